@@ -17,13 +17,16 @@ import json
 from models.Transpose_unet.unet.model import Unet as Unet_t
 from models.octave_unet.unet.model import OctaveUnet
 import torch
+from utils.torch_compile import compile_model
 
 
 class Test(object):
-    def __init__(self, model_type, image_size, mean, std, t=None):
+    def __init__(self, model_type, image_size, mean, std, t=None, compile_mode=''):
         # Models
         self.unet = None
         self.image_size = image_size # 模型的输入大小
+        # torch.compile的模式，为空时不编译
+        self.compile_mode = compile_mode
 
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.model_type = model_type
@@ -118,6 +121,9 @@ class Test(object):
             print('Load segmentation weight from %s.' % unet_path)
             seg_unet.load_state_dict(torch.load(unet_path)['state_dict'])
             seg_unet.eval()
+            # 每一折的两个模型各自编译，编译失败时退回eager
+            compile_model(self.unet, self.model_type, self.compile_mode, self.device)
+            compile_model(seg_unet, self.model_type, self.compile_mode, self.device)
             
             count_mask_classify = 0
             with torch.no_grad():
@@ -293,7 +299,9 @@ if __name__ == "__main__":
         print('Using vating strategy, thresholds_seg: ', thresholds_seg)
     print('less_than_sum: ', less_than_sum)
 
-    solver = Test(model_name, image_size, mean, std)
+    # torch.compile的模式，例如default、reduce-overhead、max-autotune，为空时不编译
+    compile_mode = ''
+    solver = Test(model_name, image_size, mean, std, compile_mode=compile_mode)
     solver.test_model(
         thresholds_classify=thresholds_classify,
         thresholds_seg=thresholds_seg,
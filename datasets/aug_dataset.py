@@ -6,6 +6,7 @@ import random
 import glob
 import tqdm
 import shutil
+import zlib
 from matplotlib import pyplot as plt
 from PIL import Image
 import threading
@@ -55,16 +56,56 @@ AUG = [
     ]
 
 
-def sample_aug(image, mask, aug):
+def aug_name(name, aug_index):
+    """第aug_index个增强结果的文件名，例如xxx.jpg -> xxx_0.jpg
+    """
+    root, ext = os.path.splitext(name)
+    return '%s_%d%s' % (root, aug_index, ext)
+
+
+def aug_seed(image_name, aug_index, seed=0):
+    """由图片名称、增强序号以及全局种子决定的随机种子，与进程无关(不使用hash)，同一个(图片, 增强)每次得到相同的结果
+    """
+    content = '%s_%d_%d' % (os.path.basename(image_name), aug_index, seed)
+    return zlib.crc32(content.encode('utf-8'))
+
+
+def sample_aug(image, mask, aug, seed=None):
     """对单个图片和掩膜应用单个aug
+
+    Args:
+        seed: 不为None时以该种子进行增强，之后恢复random和np.random原来的状态，不影响之后的随机增强
     """
-    augmented = aug(image=image, mask=mask)
+    if seed is None:
+        augmented = aug(image=image, mask=mask)
+    else:
+        # albumentations使用random和np.random
+        random_state, np_random_state = random.getstate(), np.random.get_state()
+        random.seed(seed)
+        np.random.seed(seed)
+        try:
+            augmented = aug(image=image, mask=mask)
+        finally:
+            random.setstate(random_state)
+            np.random.set_state(np_random_state)
     image_aug, mask_aug = augmented['image'], augmented['mask']
 
     return image_aug, mask_aug
 
 
-def aug_save(image_name, original_path, save_path, augs=AUG):
+def load_aug_sample(image_path, mask_path, aug_index, augs=AUG, seed=0):
+    """读取原始的图片和掩膜，应用第aug_index个增强，与dataset_aug保存的结果一致(除了保存为jpg时的压缩损失)
+
+    Return:
+        image_aug: RGB图片，numpy数组
+        mask_aug: 掩膜，numpy数组
+    """
+    image = np.asarray(Image.open(image_path).convert("RGB"))
+    mask = np.asarray(Image.open(mask_path))
+    return sample_aug(image, mask, augs[aug_index], aug_seed(image_path, aug_index, seed))
+
+
+def aug_save(image_name, original_path, save_path, augs=AUG, seed=0):
     """对单个图片和掩膜应用多个增强方法
     """
     mask_name = image_name.replace('jpg', 'png')
@@ -85,55 +126,36 @@ def aug_save(image_name, original_path, save_path, augs=AUG):
     mask_thresh = mask > 0
     mask_pixel_num = np.sum(mask_thresh)
     
-    # 只对包含掩膜的样本进行增强
-    if mask_pixel_num:
-        # 对样本进行增强并保存至目标目录
-        for aug_index, aug in enumerate(augs):
-            image_aug, mask_aug = sample_aug(image, mask, aug)
-            image_aug = Image.fromarray(image_aug)
-            mask_aug = Image.fromarray(mask_aug)
-
-            # 为增强后的样本赋予新的名称
-            image_aug_name = os.path.join(save_path, 'train_images', \
-                                            image_name.replace('.jpg', '_' + str(aug_index) + '.jpg'))
-            mask_aug_name = os.path.join(save_path, 'train_mask', \
-                                            mask_name.replace('.png', '_' + str(aug_index) + '.png'))
-        
-            image_aug.save(image_aug_name)
-            mask_aug.save(mask_aug_name)
-    else:
-        # 对于负样本，按照概率进行扩增
-        prob = random.random()
-        if prob < 1.0:
-            for aug_index, aug in enumerate(augs):
-                image_aug, mask_aug = sample_aug(image, mask, aug)
-                image_aug = Image.fromarray(image_aug)
-                mask_aug = Image.fromarray(mask_aug)
-
-                # 为增强后的样本赋予新的名称
-                image_aug_name = os.path.join(save_path, 'train_images', \
-                                                image_name.replace('.jpg', '_' + str(aug_index) + '.jpg'))
-                mask_aug_name = os.path.join(save_path, 'train_mask', \
-                                                mask_name.replace('.png', '_' + str(aug_index) + '.png'))
-        
-                image_aug.save(image_aug_name)
-                mask_aug.save(mask_aug_name)
+    # 包含掩膜的样本以及负样本都进行增强，并保存至目标目录
+    for aug_index, aug in enumerate(augs):
+        image_aug, mask_aug = sample_aug(image, mask, aug, aug_seed(image_name, aug_index, seed))
+        image_aug = Image.fromarray(image_aug)
+        mask_aug = Image.fromarray(mask_aug)
+
+        # 为增强后的样本赋予新的名称
+        image_aug_name = os.path.join(save_path, 'train_images', aug_name(image_name, aug_index))
+        mask_aug_name = os.path.join(save_path, 'train_mask', aug_name(mask_name, aug_index))
+    
+        image_aug.save(image_aug_name)
+        mask_aug.save(mask_aug_name)
 
     return image_name, mask_pixel_num
 
 
-def dataset_aug(dataset_root, save_root, augs=AUG):
-    """对原始路径下的样本进行增强，并将结果保存至目标目录下
+def dataset_aug(dataset_root, save_root, augs=AUG, seed=0):
+    """对原始路径下的样本进行增强，并将结果保存至目标目录下；训练时也可以不保存，
+    使用StageLoader的virtual_augs在读取时以同样的种子进行增强
 
     Args:
         dataset_root: 原始数据集的根目录
         save_root: 目标目录的根目录
         augs: 将采用的增强方法
+        seed: 增强的全局随机种子，与virtual_seed相同时两者的结果一致
     """
     images_path = os.path.join(dataset_root, 'train_images')
     images_name = os.listdir(images_path)
 
-    partial_aug = partial(aug_save, original_path=dataset_root, save_path=save_root, augs=augs)
+    partial_aug = partial(aug_save, original_path=dataset_root, save_path=save_root, augs=augs, seed=seed)
     pool = Pool(40)
     
     for index, (image_name, mask_pixel_num) in enumerate(pool.imap(partial_aug, images_name)):
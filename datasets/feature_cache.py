@@ -0,0 +1,199 @@
+import os
+import json
+import shutil
+import numpy as np
+import torch
+import tqdm
+from datasets.siim import StageBatchSampler
+from models.encoder_freeze import encode, encoder_fingerprint, shallow_stages, CachedBatch, SHALLOW_STRIDE
+from utils.mixed_precision import autocast
+
+
+def level_path(cache_dir, level):
+    return os.path.join(cache_dir, 'features_%d.npy' % level)
+
+
+def images_path(cache_dir):
+    return os.path.join(cache_dir, 'images.npy')
+
+
+def masks_path(cache_dir):
+    return os.path.join(cache_dir, 'masks.npy')
+
+
+def index_path(cache_dir):
+    return os.path.join(cache_dir, 'index.json')
+
+
+def to_gray(images, mean, std):
+    """由归一化的三通道输入恢复uint8的灰度图，与SIIMDataset.to_tensors互逆
+
+    Return:
+        [N, 1, H, W]，输入不是由灰度图得到时(例如各通道不同)返回None
+    """
+    mean = torch.tensor(mean, device=images.device).view(1, 3, 1, 1)
+    std = torch.tensor(std, device=images.device).view(1, 3, 1, 1)
+    pixels = (images.float() * std + mean) * 255.
+    gray = pixels[:, :1].round().clamp(0, 255)
+    if not torch.allclose(pixels, gray.expand_as(pixels), atol=1e-2):
+        return None
+    return gray.byte()
+
+
+def match_shallow_levels(model, images, features):
+    """依次运行编码器的前几个阶段，找出其输出在特征金字塔中的位置
+
+    只保留输出步长小于SHALLOW_STRIDE、并且与编码器的输出一致的阶段，这些层不缓存，读取时由图片重新计算
+    Return:
+        各阶段的输出在features中的位置，list
+    """
+    shallow_levels, x = [], images
+    for stage in shallow_stages(model.encoder):
+        x = stage(x)
+        # 部分编码器(例如densenet)后面的阶段同时输出跳跃连接，不是单个tensor
+        if not torch.is_tensor(x) or x.shape[-1] * SHALLOW_STRIDE <= images.shape[-1]:
+            break
+        level = next((level for level, feature in enumerate(features) if level not in shallow_levels and feature.shape == x.shape and
+                      torch.allclose(feature.float(), x.float(), rtol=1e-2, atol=1e-2)), None)
+        if level is None:
+            break
+        shallow_levels.append(level)
+    return shallow_levels
+
+
+class FeatureCache(object):
+    """冻结编码器且不进行数据增强时，训练集每一个样本的编码器特征在各epoch中都相同，
+    因此只计算一次，保存到内存映射文件中，之后的epoch只需要运行解码器
+
+    输入本身以及1/2、1/4分辨率的浅层特征占了特征金字塔的大部分(resnet34在768时约85%)，计算量却只占编码器的一小部分，
+    因此只缓存步长不小于SHALLOW_STRIDE的深层特征以及uint8的灰度图，浅层特征在训练时由灰度图重新计算
+
+    特征以训练时的精度保存：GPU上的混合精度训练时编码器的输出本来就是float16，否则为float32，解码器的输入与不缓存时相同
+    """
+    def __init__(self, cache_dir, max_gb=100):
+        """
+        Args:
+            cache_dir: 缓存目录，每一个(模型, 阶段, 折)一个
+            max_gb: 缓存最多占用的磁盘空间，超过时不缓存
+        """
+        self.cache_dir = cache_dir
+        self.max_gb = max_gb
+        self.index = None
+        if os.path.exists(index_path(cache_dir)):
+            with open(index_path(cache_dir), 'r') as f:
+                self.index = json.load(f)
+
+    def valid(self, image_names, image_size, fingerprint, dtype):
+        """缓存是否完整，并且与当前的样本、图片尺寸、编码器权重以及保存的精度一致
+        """
+        return self.index is not None and self.index['image_names'] == list(image_names) and \
+            self.index['image_size'] == image_size and self.index['fingerprint'] == fingerprint and \
+            self.index.get('dtype') == dtype and 'shallow_levels' in self.index
+
+    def discard(self, message):
+        print(message)
+        shutil.rmtree(self.cache_dir)
+        return False
+
+    def build(self, model, loader, device, amp=False):
+        """依次计算loader中全部样本的编码器特征并写入缓存
+
+        Args:
+            model: 原始模型(不是DataParallel)，编码器需要处于eval模式
+            loader: 不打乱顺序、不进行数据增强的训练集
+        Return:
+            是否构建成功，超出max_gb或者输入不是灰度图时返回False
+        """
+        image_names, image_size = list(loader.image_names), loader.image_size
+        dataset = loader.stage_loader.dataset
+        mean, std = list(dataset.mean), list(dataset.std)
+        fingerprint = encoder_fingerprint(model)
+        dtype = 'float16' if amp and device.type == 'cuda' else 'float32'
+        if self.valid(image_names, image_size, fingerprint, dtype):
+            return True
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+        os.makedirs(self.cache_dir)
+        self.index = None
+
+        levels, shapes, shallow_levels, images_memmap, masks_memmap, position = None, None, None, None, None, 0
+        with torch.no_grad():
+            for images, masks in tqdm.tqdm(loader, desc='Caching encoder features'):
+                images = images.to(device)
+                with autocast(device, enabled=amp):
+                    features = encode(model, images)
+                    if levels is None:
+                        shallow_levels = match_shallow_levels(model, images, features)
+                gray = to_gray(images, mean, std)
+                if gray is None:
+                    return self.discard('Training images are not grayscale, encoder features not cached.')
+                if levels is None:
+                    shapes = [None if level in shallow_levels else list(feature.shape[1:]) for level, feature in enumerate(features)]
+                    per_sample = sum(int(np.prod(shape)) for shape in shapes if shape is not None) * np.dtype(dtype).itemsize + \
+                        2 * image_size * image_size
+                    total_gb = len(image_names) * per_sample / 1024 ** 3
+                    if total_gb > self.max_gb:
+                        return self.discard('Encoder features of {} samples need {:.1f} GB (> {} GB), not cached.'.format(
+                            len(image_names), total_gb, self.max_gb))
+                    print('Caching encoder features of {} samples ({:.1f} GB, levels {} recomputed from the images) in {}'.format(
+                        len(image_names), total_gb, shallow_levels, self.cache_dir))
+                    levels = {level: np.lib.format.open_memmap(level_path(self.cache_dir, level), mode='w+', dtype=dtype,
+                                                               shape=tuple([len(image_names)] + shape))
+                              for level, shape in enumerate(shapes) if shape is not None}
+                    images_memmap = np.lib.format.open_memmap(images_path(self.cache_dir), mode='w+', dtype=np.uint8,
+                                                              shape=(len(image_names), image_size, image_size))
+                    masks_memmap = np.lib.format.open_memmap(masks_path(self.cache_dir), mode='w+', dtype=np.uint8,
+                                                             shape=(len(image_names), image_size, image_size))
+                batch_size = images.size(0)
+                for level, memmap in levels.items():
+                    memmap[position:position + batch_size] = features[level].to(getattr(torch, dtype)).cpu().numpy()
+                images_memmap[position:position + batch_size] = gray.view(batch_size, image_size, image_size).cpu().numpy()
+                masks_memmap[position:position + batch_size] = masks.view(batch_size, image_size, image_size).byte().numpy()
+                position += batch_size
+
+        for memmap in levels.values():
+            memmap.flush()
+        images_memmap.flush()
+        masks_memmap.flush()
+        # 全部写完之后才写入索引，中断时下次重新构建
+        self.index = {'image_names': image_names, 'image_size': image_size, 'fingerprint': fingerprint, 'dtype': dtype,
+                      'shapes': shapes, 'shallow_levels': shallow_levels, 'mean': mean, 'std': std}
+        tmp_path = index_path(self.cache_dir) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, index_path(self.cache_dir))
+        return True
+
+    def loader(self, batch_size, shuffle=True, weights=None):
+        return FeatureCacheLoader(self, batch_size, shuffle, weights)
+
+
+class FeatureCacheLoader(object):
+    """从特征缓存中按批次读取(CachedBatch, 掩膜)，与训练集的StageLoaderView用法相同
+
+    采样方式与训练集一致：打乱顺序，或者按权重有放回地采样
+    """
+    def __init__(self, cache, batch_size, shuffle=True, weights=None):
+        self.cache = cache
+        self.image_names = cache.index['image_names']
+        self.image_size = cache.index['image_size']
+        self.shallow_levels = tuple(cache.index['shallow_levels'])
+        self.mean, self.std = tuple(cache.index['mean']), tuple(cache.index['std'])
+        self.levels = [None if shape is None else np.load(level_path(cache.cache_dir, level), mmap_mode='r')
+                       for level, shape in enumerate(cache.index['shapes'])]
+        self.images = np.load(images_path(cache.cache_dir), mmap_mode='r')
+        self.masks = np.load(masks_path(cache.cache_dir), mmap_mode='r')
+        self.batch_sampler = StageBatchSampler()
+        self.batch_sampler.set_stage(range(len(self.image_names)), batch_size, self.image_size, shuffle=shuffle, weights=weights)
+
+    def __iter__(self):
+        for batch in self.batch_sampler:
+            # 按顺序读取内存映射更快，批次内的顺序不影响训练；按下标读取得到的是可写的副本
+            positions = np.sort([key[0] for key in batch])
+            features = [None if level is None else torch.from_numpy(level[positions]) for level in self.levels]
+            images = torch.from_numpy(self.images[positions]).unsqueeze(1)
+            masks = torch.from_numpy(self.masks[positions]).float()
+            yield CachedBatch(images, features, self.shallow_levels, self.mean, self.std), masks
+
+    def __len__(self):
+        return len(self.batch_sampler)
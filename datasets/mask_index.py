@@ -0,0 +1,88 @@
+import os
+import json
+import fcntl
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+
+DEFAULT_INDEX_PATH = './checkpoints/mask_area_index.json'
+
+
+def mask_area(mask_path):
+    """掩膜中前景像素的个数
+    """
+    return int(np.count_nonzero(np.asarray(Image.open(mask_path))))
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class MaskAreaIndex(object):
+    """每一个掩膜的前景像素数目，按照文件的修改时间和大小判断是否需要重新计算，保存在一个json文件中
+
+    只缓存各掩膜的像素数目，采样权重由像素数目直接计算；
+    多个进程(并行调度的各折、分布式训练的各进程)可能同时更新索引，保存时在文件锁中合并各自新计算的条目
+    """
+    def __init__(self, index_path=DEFAULT_INDEX_PATH):
+        self.index_path = index_path
+        # 掩膜路径 -> [修改时间, 文件大小, 前景像素数目]
+        self.entries = self.load()
+        # 本进程新计算的条目，保存时合并到文件中
+        self.updated = set()
+
+    def load(self):
+        if not os.path.exists(self.index_path):
+            return dict()
+        with open(self.index_path, 'r') as f:
+            return json.load(f)['entries']
+
+    def record(self, mask_path, area):
+        """记录已经计算好的像素数目(例如DatasetsStatic扫描掩膜时得到的)，避免再次读取掩膜
+        """
+        self.entries[mask_path] = file_stamp(mask_path) + [int(area)]
+        self.updated.add(mask_path)
+
+    def areas(self, mask_paths):
+        """
+        Return:
+            各掩膜的前景像素数目，np.int64；只读取新增或者修改过的掩膜
+        """
+        stale = list()
+        for mask_path in mask_paths:
+            entry = self.entries.get(mask_path)
+            if entry is None or entry[:2] != file_stamp(mask_path):
+                stale.append(mask_path)
+        for mask_path in tqdm(stale, desc='Indexing mask areas', disable=not stale):
+            self.record(mask_path, mask_area(mask_path))
+        if self.updated:
+            self.save()
+        return np.asarray([self.entries[mask_path][2] for mask_path in mask_paths], dtype=np.int64)
+
+    def sample_weights(self, mask_paths, weights_sample):
+        """有掩膜的样本的采样权重为weights_sample[1]，没有掩膜的为weights_sample[0]
+
+        Return:
+            weights: 与mask_paths一一对应的采样权重，list
+        """
+        areas = self.areas(mask_paths)
+        return np.where(areas > 0, weights_sample[1], weights_sample[0]).tolist()
+
+    def save(self):
+        """在文件锁中读取其它进程已经写入的条目，合并本进程新计算的条目后写入
+        """
+        index_dir = os.path.dirname(self.index_path)
+        if index_dir and not os.path.exists(index_dir):
+            os.makedirs(index_dir, exist_ok=True)
+        with open(self.index_path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = self.load()
+            entries.update({mask_path: self.entries[mask_path] for mask_path in self.updated})
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'entries': entries}, f)
+            os.replace(tmp_path, self.index_path)
+        self.entries = entries
+        self.updated.clear()
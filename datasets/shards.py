@@ -0,0 +1,177 @@
+import os
+import json
+import fcntl
+import argparse
+import numpy as np
+from multiprocessing import Pool
+from PIL import Image
+
+
+def image_shard_path(shard_root, image_size):
+    return os.path.join(shard_root, 'images_%d.npy' % image_size)
+
+
+def mask_shard_path(shard_root, image_size):
+    return os.path.join(shard_root, 'masks_%d.npy' % image_size)
+
+
+def index_path(shard_root):
+    return os.path.join(shard_root, 'index.json')
+
+
+def decode_gray(image_path, image_size=None):
+    """以灰度图解码样本，得到uint8的L模式图片
+
+    JPEG在DCT域中可以按1/2、1/4、1/8缩小解码(PIL的draft)，目标尺寸不超过原图的一半时直接解码为较小的图片，
+    之后只需要一次较小的缩放；目标尺寸更大时与完整解码相同
+    Args:
+        image_size: 目标尺寸，为None时完整解码
+    """
+    image = Image.open(image_path)
+    if image_size and image.format == 'JPEG':
+        image.draft('L', (image_size, image_size))
+    return image.convert('L')
+
+
+def decode_sample(image_path, mask_path, image_size):
+    """与SIIMDataset中的预处理保持一致：样本以双线性插值缩放，掩膜使用PIL默认的插值缩放
+
+    胸片为灰度图，SIIMDataset中转换为RGB时三个通道相同，因此只保存一个通道
+    Return:
+        image: [image_size, image_size]，uint8
+        mask: [image_size, image_size]，uint8，值为0/255
+    """
+    return resize_sample(decode_gray(image_path, image_size), Image.open(mask_path), image_size)
+
+
+def resize_sample(image, mask, image_size):
+    """按照decode_sample的方式缩放已经打开的样本(L模式)和掩膜
+    """
+    image = image.resize((image_size, image_size), Image.BILINEAR)
+    mask = mask.resize((image_size, image_size)).convert('L')
+    # 与mask_transform中的np.around(mask/256.)一致
+    mask = (np.asarray(mask) > 128).astype(np.uint8) * 255
+    return np.array(image), mask
+
+
+def _write_chunk(args):
+    shard_root, image_size, start, images_path, masks_path = args
+    images = np.load(image_shard_path(shard_root, image_size), mmap_mode='r+')
+    masks = np.load(mask_shard_path(shard_root, image_size), mmap_mode='r+')
+    for offset, (image_path, mask_path) in enumerate(zip(images_path, masks_path)):
+        images[start + offset], masks[start + offset] = decode_sample(image_path, mask_path, image_size)
+    images.flush()
+    masks.flush()
+    return len(images_path)
+
+
+def build_shards(images_path, masks_path, shard_root, image_sizes=(768, 1024), num_workers=8, chunk_size=64):
+    """将样本和掩膜解码、缩放后写入连续的uint8数组，每一种分辨率一个内存映射文件，只需要构建一次
+
+    Args:
+        images_path: 样本路径
+        masks_path: 掩膜路径
+        shard_root: 存放目录，其中index.json记录样本顺序以及已经构建好的分辨率
+        image_sizes: 需要构建的分辨率，例如第一阶段768，第二、三阶段1024
+        num_workers: 并行解码的进程数
+    """
+    if not os.path.exists(shard_root):
+        os.makedirs(shard_root, exist_ok=True)
+    # 并行训练的各折共用同一个shard_root，只由一个进程构建，其它进程等待之后重新读取索引，构建好的分辨率不再重复写入
+    with open(os.path.join(shard_root, 'index.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return _build_shards(images_path, masks_path, shard_root, image_sizes, num_workers, chunk_size)
+
+
+def _build_shards(images_path, masks_path, shard_root, image_sizes, num_workers, chunk_size):
+    index = load_index(shard_root)
+    if index is None or index['images'] != list(images_path) or index['masks'] != list(masks_path):
+        index = {'images': list(images_path), 'masks': list(masks_path), 'image_sizes': list()}
+
+    for image_size in image_sizes:
+        if image_size in index['image_sizes']:
+            continue
+        print('Building {}x{} shards of {} samples in {}...'.format(image_size, image_size, len(images_path), shard_root))
+        shape = (len(images_path), image_size, image_size)
+        np.lib.format.open_memmap(image_shard_path(shard_root, image_size), mode='w+', dtype=np.uint8, shape=shape).flush()
+        np.lib.format.open_memmap(mask_shard_path(shard_root, image_size), mode='w+', dtype=np.uint8, shape=shape).flush()
+        chunks = [(shard_root, image_size, start, images_path[start:start + chunk_size], masks_path[start:start + chunk_size])
+                  for start in range(0, len(images_path), chunk_size)]
+        if num_workers > 0:
+            with Pool(num_workers) as pool:
+                list(pool.imap_unordered(_write_chunk, chunks))
+        else:
+            list(map(_write_chunk, chunks))
+        # 全部写完之后才记录到索引中，中断时下次会重新构建该分辨率
+        index['image_sizes'].append(image_size)
+        save_index(shard_root, index)
+    return index
+
+
+def load_index(shard_root):
+    if not os.path.exists(index_path(shard_root)):
+        return None
+    with open(index_path(shard_root), 'r') as f:
+        return json.load(f)
+
+
+def save_index(shard_root, index):
+    tmp_path = index_path(shard_root) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path(shard_root))
+
+
+class ShardStore(object):
+    """以内存映射的方式读取构建好的分辨率，内存映射在第一次读取时打开，因此在DataLoader的每一个worker中各自打开
+    """
+    def __init__(self, shard_root):
+        self.shard_root = shard_root
+        index = load_index(shard_root) or {'images': [], 'masks': [], 'image_sizes': []}
+        self.image_sizes = set(index['image_sizes'])
+        self.path_index = {os.path.normpath(image_path): position for position, image_path in enumerate(index['images'])}
+        self.arrays = dict()
+
+    def __getstate__(self):
+        # 传给worker时不复制已经打开的内存映射
+        state = dict(self.__dict__)
+        state['arrays'] = dict()
+        return state
+
+    def position(self, image_path, image_size):
+        """样本在分片中的位置，没有对应的分片时返回None
+        """
+        if image_size not in self.image_sizes:
+            return None
+        return self.path_index.get(os.path.normpath(image_path))
+
+    def get(self, position, image_size):
+        """
+        Return:
+            image, mask: 分片中的只读视图，不进行拷贝；转为tensor之前需要复制
+        """
+        if image_size not in self.arrays:
+            self.arrays[image_size] = (np.load(image_shard_path(self.shard_root, image_size), mmap_mode='r'),
+                                       np.load(mask_shard_path(self.shard_root, image_size), mmap_mode='r'))
+        images, masks = self.arrays[image_size]
+        return images[position], masks[position]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_root', type=str, default='./datasets/SIIM_data')
+    parser.add_argument('--folders', type=str, nargs='+', default=['train_images:train_mask', 'test_images:test_mask'],
+                        help='image_folder:mask_folder pairs under dataset_root')
+    parser.add_argument('--shard_root', type=str, default='./datasets/SIIM_data/shards')
+    parser.add_argument('--image_sizes', type=int, nargs='+', default=[768, 1024])
+    parser.add_argument('--num_workers', type=int, default=8)
+    args = parser.parse_args()
+
+    images_path, masks_path = list(), list()
+    for folders in args.folders:
+        image_folder, mask_folder = folders.split(':')
+        # 与DatasetsStatic中的路径保持一致
+        for image_name in sorted(os.listdir(os.path.join(args.dataset_root, image_folder))):
+            images_path.append(os.path.join(args.dataset_root, image_folder, image_name))
+            masks_path.append(os.path.join(args.dataset_root, mask_folder, image_name.replace('jpg', 'png')))
+    build_shards(images_path, masks_path, args.shard_root, args.image_sizes, args.num_workers)
@@ -1,4 +1,5 @@
 import os, glob
+import shutil
 import torch
 import numpy as np
 import pandas as pd
@@ -7,13 +8,19 @@ import torch
 
 from tqdm import tqdm
 from PIL import Image
-from torchvision import transforms
 from tqdm import tqdm
 from torch.utils.data import DataLoader
 from utils.mask_functions import rle2mask
-from utils.data_augmentation import data_augmentation
+from utils.data_augmentation import data_augmentation, dump_timings, load_timings, format_timings
+from datasets.shards import ShardStore, decode_sample, resize_sample
+from datasets.aug_dataset import aug_name, load_aug_sample
+from utils.batch_augmentation import DEVICE_AUGMENTATION
+from datasets.mask_index import MaskAreaIndex, DEFAULT_INDEX_PATH
 from torch.utils.data.sampler import WeightedRandomSampler
-import pickle
+import random
+
+
+TIMING_DUMP_INTERVAL = 256
 
 
 # SIIM Dataset Class
@@ -37,11 +44,16 @@ class SIIMDataset(torch.utils.data.Dataset):
         # self.std = (0.229, 0.229, 0.229)
         self.mean = (0.485, 0.456, 0.406)
         self.std = (0.229, 0.224, 0.225)    
+        self.mean_tensor = torch.tensor(self.mean).view(3, 1, 1)
+        self.std_tensor = torch.tensor(self.std).view(3, 1, 1)
 
         # 所有样本和掩膜的名称
         self.image_names = train_image
         self.mask_names = train_mask
         self.compare_image_mask_path = compare_image_mask_path
+        # 若不为空，worker每增强TIMING_DUMP_INTERVAL个样本，以及每一轮遍历的最后一个批次，将各变换的累计耗时写入该目录
+        self.timing_dir = ''
+        self.augmented = 0
 
     def __getitem__(self, idx):
         """得到样本与其对应的mask
@@ -49,110 +61,400 @@ class SIIMDataset(torch.utils.data.Dataset):
             img: 经过预处理的样本图片
             mask: 值为0/1，0表示属于背景，1表示属于目标类
         """
-        # 依据idx读取样本图片
+        return self.load_sample(idx, self.image_size, self.augmentation_flag)
+
+    def load_sample(self, idx, image_size, augmentation_flag):
+        """按照给定的图片尺寸以及增强方法，读取第idx个样本与其对应的mask
+
+        样本直接解码为灰度图并缩放到目标尺寸，之后的数据增强以及转换都在numpy数组上进行
+        """
         img_path = self.image_names[idx]
-        img = Image.open(img_path).convert("RGB")
-        # 依据idx读取掩膜
         mask_path = self.mask_names[idx]
-        mask = Image.open(mask_path)
-
         if self.compare_image_mask_path:
             assert img_path.split('/')[-1][:-4] == mask_path.split('/')[-1][:-4]
 
-        if self.augmentation_flag:
-            img, mask = self.augmentation(img, mask)
+        image, mask = decode_sample(img_path, mask_path, image_size)
+        return self.to_tensors(image, mask, augmentation_flag)
 
-        # 对图片和mask同时进行转换
-        img = self.image_transform(img)
-        mask = self.mask_transform(mask)
+    def to_tensors(self, image, mask, augmentation_flag):
+        """对缩放好的样本和掩膜进行数据增强，并转换为模型的输入，与Resize、ToTensor以及Normalize一致
 
-        return img, mask
+        Args:
+            image: 灰度图，uint8
+            mask: 值为0/255，uint8
+            augmentation_flag: 为False时不进行增强，为True时使用默认的增强方法，也可以为PIPELINES中的增强方法名称；
+                为DEVICE_AUGMENTATION时不增强也不归一化，返回uint8的image [1, H, W]和值为0/255的mask，由训练设备上的BatchAugmentation处理
+        """
+        # 从分片中读取时image、mask是只读的内存映射，np.ascontiguousarray不会复制连续的数组，需要显式复制后再转为tensor
+        if augmentation_flag == DEVICE_AUGMENTATION:
+            return torch.from_numpy(np.array(image)).unsqueeze(0), torch.from_numpy(np.array(mask))
+        if augmentation_flag:
+            image, mask = self.augmentation(image, mask, augmentation_flag)
+        image = torch.from_numpy(np.array(image))
+        # 灰度图的三个通道相同，归一化时直接广播为三通道
+        image = image.unsqueeze(0) if image.dim() == 2 else image.permute(2, 0, 1)
+        image = (image.float() / 255. - self.mean_tensor) / self.std_tensor
+        # 将255转换为1， 0转换为0
+        mask = torch.from_numpy(np.around(np.asarray(mask) / 256.)).float()
+        return image, mask
 
-    def image_transform(self, image):
-        """对样本进行预处理
+    def augmentation(self, image, mask, name=True):
+        """进行数据增强
+        Args:
+            image: 原始图像，numpy数组
+            mask: 原始掩膜，numpy数组
+            name: 增强方法的名称，为True时使用默认的增强方法
+        Return:
+            image_aug: 增强后的图像，numpy数组
+            mask: 增强后的掩膜，numpy数组
         """
-        resize = transforms.Resize(self.image_size)
-        to_tensor = transforms.ToTensor()
-        normalize = transforms.Normalize(self.mean, self.std)
+        # 数据增强的输入为RGB图片，增强后各通道可能不再相同
+        if image.ndim == 2:
+            image = np.stack([image] * 3, axis=-1)
+
+        image_aug, mask_aug = data_augmentation(image, mask, 'default' if name is True else name)
+        self.augmented += 1
+        if self.timing_dir and self.augmented % TIMING_DUMP_INTERVAL == 0:
+            dump_timings(self.timing_dir)
+
+        return image_aug, mask_aug
+
+    def __len__(self):
+        return len(self.image_names)
+
+
+class SIIMStageDataset(SIIMDataset):
+    """包含所有折、所有阶段用到的全部样本，下标为(样本序号, 图片尺寸, 是否增强, 增强的随机种子, 是否写入增强耗时)。
+
+    各阶段的图片尺寸、是否增强以及各折的样本子集都由主进程中的StageBatchSampler决定，
+    因此同一组DataLoader worker可以在不同阶段、不同折之间复用。
+    增强的随机种子同样由采样器给出，worker中的随机状态只取决于采样器的状态，从而可以在epoch中间精确地恢复训练
 
-        transform_compose = transforms.Compose([resize, to_tensor, normalize])
+    virtual_augs不为空时进行虚拟扩增：样本序号idx + (k + 1) * 样本总数表示第idx个样本经过virtual_augs[k]增强的结果，
+    读取时以固定的种子进行增强，与datasets.aug_dataset.dataset_aug保存到磁盘上的扩增样本一致，但不需要额外的文件
+    """
+    def __init__(self, images_path, masks_path, virtual_augs=(), virtual_seed=0):
+        super(SIIMStageDataset, self).__init__(images_path, masks_path, image_size=None, augmentation_flag=False)
+        self.virtual_augs = list(virtual_augs)
+        self.virtual_seed = virtual_seed
+
+    def __getitem__(self, key):
+        idx, image_size, augmentation_flag, seed, flush_timings = key
+        if seed is not None:
+            # albumentations使用random和np.random
+            random.seed(seed)
+            np.random.seed(seed % 2 ** 32)
+        source, aug_index = self.virtual_source(idx)
+        if aug_index is not None:
+            sample = self.load_virtual_sample(source, aug_index, image_size, augmentation_flag)
+        else:
+            sample = self.load_sample(source, image_size, augmentation_flag)
+        if flush_timings and self.timing_dir:
+            # 该worker本轮遍历的最后一个批次，写入累计耗时，epoch结束时汇总的结果不会漏掉不足TIMING_DUMP_INTERVAL的部分
+            dump_timings(self.timing_dir)
+        return sample
 
-        return transform_compose(image)
+    def __len__(self):
+        return len(self.image_names) * (len(self.virtual_augs) + 1)
 
-    def mask_transform(self, mask):
-        """对mask进行预处理
+    def virtual_source(self, idx):
         """
-        mask = mask.resize((self.image_size, self.image_size))
-        # 将255转换为1， 0转换为0
-        mask = np.around(np.array(mask.convert('L'))/256.)
-        # # mask = mask[:, :, np.newaxis] # Wrong, will convert range
-        # mask = np.reshape(mask, (np.shape(mask)[0],np.shape(mask)[1],1)).astype("float32")
-        # to_tensor = transforms.ToTensor()
-
-        # transform_compose = transforms.Compose([to_tensor])
-        # mask = transform_compose(mask)
-        # mask = torch.squeeze(mask)
-        mask = torch.from_numpy(mask)
-        return mask.float()
-    
-    def augmentation(self, image, mask):
-        """进行数据增强
-        Args:
-            image: 原始图像，Image图像
-            mask: 原始掩膜，Image图像
         Return:
-            image_aug: 增强后的图像，Image图像
-            mask: 增强后的掩膜，Image图像
+            source: 原始样本的序号
+            aug_index: virtual_augs中增强的序号，原始样本为None
         """
-        image = np.asarray(image)
-        mask = np.asarray(mask)
+        slot, source = divmod(idx, len(self.image_names))
+        return source, slot - 1 if slot else None
 
-        image_aug, mask_aug = data_augmentation(image, mask)
+    def load_virtual_sample(self, idx, aug_index, image_size, augmentation_flag):
+        """读取原始尺寸的样本，以固定的种子应用virtual_augs[aug_index]后缩放到image_size，之后与其它样本一样进行随机增强
+        """
+        image, mask = load_aug_sample(self.image_names[idx], self.mask_names[idx], aug_index, self.virtual_augs, self.virtual_seed)
+        image, mask = resize_sample(Image.fromarray(image).convert('L'), Image.fromarray(mask), image_size)
+        return self.to_tensors(image, mask, augmentation_flag)
 
-        image_aug = Image.fromarray(image_aug)
-        mask_aug = Image.fromarray(mask_aug)
 
-        return image_aug, mask_aug
+class SIIMShardDataset(SIIMStageDataset):
+    """从内存映射的分片中读取已经解码、缩放好的样本，worker中只需要进行数据增强；没有对应分片的样本以及虚拟扩增的样本仍然从图片解码
+    """
+    def __init__(self, images_path, masks_path, shard_root, virtual_augs=(), virtual_seed=0):
+        super(SIIMShardDataset, self).__init__(images_path, masks_path, virtual_augs, virtual_seed)
+        self.store = ShardStore(shard_root)
+
+    def load_sample(self, idx, image_size, augmentation_flag):
+        position = self.store.position(self.image_names[idx], image_size)
+        if position is None:
+            return super(SIIMShardDataset, self).load_sample(idx, image_size, augmentation_flag)
+        image, mask = self.store.get(position, image_size)
+        return self.to_tensors(image, mask, augmentation_flag)
+
+
+class StageBatchSampler(torch.utils.data.Sampler):
+    """在主进程中生成批次下标，当前阶段的配置可以随时通过set_stage修改
+
+    分布式训练时与DistributedSampler一致：各进程使用相同的种子生成同一个全局顺序，补齐为world_size的整数倍后，
+    每一个进程取其中的一份；按权重采样时同样先在全局采样再切分，相当于分布式版本的WeightedRandomSampler
+
+    每一轮遍历的顺序(包括按权重采样的结果)以及增强的随机种子可以通过state_dict保存，
+    load_state_dict之后的下一轮遍历沿用保存的顺序，并跳过已经训练过的批次
+
+    flush_batches不为0时，增强的批次中最后flush_batches个批次的最后一个下标标记为写入增强耗时；
+    DataLoader按顺序轮流将批次分配给各worker，取worker的数目时每一个worker在一轮遍历结束前都会写入一次
+    """
+    def __init__(self, rank=0, world_size=1, seed=0):
+        self.indices = list()
+        self.batch_size = 1
+        self.image_size = None
+        self.augmentation_flag = False
+        self.shuffle = False
+        self.weights = None
+        self.shard = False
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+        # 最近一轮遍历的顺序和增强种子，以及待恢复的状态
+        self.current_order = None
+        self.current_aug_seed = None
+        self.resume_state = None
+        self.flush_batches = 0
+
+    def set_stage(self, indices, batch_size, image_size, augmentation_flag=False, shuffle=False, weights=None, shard=False):
+        """
+        Args:
+            indices: 当前使用的样本在SIIMStageDataset中的下标
+            batch_size: batch size
+            image_size: 图片尺寸
+            augmentation_flag: 是否进行数据增强
+            shuffle: 是否打乱顺序
+            weights: 若不为None，则按照权重有放回地采样，与WeightedRandomSampler一致
+            shard: 分布式训练时是否将样本切分到各个进程，验证集只在主进程上进行，不需要切分
+        """
+        self.indices = list(indices)
+        self.batch_size = batch_size
+        self.image_size = image_size
+        self.augmentation_flag = augmentation_flag
+        self.shuffle = shuffle
+        self.weights = weights
+        self.shard = shard
+
+    def sharded(self, shard=None):
+        return (self.shard if shard is None else shard) and self.world_size > 1
+
+    def generator(self):
+        """分布式训练时各进程需要相同的随机顺序，使用种子与遍历次数生成；否则使用全局的随机数
+        """
+        if not self.sharded():
+            return None
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+        return generator
+
+    def order(self, generator=None):
+        """本轮遍历的样本顺序
+        """
+        if self.weights is not None:
+            positions = torch.multinomial(torch.as_tensor(self.weights, dtype=torch.double), len(self.indices), replacement=True,
+                                          generator=generator)
+            order = [self.indices[x] for x in positions.tolist()]
+        elif self.shuffle:
+            order = [self.indices[x] for x in torch.randperm(len(self.indices), generator=generator).tolist()]
+        else:
+            order = self.indices
+        if self.sharded():
+            total_size = self.num_samples() * self.world_size
+            while len(order) < total_size:
+                order = order + order[:total_size - len(order)]
+            order = order[self.rank::self.world_size]
+        return order
+
+    def num_samples(self, num_indices=None, shard=None):
+        """当前进程本轮遍历的样本数目，num_indices、shard缺省时使用当前阶段的配置
+        """
+        num_indices = len(self.indices) if num_indices is None else num_indices
+        if self.sharded(shard):
+            return (num_indices + self.world_size - 1) // self.world_size
+        return num_indices
+
+    def num_batches(self, num_indices=None, batch_size=None, shard=None):
+        """当前进程本轮遍历的批次数目，参数缺省时使用当前阶段的配置，不修改采样器的状态
+        """
+        batch_size = self.batch_size if batch_size is None else batch_size
+        return (self.num_samples(num_indices, shard) + batch_size - 1) // batch_size
+
+    def state_dict(self):
+        """最近一轮遍历的状态，与训练循环中已经完成的批次数一起保存即可从该批次继续
+        """
+        return {'order': self.current_order, 'aug_seed': self.current_aug_seed, 'epoch': self.epoch}
+
+    def load_state_dict(self, state, start_batch=0):
+        """下一轮遍历使用保存的顺序和增强种子，并从第start_batch个批次开始
+        """
+        self.resume_state = dict(state, start_batch=start_batch)
+        self.epoch = state['epoch']
+
+    def __iter__(self):
+        start_batch = 0
+        if self.resume_state is not None and not self.sharded():
+            order, aug_seed, start_batch = self.resume_state['order'], self.resume_state['aug_seed'], self.resume_state['start_batch']
+            self.resume_state = None
+        else:
+            if self.resume_state is not None:
+                # 分布式训练时只有主进程保存了自己的那一份顺序，各进程由种子和遍历次数重新生成本轮的顺序
+                self.epoch = self.resume_state['epoch'] - 1
+                start_batch = self.resume_state['start_batch']
+                self.resume_state = None
+            generator = self.generator()
+            order = self.order(generator)
+            # 分布式训练时各进程的增强种子同样由种子和遍历次数决定，偏移各自的进程序号
+            aug_seed = int(torch.randint(0, 2 ** 31 - 1, (1,), generator=generator).item()) + self.rank
+        self.current_order, self.current_aug_seed = order, aug_seed
+        # 生成器在DataLoader取批次时才执行，当前阶段的配置在这里取出，之后其它loader调用set_stage不影响本轮遍历
+        return self.batches(order, aug_seed, self.batch_size, self.image_size, self.augmentation_flag, start_batch)
+
+    def batches(self, order, aug_seed, batch_size, image_size, augmentation_flag, start_batch=0):
+        num_batches = (len(order) + batch_size - 1) // batch_size
+        flush_start = (num_batches - self.flush_batches) * batch_size if augmentation_flag else len(order)
+        for start in range(start_batch * batch_size, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            yield [(idx, image_size, augmentation_flag, aug_seed + (start + offset) * self.world_size if augmentation_flag else None,
+                    start >= flush_start and offset == len(batch) - 1)
+                   for offset, idx in enumerate(batch)]
 
     def __len__(self):
-        return len(self.image_names)
+        return self.num_batches()
+
 
-def exist_mask(mask):
-    """判断是否存在掩膜
+class StageLoaderView(object):
+    """某一折某一阶段的训练集或验证集，遍历时将配置写入共享的采样器，并复用同一个DataLoader
     """
-    pix_max = torch.max(mask)
-    if pix_max == 1:
-        flag = 1
-    elif pix_max == 0:
-        flag = 0
-    
-    return flag
+    def __init__(self, stage_loader, image_names, indices, batch_size, image_size, augmentation_flag, shuffle, weights=None, shard=False):
+        self.stage_loader = stage_loader
+        self.image_names = image_names
+        self.indices = indices
+        self.batch_size = batch_size
+        self.image_size = image_size
+        self.augmentation_flag = augmentation_flag
+        self.shuffle = shuffle
+        self.weights = weights
+        self.shard = shard
+
+    @property
+    def batch_sampler(self):
+        return self.stage_loader.batch_sampler
+
+    def set_stage(self):
+        self.stage_loader.batch_sampler.set_stage(self.indices, self.batch_size, self.image_size, self.augmentation_flag, self.shuffle, self.weights, self.shard)
 
-def weight_mask(dataset, weights_sample=[1, 3]):
+    def __iter__(self):
+        self.set_stage()
+        return iter(self.stage_loader.data_loader)
+
+    def __len__(self):
+        # 由自己的配置计算，不写入共享的采样器，否则会改变其它loader正在进行的遍历
+        return self.stage_loader.batch_sampler.num_batches(len(self.indices), self.batch_size, self.shard)
+
+    def ordered_view(self):
+        """同样的样本，但不打乱顺序、不进行数据增强、不切分到各个进程，用于逐样本地计算一次(例如缓存编码器特征)
+        """
+        return StageLoaderView(self.stage_loader, self.image_names, self.indices, self.batch_size, self.image_size,
+                               augmentation_flag=False, shuffle=False)
+
+
+class StageLoader(object):
+    """整个交叉验证过程共用的数据加载器：数据集和worker进程只创建一次，各折、各阶段通过get_loaders得到对应的训练集和验证集
+    """
+    def __init__(self, images_path, masks_path, num_workers=2, rank=0, world_size=1, shard_root='', timing_dir='',
+                 virtual_augs=(), virtual_seed=0):
+        """
+        Args:
+            images_path: 所有折、所有阶段会用到的样本路径
+            masks_path: 样本对应的掩膜路径
+            num_workers: worker进程数目
+            rank, world_size: 分布式训练时当前进程的序号以及进程总数
+            shard_root: 若不为空，则从该目录下预先解码好的分片中读取样本
+            timing_dir: 若不为空，各worker将数据增强中各变换的累计耗时写入该目录
+            virtual_augs: 若不为空，训练集的每一个样本扩增为原始样本以及各个增强的结果，例如datasets.aug_dataset.AUG
+            virtual_seed: 虚拟扩增的全局随机种子
+        """
+        if shard_root:
+            self.dataset = SIIMShardDataset(images_path, masks_path, shard_root, virtual_augs, virtual_seed)
+        else:
+            self.dataset = SIIMStageDataset(images_path, masks_path, virtual_augs, virtual_seed)
+        self.timing_dir = timing_dir
+        if timing_dir:
+            # 清除之前运行时留下的记录
+            if rank == 0 and os.path.exists(timing_dir):
+                shutil.rmtree(timing_dir)
+            self.dataset.timing_dir = timing_dir
+        self.path_index = {image_path: index for index, image_path in enumerate(images_path)}
+        self.batch_sampler = StageBatchSampler(rank, world_size)
+        if timing_dir:
+            self.batch_sampler.flush_batches = max(num_workers, 1)
+        # DataLoader创建迭代器时从generator中取worker的基础种子；使用单独的生成器，不消耗全局随机数，
+        # 否则从epoch中间继续训练时，恢复的全局随机状态被取走一次，之后各epoch的顺序与没有中断时不同
+        self.data_loader = DataLoader(self.dataset, batch_sampler=self.batch_sampler, num_workers=num_workers, pin_memory=True,
+                                      persistent_workers=num_workers > 0, generator=torch.Generator().manual_seed(rank))
+
+    def get_loaders(self, train_image, train_mask, val_image, val_mask, image_size=224, batch_size=2, augmentation_flag=False, weights_sample=None):
+        """参数与get_loader一致，返回的训练集和验证集共用同一组worker；augmentation_flag也可以为增强方法的名称
+        """
+        train_indices = [self.path_index[x] for x in train_image]
+        val_indices = [self.path_index[x] for x in val_image]
+
+        weights = None
+        # 依据weigths_sample决定是否对训练集的样本进行采样
+        if weights_sample:
+            weights = get_weights(train_mask, weights_sample)
+        if self.dataset.virtual_augs:
+            train_image, train_indices, weights = self.virtual_samples(train_image, train_indices, weights)
+        train_loader = StageLoaderView(self, train_image, train_indices, batch_size, image_size, augmentation_flag, shuffle=True, weights=weights, shard=True)
+        # 验证集要保证augmentation_flag为False
+        val_loader = StageLoaderView(self, val_image, val_indices, batch_size, image_size, augmentation_flag=False, shuffle=False)
+        return train_loader, val_loader
+
+    def virtual_samples(self, image_names, indices, weights=None):
+        """训练集加上各样本的虚拟扩增样本，名称与dataset_aug保存的文件名相同，采样权重与原始样本相同
+
+        Return:
+            扩增后的image_names, indices, weights
+        """
+        num_images = len(self.path_index)
+        virtual_names, virtual_indices = list(image_names), list(indices)
+        for aug_index in range(len(self.dataset.virtual_augs)):
+            virtual_names += [aug_name(image_name, aug_index) for image_name in image_names]
+            virtual_indices += [idx + (aug_index + 1) * num_images for idx in indices]
+        if weights is not None:
+            weights = list(weights) * (len(self.dataset.virtual_augs) + 1)
+        return virtual_names, virtual_indices, weights
+
+    def augmentation_timings(self):
+        """所有worker中各数据增强变换累计的调用次数和耗时，没有记录时为空字符串
+        """
+        if not self.timing_dir:
+            return ''
+        return format_timings(load_timings(self.timing_dir))
+
+def weight_mask(mask_paths, weights_sample=[1, 3], index_path=DEFAULT_INDEX_PATH):
     """计算每一个样本的权重
 
     Args:
-        dataset: 数据集
+        mask_paths: 训练集各样本的掩膜路径
         weight_sample: 正负类样本对应的采样权重
+        index_path: 掩膜前景像素数目的索引文件，只需要读取新增或者修改过的掩膜
     
     Return:
         weights: 每一个样本对应的权重 
     """
-    print('Start calculating weights of sample...')
-    weights = list()
-    tbar = tqdm(dataset)
-    for index, (image, mask) in enumerate(tbar):
-        flag = exist_mask(mask)
-        # 存在掩膜的样本的采样权重为3，不存在的为1
-        if flag:
-            weights.append(weights_sample[1])
-        else:
-            weights.append(weights_sample[0])
-        descript = 'Image %d, flag: %d' % (index, flag)
-        tbar.set_description(descript)
+    return MaskAreaIndex(index_path).sample_weights(mask_paths, weights_sample)
 
-    print('Finish calculating weights of sample...')
-    return weights
+
+def get_weights(mask_paths, weights_sample, index_path=DEFAULT_INDEX_PATH):
+    """由索引文件中缓存的掩膜像素数目计算训练集中每一个样本的采样权重，各折、各阶段互不影响
+    """
+    print('Extract weights of sample from: {}'.format(index_path))
+    return weight_mask(mask_paths, weights_sample, index_path)
 
 
 def get_loader(train_image, train_mask, val_image, val_mask, image_size=224, batch_size=2, num_workers=2, augmentation_flag=False, weights_sample=None):
@@ -164,15 +466,7 @@ def get_loader(train_image, train_mask, val_image, val_mask, image_size=224, bat
     
     # 依据weigths_sample决定是否对训练集的样本进行采样
     if weights_sample:
-        if os.path.exists('weights_sample.pkl'):
-            print('Extract weights of sample from: weights_sample.pkl...')
-            with open('weights_sample.pkl', 'rb') as f:
-                weights = pickle.load(f)
-        else:
-            print('Calculating weights of sample...')
-            weights = weight_mask(dataset_train, weights_sample)
-            with open('weights_sample.pkl', 'wb') as f:
-                pickle.dump(weights, f)            
+        weights = get_weights(train_mask, weights_sample)
         sampler = WeightedRandomSampler(weights, num_samples=len(dataset_train), replacement=True)
         train_data_loader = DataLoader(dataset_train, batch_size=batch_size, num_workers=num_workers, sampler=sampler, pin_memory=True)
     else: 
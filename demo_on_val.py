@@ -3,7 +3,7 @@ import os
 from glob import glob
 import numpy as np
 from PIL import Image
-import pickle
+from utils.datasets_statics import DatasetsStatic
 from tqdm import tqdm_notebook, tqdm
 from models.network import U_Net, R2U_Net, AttU_Net, R2AttU_Net
 from models.linknet import LinkNet34
@@ -310,13 +310,10 @@ if __name__ == "__main__":
     print('less_than_sum: ', less_than_sum)
 
     # 只有test的样本路径
-    with open('dataset_static_mask.pkl', 'rb') as f:
-        static = pickle.load(f)
-        images_path, masks_path, masks_bool = static[0], static[1], static[2]
+    dataset_root = './datasets/SIIM_data'
+    images_path, masks_path, masks_bool = DatasetsStatic(dataset_root, 'test_images', 'test_mask', True).mask_static_bool_stage3()
     # 只有stage1的训练集的样本路径
-    with open('dataset_static_mask_stage1.pkl', 'rb') as f:
-        static_stage1 = pickle.load(f)
-        images_path_stage1, masks_path_stage1, masks_bool_stage1 = static_stage1[0], static_stage1[1], static_stage1[2]
+    images_path_stage1, masks_path_stage1, masks_bool_stage1 = DatasetsStatic(dataset_root, 'train_images', 'train_mask', True).mask_static_bool_stage3()
     
     skf = StratifiedKFold(n_splits=5, shuffle=True, random_state=1)
     split = skf.split(images_path, masks_bool)
@@ -0,0 +1,151 @@
+import re
+import inspect
+import torch
+from torch.utils.checkpoint import checkpoint
+
+
+# 可选的模式：decoder为解码模块以及network.py中的卷积块，encoder为编码器的各个stage，all为两者都包含
+CHECKPOINT_MODES = ['none', 'decoder', 'encoder', 'all']
+
+# 按类名匹配的解码模块，network.py中的conv_block、Recurrent_block编码和解码共用，也归到这一类；
+# segmentation_models_pytorch 0.4之后DecoderBlock、CenterBlock改名为UnetDecoderBlock、UnetCenterBlock
+DECODER_BLOCKS = {
+    'DecoderBlock', 'CenterBlock', 'UnetDecoderBlock', 'UnetCenterBlock',
+    'FirstOctaveDecoderBlock', 'OctaveDecoderBlock', 'LastOctaveDecoderBlock',
+    'Recurrent_block', 'conv_block', 'ASPP',
+}
+
+# 按属性名匹配的编码器stage：resnet/senet/deeplabv3+为layer1-4，densenet为denseblock1-4，linknet为encoder1-4。
+# 第一个卷积直接作用在输入图片上，输入不需要梯度，因此不包含在内
+ENCODER_STAGES = re.compile(r'^(layer[1-4]|denseblock[1-4]|encoder[1-4])$')
+
+_SUPPORT_NON_REENTRANT = 'use_reentrant' in inspect.signature(checkpoint).parameters
+_CHECKPOINT_CLASSES = dict()
+
+
+def checkpoint_forward(function, *args):
+    """以重计算的方式执行function，前向时不保存中间激活，反向时重新计算
+
+    解码模块的输入为[x, skip]这种list，较新的pytorch使用非重入的实现，可以直接处理；
+    旧版本只支持以tensor作为参数，因此先将list展开，在function内部再还原
+    """
+    if _SUPPORT_NON_REENTRANT:
+        return checkpoint(function, *args, use_reentrant=False)
+
+    lengths = [len(arg) if isinstance(arg, (list, tuple)) else None for arg in args]
+    flat_args = list()
+    for arg, length in zip(args, lengths):
+        flat_args.extend(arg if length is not None else [arg])
+
+    def run(*flat_args):
+        rebuilt, start = list(), 0
+        for length in lengths:
+            if length is None:
+                rebuilt.append(flat_args[start])
+                start += 1
+            else:
+                rebuilt.append(list(flat_args[start:start + length]))
+                start += length
+        return function(*rebuilt)
+    return checkpoint(run, *flat_args)
+
+
+def positional_args(function, args, kwargs):
+    """将关键字参数按function的签名转为位置参数，旧版本的checkpoint只接受位置参数
+    """
+    if not kwargs:
+        return args
+    bound = inspect.signature(function).bind(*args, **kwargs)
+    bound.apply_defaults()
+    return bound.args
+
+
+def freeze_norm_on_recompute(module, function):
+    """重计算时BN层会再执行一次前向，第二次调用function时将module中BN层的momentum置0，
+    并恢复num_batches_tracked，running_mean/running_var只在第一次前向中更新，与不重计算时一致
+
+    训练模式下BN的输出只取决于当前批次的统计量，与momentum无关，因此重计算的结果不变
+    """
+    calls = [0]
+
+    def run(*args):
+        calls[0] += 1
+        if calls[0] == 1:
+            return function(*args)
+        norms = [m for m in module.modules() if isinstance(m, torch.nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+        saved = [(m.momentum, m.num_batches_tracked.clone()) for m in norms]
+        for m in norms:
+            m.momentum = 0.
+        try:
+            return function(*args)
+        finally:
+            for m, (momentum, num_batches_tracked) in zip(norms, saved):
+                m.momentum = momentum
+                m.num_batches_tracked.copy_(num_batches_tracked)
+    return run
+
+
+def _checkpoint_class(cls):
+    """为cls生成一个只重写了forward的子类
+
+    直接替换模块的__class__而不是在外面再包一层，这样state_dict的键保持不变，已有的权重可以直接加载，
+    isinstance判断也不受影响，DataParallel复制模块时也会保留
+    """
+    if cls not in _CHECKPOINT_CLASSES:
+        def forward(self, *args, **kwargs):
+            if self.activation_checkpoint and self.training and torch.is_grad_enabled():
+                # 例如UnetDecoderBlock以关键字参数传入skip_connection
+                function = super(checkpoint_cls, self).forward
+                return checkpoint_forward(freeze_norm_on_recompute(self, function), *positional_args(function, args, kwargs))
+            return super(checkpoint_cls, self).forward(*args, **kwargs)
+        checkpoint_cls = type('Checkpoint' + cls.__name__, (cls,), {'forward': forward})
+        _CHECKPOINT_CLASSES[cls] = checkpoint_cls
+    return _CHECKPOINT_CLASSES[cls]
+
+
+def apply_activation_checkpoint(model, mode='none'):
+    """对模型中的编码器stage和解码模块使用激活重计算，以重计算换显存
+
+    重计算时BN层会再执行一次前向，由freeze_norm_on_recompute保证running_mean/running_var只更新一次
+
+    Args:
+        model: 待处理的模型，在DataParallel包装之前调用
+        mode: CHECKPOINT_MODES中的一种
+    Return:
+        names: 使用了重计算的模块名称
+    """
+    if mode not in CHECKPOINT_MODES:
+        raise ValueError('Unknown checkpoint_mode: {}'.format(mode))
+    names = list()
+    if mode == 'none':
+        return names
+
+    def match(name, module):
+        short_name = name.split('.')[-1]
+        if mode in ('decoder', 'all') and type(module).__name__ in DECODER_BLOCKS:
+            return True
+        if mode in ('encoder', 'all') and ENCODER_STAGES.match(short_name):
+            return True
+        return False
+
+    def visit(prefix, module):
+        for name, child in module.named_children():
+            full_name = prefix + name
+            if match(full_name, child):
+                child.__class__ = _checkpoint_class(type(child))
+                child.activation_checkpoint = True
+                names.append(full_name)
+            else:
+                # 已经重计算的模块内部不再嵌套重计算
+                visit(full_name + '.', child)
+
+    visit('', model)
+    return names
+
+
+def set_activation_checkpoint(model, enabled):
+    """打开或关闭已经处理过的模块的重计算，例如只在1024的阶段打开
+    """
+    for module in model.modules():
+        if type(module) in _CHECKPOINT_CLASSES.values():
+            module.activation_checkpoint = enabled
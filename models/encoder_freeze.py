@@ -0,0 +1,172 @@
+import hashlib
+import collections
+import torch
+
+
+_FREEZE_CLASSES = dict()
+# 输出步长小于SHALLOW_STRIDE的浅层特征(输入本身、1/2以及1/4分辨率)占了特征金字塔的大部分，而计算量只占编码器的一小部分，
+# 使用特征缓存时不保存，由缓存的输入图片重新计算
+SHALLOW_STRIDE = 8
+
+
+def supports_encoder_freeze(model):
+    """只有由encoder和decoder组成的模型(segmentation_models_pytorch、Transpose_unet、octave_unet)可以冻结编码器
+    """
+    return hasattr(model, 'encoder') and hasattr(model, 'decoder')
+
+
+def encode(model, images):
+    """
+    Return:
+        编码器输出的特征金字塔，list
+    """
+    return list(model.encoder(images))
+
+
+def shallow_stages(encoder):
+    """编码器从输入开始的前几个阶段，依次调用时各阶段的输出即为特征金字塔中分辨率最高的几层
+
+    segmentation_models_pytorch的编码器由get_stages给出；Transpose_unet、octave_unet的ResNetEncoder与torchvision的ResNet结构相同，
+    分别为conv1-bn1-relu以及maxpool-layer1；其它编码器返回空列表，特征全部缓存
+    """
+    if hasattr(encoder, 'get_stages'):
+        return list(encoder.get_stages())
+    if all(hasattr(encoder, name) for name in ('conv1', 'bn1', 'relu', 'maxpool', 'layer1')):
+        return [torch.nn.Sequential(encoder.conv1, encoder.bn1, encoder.relu), torch.nn.Sequential(encoder.maxpool, encoder.layer1)]
+    return []
+
+
+def shallow_features(model, images, count):
+    """依次运行编码器的前count个阶段
+
+    Return:
+        各阶段的输出，list
+    """
+    features, x = [], images
+    for stage in shallow_stages(model.encoder)[:count]:
+        x = stage(x)
+        features.append(x)
+    return features
+
+
+class CachedBatch(collections.namedtuple('CachedBatch', ['images', 'features', 'shallow_levels', 'mean', 'std'])):
+    """从特征缓存中读取的一个批次，作为模型的输入
+
+    images: uint8的灰度图 [N, 1, H, W]，用于重新计算浅层特征
+    features: 与编码器输出的特征金字塔等长，shallow_levels中的层为None
+    shallow_levels: 编码器前len(shallow_levels)个阶段的输出在特征金字塔中的位置
+    mean, std: 与数据集相同的归一化参数
+
+    各字段都是tensor或者python对象，DataParallel可以按批次切分
+    """
+    def to(self, device):
+        return self._replace(images=self.images.to(device), features=[None if feature is None else feature.to(device) for feature in self.features])
+
+    def normalized_images(self):
+        """与SIIMDataset.to_tensors相同的归一化，灰度图广播为三通道
+        """
+        mean = torch.tensor(self.mean, device=self.images.device).view(1, 3, 1, 1)
+        std = torch.tensor(self.std, device=self.images.device).view(1, 3, 1, 1)
+        return (self.images.float() / 255. - mean) / std
+
+
+def complete_features(model, batch):
+    """由缓存的深层特征以及重新计算的浅层特征得到完整的特征金字塔
+    """
+    images = batch.normalized_images()
+    features = list(batch.features)
+    if batch.shallow_levels:
+        with torch.no_grad():
+            for level, feature in zip(batch.shallow_levels, shallow_features(model, images, len(batch.shallow_levels))):
+                features[level] = feature
+    return features, images
+
+
+class FixedFeatures(torch.nn.Module):
+    """代替编码器，直接返回已经计算好的特征金字塔
+    """
+    def __init__(self, features):
+        super(FixedFeatures, self).__init__()
+        self.features = features
+
+    def forward(self, x):
+        return self.features
+
+
+def decode(model, features, forward, images=None):
+    """由特征金字塔得到输出：暂时将编码器替换为直接返回features的模块，再调用模型原来的forward，
+    解码器、分割头等的调用方式与各模型(各版本的segmentation_models_pytorch、Transpose_unet、octave_unet)自己的一致
+
+    Args:
+        forward: 模型原来的forward
+        images: 模型的输入；使用缓存的特征时为None，部分模型的forward会检查输入的尺寸，以尺寸最大的特征代替
+    """
+    if images is None:
+        images = max(features, key=lambda feature: feature.shape[-1])
+    encoder = model._modules['encoder']
+    model._modules['encoder'] = FixedFeatures(features)
+    try:
+        return forward(model, images)
+    finally:
+        model._modules['encoder'] = encoder
+
+
+def _freeze_class(cls):
+    """为cls生成一个只重写了forward的子类，与激活重计算相同，替换__class__，state_dict的键保持不变
+
+    forward的输入可以是图片，也可以是编码器特征(list)或者从特征缓存中读取的CachedBatch，此时直接进入解码器
+    """
+    if cls not in _FREEZE_CLASSES:
+        def forward(self, x):
+            # CachedBatch也是tuple，需要先判断
+            if isinstance(x, CachedBatch):
+                features, images = complete_features(self, x)
+                return decode(self, features, cls.forward, images)
+            if isinstance(x, (list, tuple)):
+                return decode(self, list(x), cls.forward)
+            if self.encoder_frozen:
+                with torch.no_grad():
+                    features = encode(self, x)
+                return decode(self, features, cls.forward, x)
+            return cls.forward(self, x)
+        _FREEZE_CLASSES[cls] = type('Freezable' + cls.__name__, (cls,), {'forward': forward})
+    return _FREEZE_CLASSES[cls]
+
+
+def apply_encoder_freeze(model):
+    """使模型支持冻结编码器，默认不冻结
+
+    Return:
+        模型是否支持冻结编码器
+    """
+    if not supports_encoder_freeze(model):
+        return False
+    if type(model) not in _FREEZE_CLASSES.values():
+        model.__class__ = _freeze_class(type(model))
+    model.encoder_frozen = False
+    return True
+
+
+def set_encoder_frozen(model, frozen):
+    """冻结或者解冻编码器：冻结时编码器参数不计算梯度，前向在no_grad下进行，BN使用已有的统计量
+
+    需要在model.train()之后调用，否则编码器的BN会被重新设为训练模式
+    """
+    if not hasattr(model, 'encoder_frozen'):
+        return
+    model.encoder_frozen = frozen
+    model.encoder.requires_grad_(not frozen)
+    if frozen:
+        model.encoder.eval()
+
+
+def encoder_fingerprint(model):
+    """编码器权重的指纹：state_dict中各个张量(包括BN的统计量)的名称、类型、形状以及内容的sha1，
+    权重有任何改变时缓存的特征都需要重新计算
+    """
+    sha1 = hashlib.sha1()
+    with torch.no_grad():
+        for name, tensor in model.encoder.state_dict().items():
+            sha1.update('{}|{}|{}'.format(name, tensor.dtype, list(tensor.shape)).encode('utf-8'))
+            sha1.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return sha1.hexdigest()
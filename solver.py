@@ -1,4 +1,6 @@
-import os, shutil
+import os
+import json
+import random
 import numpy as np
 import time
 import datetime
@@ -7,7 +9,18 @@ import torchvision
 from torch import optim
 from torch.autograd import Variable
 import torch.nn.functional as F
-from utils.mask_functions import write_txt
+from utils.eval_ledger import EvalLedger, LedgerRecorder, image_ids_of
+from utils.mixed_precision import autocast, grad_scaler
+from models.activation_checkpoint import apply_activation_checkpoint, set_activation_checkpoint
+from utils.checkpoint_writer import CheckpointWriter, apply_retention, snapshot_state
+from utils.async_validation import AsyncValidator, valid_samples
+from utils.distributed import get_device, wrap_model, is_distributed, is_main_process, get_rank, get_world_size, barrier, NullWriter
+from utils.telemetry import Telemetry, Throughput, format_seconds
+from utils.profiler import PhaseProfiler, format_report
+from utils.batch_augmentation import BatchAugmentation, DEVICE_AUGMENTATION, batch_seed
+from utils.torch_compile import compile_model
+from models.encoder_freeze import apply_encoder_freeze, set_encoder_frozen
+from datasets.feature_cache import FeatureCache
 from models.network import U_Net, R2U_Net, AttU_Net, R2AttU_Net
 from models.linknet import LinkNet34
 from models.deeplabv3.deeplabv3plus import DeepLabV3Plus
@@ -24,94 +37,352 @@ from models.Transpose_unet.unet.model import Unet as Unet_t
 from models.octave_unet.unet.model import OctaveUnet
 import pandas as pd
 
+
+def get_model(model_type, output_ch=1, t=3, pretrained=True):
+    """依据model_type构建模型
+
+    Args:
+        pretrained: 是否加载ImageNet预训练的编码器权重，之后马上加载自己的权重时(例如评估进程)不需要
+    """
+    encoder_weights = 'imagenet' if pretrained else None
+    if model_type == 'U_Net':
+        unet = U_Net(img_ch=3, output_ch=output_ch)
+    elif model_type == 'R2U_Net':
+        unet = R2U_Net(img_ch=3, output_ch=output_ch, t=t)
+    elif model_type == 'AttU_Net':
+        unet = AttU_Net(img_ch=3, output_ch=output_ch)
+    elif model_type == 'R2AttU_Net':
+        unet = R2AttU_Net(img_ch=3, output_ch=output_ch, t=t)
+
+    elif model_type == 'unet_resnet34':
+        # unet = Unet(backbone_name='resnet34', pretrained=True, classes=output_ch)
+        unet = smp.Unet('resnet34', encoder_weights=encoder_weights, activation=None)
+    elif model_type == 'unet_resnet50':
+        unet = smp.Unet('resnet50', encoder_weights=encoder_weights, activation=None)
+    elif model_type == 'unet_se_resnext50_32x4d':
+        unet = smp.Unet('se_resnext50_32x4d', encoder_weights=encoder_weights, activation=None)
+    elif model_type == 'unet_densenet121':
+        unet = smp.Unet('densenet121', encoder_weights=encoder_weights, activation=None)
+    elif model_type == 'unet_resnet34_t':
+        unet = Unet_t('resnet34', encoder_weights=encoder_weights, activation=None, use_ConvTranspose2d=True)
+    elif model_type == 'unet_resnet34_oct':
+        unet = OctaveUnet('resnet34', encoder_weights=encoder_weights, activation=None)
+
+    elif model_type == 'linknet':
+        unet = LinkNet34(num_classes=output_ch, pretrained=pretrained)
+    elif model_type == 'deeplabv3plus':
+        unet = DeepLabV3Plus(model_backbone='res50_atrous', num_classes=output_ch)
+    elif model_type == 'pspnet_resnet34':
+        unet = smp.PSPNet('resnet34', encoder_weights=encoder_weights, classes=1, activation=None)
+    else:
+        raise ValueError('Unknown model_type: {}'.format(model_type))
+    return unet
+
+
+def numpy_rng_state():
+    """numpy的随机状态，其中的数组转为tensor，这样torch.load(weights_only=True)也可以读取
+    """
+    name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    return [name, torch.from_numpy(keys.astype(np.int64)), position, has_gauss, cached_gaussian]
+
+
+def set_numpy_rng_state(state):
+    name, keys, position, has_gauss, cached_gaussian = state
+    np.random.set_state((name, keys.cpu().numpy().astype(np.uint32), position, has_gauss, cached_gaussian))
+
+
+def dice_overall(preds, targs):
+    """每一张图片的dice，预测和真实均为空时为1
+    """
+    n = preds.shape[0]  # batch size为多少
+    preds = preds.view(n, -1)
+    targs = targs.view(n, -1)
+    preds, targs = preds.cpu(), targs.cpu()
+
+    # tensor之间按位相成，求两个集合的交(只有1×1等于1)后。按照第二个维度求和，得到[batch size]大小的tensor，每一个值代表该输入图片真实类标与预测类标的交集大小
+    intersect = (preds * targs).sum(-1).float()
+    # tensor之间按位相加，求两个集合的并。然后按照第二个维度求和，得到[batch size]大小的tensor，每一个值代表该输入图片真实类标与预测类标的并集大小
+    union = (preds + targs).sum(-1).float()
+    '''
+    输入图片真实类标与预测类标无并集有两种情况：第一种为预测与真实均没有类标，此时并集之和为0；第二种为真实有类标，但是预测完全错误，此时并集之和不为0;
+
+    寻找输入图片真实类标与预测类标并集之和为0的情况，将其交集置为1，并集置为2，最后还有一个2*交集/并集，值为1；
+    其余情况，直接按照2*交集/并集计算，因为上面的并集并没有减去交集，所以需要拿2*交集，其最大值为1
+    '''
+    u0 = union == 0
+    intersect[u0] = 1
+    union[u0] = 2
+    
+    return (2. * intersect / union)
+
+
+def evaluate(net, valid_loader, criterion, device, amp=False, recorder=None, image_ids=None, progress=True):
+    """在验证集上计算平均损失和dice(阈值0.5)，训练过程中的验证和异步验证进程共用
+
+    Args:
+        net: 处于eval模式的模型
+        recorder: 若不为None，逐图片的结果写入账本，此时需要给出验证集各样本的image_ids
+        progress: 是否显示进度条
+    Return:
+        loss_mean, dice_mean
+    """
+    tbar = tqdm.tqdm(valid_loader, disable=not progress)
+    loss_sum, dice_sum = 0, 0
+    with torch.no_grad():
+        for i, (images, masks) in enumerate(tbar):
+            images = images.to(device)
+            masks = masks.to(device)
+
+            with autocast(device, enabled=amp):
+                net_output = net(images)
+            net_output_flat = net_output.view(net_output.size(0), -1).float()
+            masks_flat = masks.view(masks.size(0), -1)
+
+            loss_set = criterion(net_output_flat, masks_flat)
+            try:
+                loss_num = len(loss_set)
+            except:
+                loss_num = 1
+
+            # 依据返回的损失个数分情况处理
+            if loss_num > 1:
+                loss = loss_set[0]
+            else:
+                loss = loss_set
+            loss_sum += loss.item()
+
+            # 计算dice系数，预测出的矩阵要经过sigmoid含义以及阈值，阈值默认为0.5
+            net_output_flat_sign = (torch.sigmoid(net_output_flat)>0.5).float()
+            dice = dice_overall(net_output_flat_sign, masks_flat).mean()
+            dice_sum += dice.item()
+            if recorder is not None:
+                batch_start = i * valid_loader.batch_size
+                recorder.add_batch(image_ids[batch_start:batch_start+images.size(0)], torch.sigmoid(net_output_flat), masks_flat)
+
+            descript = "Val Loss: {:.7f}, dice: {:.7f}".format(loss.item(), dice.item())
+            tbar.set_description(desc=descript)
+
+    if recorder is not None:
+        recorder.close()
+    loss_mean, dice_mean = loss_sum/len(tbar), dice_sum/len(tbar)
+    print("Val Loss: {:.7f}, dice: {:.7f}".format(loss_mean, dice_mean))
+    return loss_mean, dice_mean
+
+
+# 各训练模式需要训练的阶段
+TRAIN_MODE_STAGES = {
+    'train': [1, 2, 3],
+    'train_stage1': [1],
+    'train_stage2': [2],
+    'train_stage3': [3],
+    'train_stage23': [2, 3],
+}
+
+# 训练计划中可以使用的损失函数
+LOSSES = {
+    'soft_bce_dice': lambda: SoftBCEDiceLoss(weight=[0.25, 0.75]),
+    'bce_dice': lambda: BCEDiceLoss(),
+    'soft_bce': lambda: SoftBceLoss(weight=[0.25, 0.75]),
+    'lovasz': lambda: LovaszLoss(),
+    # 每张图片只排序最大的65536个hinge，1024的阶段也可以使用
+    'lovasz_topk': lambda: LovaszLoss(top_k=1 << 16),
+}
+
+
+def get_stage_schedule(config):
+    """依据配置生成各阶段的训练计划，每一个阶段由一个dict描述：
+        stage: 第几阶段，权重以 model_type_stage_fold.pth 命名
+        image_size, batch_size, epoch, lr, weight_decay: 图片尺寸，batch size，epoch数，初始学习率，权重衰减
+        loss: 损失函数，为LOSSES中的键
+        sample_filter: all表示使用全部样本，mask表示只使用有掩膜的样本
+        augmentation_flag: 训练集是否使用数据增强
+        augmentation: 数据增强方法，为utils.data_augmentation.PIPELINES中的键，缺省时为default；
+            为device时worker只读取uint8的样本，在训练设备上批量增强
+        epoch_accumulation, accumulation_steps: 最后多少个epoch进行梯度累加，以及累加的步数
+        epoch_freeze: 前多少个epoch冻结编码器
+        annealing_epoch_extra: 余弦退火的周期比该阶段的epoch数多出的epoch数
+        threshold_search: 选阈值时使用线性搜索(linear)还是网格搜索(grid)
+        activation_checkpoint: 是否打开激活重计算(需要checkpoint_mode不为none)，默认只在1024的阶段打开
+
+    若config.stage_schedule不为空，则直接从该json文件中读取训练计划
+    """
+    if getattr(config, 'stage_schedule', ''):
+        with open(config.stage_schedule, 'r', encoding='utf-8') as json_file:
+            return json.load(json_file)
+
+    return [
+        {'stage': 1, 'image_size': config.image_size_stage1, 'batch_size': config.batch_size_stage1, 'epoch': config.epoch_stage1,
+         'lr': config.lr, 'weight_decay': config.weight_decay, 'loss': 'soft_bce_dice', 'sample_filter': 'all',
+         'augmentation_flag': config.stage1_augmentation_flag, 'augmentation': getattr(config, 'stage1_augmentation', 'default'),
+         'epoch_accumulation': 0, 'accumulation_steps': config.accumulation_steps,
+         'epoch_freeze': config.epoch_stage1_freeze, 'annealing_epoch_extra': 10, 'threshold_search': 'linear',
+         'activation_checkpoint': False},
+        {'stage': 2, 'image_size': config.image_size_stage2, 'batch_size': config.batch_size_stage2, 'epoch': config.epoch_stage2,
+         'lr': config.lr_stage2, 'weight_decay': config.weight_decay, 'loss': 'soft_bce_dice', 'sample_filter': 'all',
+         'augmentation_flag': config.stage2_augmentation_flag, 'augmentation': getattr(config, 'stage2_augmentation', 'default'),
+         'epoch_accumulation': config.epoch_stage2_accumulation, 'accumulation_steps': config.accumulation_steps,
+         'epoch_freeze': 0, 'annealing_epoch_extra': 5, 'threshold_search': 'grid',
+         'activation_checkpoint': True},
+        # 第三阶段和第二阶段使用的图片大小一致，最大batch_size一致
+        {'stage': 3, 'image_size': config.image_size_stage2, 'batch_size': config.batch_size_stage2, 'epoch': config.epoch_stage3,
+         'lr': config.lr_stage3, 'weight_decay': config.weight_decay, 'loss': 'soft_bce_dice', 'sample_filter': 'mask',
+         'augmentation_flag': config.stage3_augmentation_flag, 'augmentation': getattr(config, 'stage3_augmentation', 'default'),
+         'epoch_accumulation': config.epoch_stage3_accumulation, 'accumulation_steps': config.accumulation_steps,
+         'epoch_freeze': 0, 'annealing_epoch_extra': 5, 'threshold_search': 'linear',
+         'activation_checkpoint': True},
+    ]
+
+
 class Train(object):
-    def __init__(self, config, train_loader, valid_loader):
+    def __init__(self, config, train_loader=None, valid_loader=None, schedule=None):
         # Data loader
         self.train_loader = train_loader
         self.valid_loader = valid_loader
 
+        # 训练计划
+        self.schedule = schedule or get_stage_schedule(config)
+
         # Models
         self.unet = None
         self.optimizer = None
         self.img_ch = config.img_ch
         self.output_ch = config.output_ch
-        self.criterion = SoftBCEDiceLoss(weight=[0.25, 0.75])
-        # self.criterion = torch.nn.BCEWithLogitsLoss(pos_weight=torch.tensor(50))
-        self.criterion_stage2 = SoftBCEDiceLoss(weight=[0.25, 0.75])
-        self.criterion_stage3 = SoftBCEDiceLoss(weight=[0.25, 0.75])
+        # 每一个阶段使用的损失函数
+        self.criterions = {stage_config['stage']: LOSSES[stage_config['loss']]() for stage_config in self.schedule}
         self.model_type = config.model_type
         self.t = config.t
+        # 激活重计算的模式，以及实际使用了重计算的模块
+        self.checkpoint_mode = config.checkpoint_mode
+        # torch.compile的模式，为空时不编译
+        self.compile_mode = config.compile_mode if config.compile else ''
+        self.compile_cache = os.path.join(config.model_path, 'compile_cache')
+        # 编码器特征缓存的目录，为空时不缓存，以及缓存最多占用的磁盘空间
+        self.feature_cache = config.feature_cache
+        self.feature_cache_max_gb = config.feature_cache_max_gb
 
         self.mode = config.mode
         self.resume = config.resume
+        self.config_resume = config.resume
 
         # Hyper-parameters
         self.lr = config.lr
-        self.lr_stage2 = config.lr_stage2
-        self.lr_stage3 = config.lr_stage3
         self.start_epoch, self.max_dice = 0, 0
-        self.weight_decay = config.weight_decay
-        self.weight_decay_stage2 = config.weight_decay
-        self.weight_decay_stage3 = config.weight_decay
 
         # save set
         self.save_path = config.save_path
-        if 'choose_threshold' not in self.mode:
-            TIMESTAMP = "{0:%Y-%m-%dT%H-%M-%S}".format(datetime.datetime.now())
-            self.writer = SummaryWriter(log_dir=self.save_path+'/'+TIMESTAMP)
-
-        # 配置参数
-        self.epoch_stage1 = config.epoch_stage1
-        self.epoch_stage1_freeze = config.epoch_stage1_freeze
-        self.epoch_stage2 = config.epoch_stage2
-        self.epoch_stage2_accumulation = config.epoch_stage2_accumulation
-        self.accumulation_steps = config.accumulation_steps
-        self.epoch_stage3 = config.epoch_stage3
-        self.epoch_stage3_accumulation = config.epoch_stage3_accumulation
-
-        # 模型初始化
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.writer = None
+        # 缓冲的日志：标量和文本由后台线程定期写入TensorBoard、telemetry.jsonl和log.txt，只有主进程记录
+        self.telemetry = Telemetry(self.save_path, config.telemetry_flush_interval, enabled=is_main_process())
+        self.throughput = Throughput(get_world_size())
+        # 每隔多少步同步一次损失并更新进度条
+        self.log_interval = config.log_interval
+        # 逐图片的评估结果账本
+        self.ledger = EvalLedger(os.path.join(self.save_path, 'ledger'))
+        # 后台保存权重，以及最多保留多少个(阶段, 折)最后一个epoch的权重，0表示全部保留
+        self.checkpoint_writer = CheckpointWriter()
+        self.keep_last_units = config.keep_last_units
+        # 本次运行训练过的(阶段, 折)，按照训练的先后顺序，保留规则只删除其中较早的权重
+        self.trained_units = list()
+        # 每隔多少步保存一次epoch中间的权重，0表示只在epoch结束时保存
+        self.step_checkpoint_interval = config.step_checkpoint_interval
+        # 异步验证：每一个epoch的权重交给单独的进程(config.async_validation指定的设备)验证，训练不等待验证结果
+        self.async_validator = None
+        if config.async_validation and is_main_process():
+            self.async_validator = AsyncValidator(self.model_type, self.output_ch, self.t, self.ledger.ledger_root,
+                                                  config.async_validation, config.amp, config.async_validation_threads)
+
+        # 模型初始化，分布式模式下每一个进程使用一张卡
+        self.device = get_device()
+        # 逐步统计训练循环各阶段的耗时，默认关闭
+        self.profiler = PhaseProfiler(self.save_path, self.device, config.profile, config.profile_trace_start,
+                                      config.profile_trace_steps if is_main_process() else 0)
         self.build_model()
+        # 保存初始权重，开始新的一折时直接恢复，不需要重新构建模型、加载预训练权重
+        self.initial_state = {k: v.detach().cpu().clone() for k, v in self.unet.module.state_dict().items()}
+
+        # 混合精度：前向和损失在autocast下计算，GPU上使用GradScaler防止float16梯度下溢
+        self.amp = config.amp
+        self.scaler = grad_scaler(self.device, enabled=self.amp)
+        # augmentation为device的阶段在训练设备上批量地进行数据增强
+        self.batch_augmentation = BatchAugmentation()
 
     def build_model(self):
         print("Using model: {}".format(self.model_type))
         """Build generator and discriminator."""
-        if self.model_type == 'U_Net':
-            self.unet = U_Net(img_ch=3, output_ch=self.output_ch)
-        elif self.model_type == 'R2U_Net':
-            self.unet = R2U_Net(img_ch=3, output_ch=self.output_ch, t=self.t)
-        elif self.model_type == 'AttU_Net':
-            self.unet = AttU_Net(img_ch=3, output_ch=self.output_ch)
-        elif self.model_type == 'R2AttU_Net':
-            self.unet = R2AttU_Net(img_ch=3, output_ch=self.output_ch, t=self.t)
-
-        elif self.model_type == 'unet_resnet34':
-            # self.unet = Unet(backbone_name='resnet34', pretrained=True, classes=self.output_ch)
-            self.unet = smp.Unet('resnet34', encoder_weights='imagenet', activation=None)
-        elif self.model_type == 'unet_resnet50':
-            self.unet = smp.Unet('resnet50', encoder_weights='imagenet', activation=None)
-        elif self.model_type == 'unet_se_resnext50_32x4d':
-            self.unet = smp.Unet('se_resnext50_32x4d', encoder_weights='imagenet', activation=None)
-        elif self.model_type == 'unet_densenet121':
-            self.unet = smp.Unet('densenet121', encoder_weights='imagenet', activation=None)
-        elif self.model_type == 'unet_resnet34_t':
-            self.unet = Unet_t('resnet34', encoder_weights='imagenet', activation=None, use_ConvTranspose2d=True)
-        elif self.model_type == 'unet_resnet34_oct':
-            self.unet = OctaveUnet('resnet34', encoder_weights='imagenet', activation=None)
-        
-        elif self.model_type == 'linknet':
-            self.unet = LinkNet34(num_classes=self.output_ch)
-        elif self.model_type == 'deeplabv3plus':
-            self.unet = DeepLabV3Plus(model_backbone='res50_atrous', num_classes=self.output_ch)
-        elif self.model_type == 'pspnet_resnet34':
-            self.unet = smp.PSPNet('resnet34', encoder_weights='imagenet', classes=1, activation=None)
-
-        if torch.cuda.is_available():
-            self.unet = torch.nn.DataParallel(self.unet)
-            self.criterion = self.criterion.cuda()
-            self.criterion_stage2 = self.criterion_stage2.cuda()
-            self.criterion_stage3 = self.criterion_stage3.cuda()
-        self.unet.to(self.device)
+        self.unet = get_model(self.model_type, self.output_ch, self.t)
+        self.checkpoint_modules = apply_activation_checkpoint(self.unet, self.checkpoint_mode)
+        if self.checkpoint_modules:
+            print('Activation checkpointing ({}) on {} modules'.format(self.checkpoint_mode, len(self.checkpoint_modules)))
+        # 训练计划中有冻结编码器的epoch时，模型需要支持冻结编码器
+        freeze = any(stage_config.get('epoch_freeze', 0) > 0 for stage_config in self.schedule)
+        self.encoder_freeze = freeze and apply_encoder_freeze(self.unet)
+        if freeze and not self.encoder_freeze:
+            print('{} has no encoder/decoder, epoch_freeze is ignored.'.format(self.model_type))
+
+        # 编译时按模型所在的设备记录状态、选择后端，先移动到训练设备；DataParallel在多张卡上会复制模型，替换过的forward无法随之复制，此时不编译
+        self.unet = self.unet.to(self.device)
+        if self.compile_mode and not is_distributed() and torch.cuda.device_count() > 1:
+            print('torch.compile is not supported with DataParallel on multiple gpus, use torchrun or a single gpu.')
+        else:
+            compile_model(self.unet, self.model_type, self.compile_mode, self.device, self.compile_cache)
+
+        # 分布式模式下使用DistributedDataParallel，否则使用DataParallel，两者均可以通过self.unet.module得到原始模型
+        # 冻结编码器时其参数没有梯度，DistributedDataParallel需要find_unused_parameters
+        self.unet = wrap_model(self.unet, self.device, find_unused_parameters=self.encoder_freeze)
+        for stage in self.criterions:
+            self.criterions[stage] = self.criterions[stage].to(self.device)
+
+    def open_writer(self):
+        """每一折使用一个单独的TensorBoard日志目录，分布式模式下只有主进程写日志
+        """
+        if not is_main_process():
+            self.writer = NullWriter()
+            return
+        TIMESTAMP = "{0:%Y-%m-%dT%H-%M-%S}".format(datetime.datetime.now())
+        self.writer = SummaryWriter(log_dir=self.save_path+'/'+TIMESTAMP)
+        self.telemetry.set_writer(self.writer)
+
+    def reset_fold(self, index):
+        """开始新的一折之前调用：恢复初始权重以及resume等状态，模型、损失函数等均不需要重新构建
+
+        Args:
+            index: 即将开始的是第几个fold
+        """
+        self.unet.module.load_state_dict(self.initial_state)
+        self.resume = self.config_resume
+        self.start_epoch, self.max_dice = 0, 0
+        self.optimizer = None
+        if self.writer is not None:
+            self.telemetry.set_writer(None)
+            self.writer.close()
+            self.writer = None
+        self.telemetry.set_fold(index)
+
+    def close(self):
+        """训练结束时调用：写完缓冲的日志，结束异步验证的进程
+        """
+        if self.async_validator is not None:
+            self.async_validator.close()
+        self.telemetry.close()
+
+    def stage_config(self, stage):
+        """训练计划中第stage阶段的配置
+        """
+        for stage_config in self.schedule:
+            if stage_config['stage'] == stage:
+                return stage_config
+        raise ValueError('Stage {} is not in the schedule'.format(stage))
+
+    def resume_stage(self):
+        """依据resume的权重名(model_type_stage_fold.pth)得到其所属的阶段
+        """
+        if not self.resume:
+            return None
+        name = os.path.basename(self.resume)
+        # model_type本身可能包含下划线，优先去掉model_type前缀再解析
+        if name.startswith(self.model_type + '_'):
+            return int(name[len(self.model_type) + 1:].split('_')[0])
+        return int(name.split('_')[2])
 
     def print_network(self, model, name):
         """Print out the network information."""
@@ -127,19 +398,25 @@ class Train(object):
         self.unet.zero_grad()
 
     def save_checkpoint(self, state, stage, index, is_best): 
-        # 保存权重，每一epoch均保存一次，若为最优，则复制到最优权重；index可以区分不同的交叉验证 
+        # 保存权重，每一epoch均保存一次，若为最优，则硬链接到最优权重；index可以区分不同的交叉验证 
+        # 权重先拷贝到CPU，再由后台线程写入临时文件后重命名，训练不需要等待写盘
         pth_path = os.path.join(self.save_path, '%s_%d_%d.pth' % (self.model_type, stage, index))
-        torch.save(state, pth_path)
+        best_path = None
         if is_best:
             print('Saving Best Model.')
-            write_txt(self.save_path, 'Saving Best Model.')
-            shutil.copyfile(os.path.join(self.save_path, '%s_%d_%d.pth' % (self.model_type, stage, index)), os.path.join(self.save_path, '%s_%d_%d_best.pth' % (self.model_type, stage, index)))
+            self.telemetry.log('Saving Best Model.')
+            best_path = os.path.join(self.save_path, '%s_%d_%d_best.pth' % (self.model_type, stage, index))
+        with self.profiler.phase('checkpoint'):
+            self.checkpoint_writer.save(state, pth_path, best_path)
 
     def load_checkpoint(self, load_optimizer=True):
         # Load the pretrained Encoder
+        # 要加载的权重可能还在等待验证结果或者在后台写入
+        self.drain_validation()
+        self.checkpoint_writer.flush()
         weight_path = os.path.join(self.save_path, self.resume)
         if os.path.isfile(weight_path):
-            checkpoint = torch.load(weight_path)
+            checkpoint = torch.load(weight_path, map_location=self.device)
             # 加载模型的参数，学习率，优化器，开始的epoch，最小误差等
             if torch.cuda.is_available:
                 self.unet.module.load_state_dict(checkpoint['state_dict'])
@@ -150,242 +427,87 @@ class Train(object):
             if load_optimizer:
                 self.lr = checkpoint['lr']
                 self.optimizer.load_state_dict(checkpoint['optimizer'])
+                # 未开启混合精度时保存的scaler状态为空字典，不需要加载
+                if checkpoint.get('scaler') and self.scaler.is_enabled():
+                    self.scaler.load_state_dict(checkpoint['scaler'])
 
             print('%s is Successfully Loaded from %s' % (self.model_type, weight_path))
-            write_txt(self.save_path, '%s is Successfully Loaded from %s' % (self.model_type, weight_path))
+            self.telemetry.log('%s is Successfully Loaded from %s' % (self.model_type, weight_path))
+            return checkpoint
         else:
             raise FileNotFoundError("Can not find weight file in {}".format(weight_path))
 
-    def train(self, index):
-        # self.optimizer = optim.Adam([{'params': self.unet.decoder.parameters(), 'lr': 1e-4}, {'params': self.unet.encoder.parameters(), 'lr': 1e-6},])
-        self.optimizer = optim.Adam(self.unet.module.parameters(), self.lr, weight_decay=self.weight_decay)
-
-        # 若训练到一半暂停了，则需要加载之前训练的参数，并加载之前学习率 TODO:resume学习率没有接上，所以resume暂时无法使用
-        if self.resume:
-            self.load_checkpoint(load_optimizer=True)
-            '''
-            CosineAnnealingLR：若存在['initial_lr']，则从initial_lr开始衰减；
-            若不存在，则执行CosineAnnealingLR会在optimizer.param_groups中添加initial_lr键值，其值等于lr
-
-            重置初始学习率，在load_checkpoint中会加载优化器，但其中的initial_lr还是之前的，所以需要覆盖为self.lr，让其从self.lr衰减
-            '''
-            self.optimizer.param_groups[0]['initial_lr'] = self.lr
-            
-        stage1_epoches = self.epoch_stage1 - self.start_epoch
-        lr_scheduler = optim.lr_scheduler.CosineAnnealingLR(self.optimizer, stage1_epoches+10)
-        # 防止训练到一半暂停重新训练，日志被覆盖
-        global_step_before = self.start_epoch*len(self.train_loader)
-
-        for epoch in range(self.start_epoch, self.epoch_stage1):
-            epoch += 1
-            self.unet.train(True)
-            
-            # 学习率重启
-            # if epoch == 30:
-            #     self.optimizer.param_groups[0]['initial_lr'] = 0.0001
-            #     lr_scheduler = optim.lr_scheduler.CosineAnnealingLR(self.optimizer, 25)
-
-            epoch_loss = 0
-            tbar = tqdm.tqdm(self.train_loader)
-            for i, (images, masks) in enumerate(tbar):
-                # GT : Ground Truth
-                images = images.to(self.device)
-                masks = masks.to(self.device)
-
-                # SR : Segmentation Result
-                net_output = self.unet(images)
-                net_output_flat = net_output.view(net_output.size(0), -1)
-                masks_flat = masks.view(masks.size(0), -1)
-                loss_set = self.criterion(net_output_flat, masks_flat)
-                
-                try:
-                    loss_num = len(loss_set)
-                except:
-                    loss_num = 1
-                # 依据返回的损失个数分情况处理
-                if loss_num > 1:
-                    for loss_index, loss_item in enumerate(loss_set):
-                        if loss_index > 0:
-                            loss_name = 'stage1_loss_%d' % loss_index
-                            self.writer.add_scalar(loss_name, loss_item.item(), global_step_before + i)
-                    loss = loss_set[0]
-                else:
-                    loss = loss_set
-                epoch_loss += loss.item()
-
-                # Backprop + optimize
-                self.reset_grad()
-                loss.backward()
-                self.optimizer.step()
-                
-                params_groups_lr = str()
-                for group_ind, param_group in enumerate(self.optimizer.param_groups):
-                    params_groups_lr = params_groups_lr + 'params_group_%d' % (group_ind) + ': %.12f, ' % (param_group['lr'])
-
-                # 保存到tensorboard，每一步存储一个
-                self.writer.add_scalar('Stage1_train_loss', loss.item(), global_step_before+i)
-
-                descript = "Train Loss: %.7f, lr: %s" % (loss.item(), params_groups_lr)
-                tbar.set_description(desc=descript)
-            # 更新global_step_before为下次迭代做准备
-            global_step_before += len(tbar)
-
-            # Print the log info
-            print('Finish Stage1 Epoch [%d/%d], Average Loss: %.7f' % (epoch, self.epoch_stage1, epoch_loss/len(tbar)))
-            write_txt(self.save_path, 'Finish Stage1 Epoch [%d/%d], Average Loss: %.7f' % (epoch, self.epoch_stage1, epoch_loss/len(tbar)))
+    def step_checkpoint_path(self, stage, index):
+        return os.path.join(self.save_path, '%s_%d_%d_step.pth' % (self.model_type, stage, index))
 
-            # 验证模型，保存权重，并保存日志
-            loss_mean, dice_mean = self.validation(stage=1)
-            if dice_mean > self.max_dice: 
-                is_best = True
-                self.max_dice = dice_mean
-            else: is_best = False
-            
-            self.lr = lr_scheduler.get_lr()
-            state = {'epoch': epoch,
-                'state_dict': self.unet.module.state_dict(),
-                'max_dice': self.max_dice,
-                'optimizer' : self.optimizer.state_dict(),
-                'lr' : self.lr}
-            
-            self.save_checkpoint(state, 1, index, is_best)
+    def save_step_checkpoint(self, stage, index, epoch, step, global_step, epoch_loss, lr_scheduler, train_loader):
+        """epoch中间保存的权重，包含从下一个批次继续训练所需的全部状态：
+        模型、优化器、scaler、学习率策略、采样器本轮的顺序和增强种子(worker中的随机状态由其决定)、主进程的随机状态以及TensorBoard的global step
 
-            self.writer.add_scalar('Stage1_val_loss', loss_mean, epoch)
-            self.writer.add_scalar('Stage1_val_dice', dice_mean, epoch)
-            self.writer.add_scalar('Stage1_lr', self.lr[0], epoch)
+        Args:
+            epoch: 当前正在训练的epoch(从1开始)
+            step: 当前epoch已经完成的批次数
+            global_step: 下一个批次的global step
+        """
+        # 之前的epoch还在异步验证时max_dice可能偏小，先合并全部结果；从该权重继续训练时之前的epoch不会再验证
+        self.drain_validation()
+        state = {'epoch': epoch - 1,
+            'step': step,
+            'state_dict': self.unet.module.state_dict(),
+            'max_dice': self.max_dice,
+            'optimizer': self.optimizer.state_dict(),
+            'scaler': self.scaler.state_dict(),
+            'lr_scheduler': lr_scheduler.state_dict(),
+            'lr': lr_scheduler.get_last_lr(),
+            'global_step': global_step,
+            'epoch_loss': float(epoch_loss),
+            'sampler': train_loader.batch_sampler.state_dict(),
+            'rng': {'random': random.getstate(), 'numpy': numpy_rng_state(), 'torch': torch.get_rng_state(),
+                    'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}}
+        self.checkpoint_writer.save(state, self.step_checkpoint_path(stage, index))
+
+    def restore_step_state(self, checkpoint, train_loader):
+        """恢复epoch中间保存的采样器状态以及随机状态，下一轮遍历从保存时的下一个批次开始
+        """
+        train_loader.batch_sampler.load_state_dict(checkpoint['sampler'], checkpoint['step'])
+        rng = checkpoint['rng']
+        random.setstate(rng['random'])
+        set_numpy_rng_state(rng['numpy'])
+        torch.set_rng_state(rng['torch'].cpu())
+        if rng['cuda'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all([state.cpu() for state in rng['cuda']])
 
-            # 学习率衰减
-            lr_scheduler.step()
+    def train(self, index):
+        self.train_stage(self.stage_config(1), index)
 
     def train_stage2(self, index):
-        # # 冻结BN层， see https://zhuanlan.zhihu.com/p/65439075 and https://www.kaggle.com/c/siim-acr-pneumothorax-segmentation/discussion/100736591271 for more information
-        # def set_bn_eval(m):
-        #     classname = m.__class__.__name__
-        #     if classname.find('BatchNorm') != -1:
-        #         m.eval()
-        # self.unet.apply(set_bn_eval)
-
-        # self.optimizer = optim.Adam([{'params': self.unet.decoder.parameters(), 'lr': 1e-5}, {'params': self.unet.encoder.parameters(), 'lr': 1e-7},])
-        self.optimizer = optim.Adam(self.unet.module.parameters(), self.lr_stage2, weight_decay=self.weight_decay_stage2)
-
-        # 加载的resume分为两种情况：之前没有训练第二个阶段，现在要加载第一个阶段的参数；第二个阶段训练了一半要继续训练
-        if self.resume:
-            # 若第二个阶段训练一半，要重新加载 TODO
-            if self.resume.split('_')[2] == '2':
-                self.load_checkpoint(load_optimizer=True) # 当load_optimizer为True会重新加载学习率和优化器
-                '''
-                CosineAnnealingLR：若存在['initial_lr']，则从initial_lr开始衰减；
-                若不存在，则执行CosineAnnealingLR会在optimizer.param_groups中添加initial_lr键值，其值等于lr
-
-                重置初始学习率，在load_checkpoint中会加载优化器，但其中的initial_lr还是之前的，所以需要覆盖为self.lr，让其从self.lr衰减
-                '''
-                self.optimizer.param_groups[0]['initial_lr'] = self.lr
-
-            # 若第一阶段结束后没有直接进行第二个阶段，中间暂停了
-            elif self.resume.split('_')[2] == '1':
-                self.load_checkpoint(load_optimizer=False)
-                self.start_epoch = 0
-                self.max_dice = 0
+        self.train_stage(self.stage_config(2), index)
 
-        # 第一阶段结束后直接进行第二个阶段，中间并没有暂停
-        else:
-            self.start_epoch = 0
-            self.max_dice = 0
-
-        # 防止训练到一半暂停重新训练，日志被覆盖
-        global_step_before = self.start_epoch*len(self.train_loader)
-
-        stage2_epoches = self.epoch_stage2 - self.start_epoch
-        lr_scheduler = optim.lr_scheduler.CosineAnnealingLR(self.optimizer, stage2_epoches+5)
-
-        for epoch in range(self.start_epoch, self.epoch_stage2):
-            epoch += 1
-            self.unet.train(True)
-            epoch_loss = 0
-
-            self.reset_grad() # 梯度累加的时候需要使用
-            
-            tbar = tqdm.tqdm(self.train_loader)
-            for i, (images, masks) in enumerate(tbar):
-                # GT : Ground Truth
-                images = images.to(self.device)
-                masks = masks.to(self.device)
-                assert images.size(2) == 1024
-
-                # SR : Segmentation Result
-                net_output = self.unet(images)
-                net_output_flat = net_output.view(net_output.size(0), -1)
-                masks_flat = masks.view(masks.size(0), -1)
-                loss_set = self.criterion_stage2(net_output_flat, masks_flat)
-
-                try:
-                    loss_num = len(loss_set)
-                except:
-                    loss_num = 1
-                # 依据返回的损失个数分情况处理
-                if loss_num > 1:
-                    for loss_index, loss_item in enumerate(loss_set):
-                        if loss_index > 0:
-                            loss_name = 'stage2_loss_%d' % loss_index
-                            self.writer.add_scalar(loss_name, loss_item.item(), global_step_before + i)
-                    loss = loss_set[0]
-                else:
-                    loss = loss_set
-                epoch_loss += loss.item()
-
-                # Backprop + optimize, see https://discuss.pytorch.org/t/why-do-we-need-to-set-the-gradients-manually-to-zero-in-pytorch/4903/20 for Accumulating Gradients
-                if epoch <= self.epoch_stage2 - self.epoch_stage2_accumulation:
-                    self.reset_grad()
-                    loss.backward()
-                    self.optimizer.step()
-                else:
-                    # loss = loss / self.accumulation_steps                # Normalize our loss (if averaged)
-                    loss.backward()                                      # Backward pass
-                    if (i+1) % self.accumulation_steps == 0:             # Wait for several backward steps
-                        self.optimizer.step()                            # Now we can do an optimizer step
-                        self.reset_grad()
-
-                params_groups_lr = str()
-                for group_ind, param_group in enumerate(self.optimizer.param_groups):
-                    params_groups_lr = params_groups_lr + 'params_group_%d' % (group_ind) + ': %.12f, ' % (param_group['lr'])
-
-                # 保存到tensorboard，每一步存储一个
-                self.writer.add_scalar('Stage2_train_loss', loss.item(), global_step_before+i)
-
-                descript = "Train Loss: %.7f, lr: %s" % (loss.item(), params_groups_lr)
-                tbar.set_description(desc=descript)
-            # 更新global_step_before为下次迭代做准备
-            global_step_before += len(tbar)
-
-            # Print the log info
-            print('Finish Stage2 Epoch [%d/%d], Average Loss: %.7f' % (epoch, self.epoch_stage2, epoch_loss/len(tbar)))
-            write_txt(self.save_path, 'Finish Stage2 Epoch [%d/%d], Average Loss: %.7f' % (epoch, self.epoch_stage2, epoch_loss/len(tbar)))
-
-            # 验证模型，保存权重，并保存日志
-            loss_mean, dice_mean = self.validation(stage=2)
-            if dice_mean > self.max_dice: 
-                is_best = True
-                self.max_dice = dice_mean
-            else: is_best = False
-            
-            self.lr = lr_scheduler.get_lr()            
-            state = {'epoch': epoch,
-                'state_dict': self.unet.module.state_dict(),
-                'max_dice': self.max_dice,
-                'optimizer' : self.optimizer.state_dict(),
-                'lr' : self.lr}
-            
-            self.save_checkpoint(state, 2, index, is_best)
+    # stage3, 接着stage2的训练，只训练有mask的样本
+    def train_stage3(self, index):
+        self.train_stage(self.stage_config(3), index)
 
-            self.writer.add_scalar('Stage2_val_loss', loss_mean, epoch)
-            self.writer.add_scalar('Stage2_val_dice', dice_mean, epoch)
-            self.writer.add_scalar('Stage2_lr', self.lr[0], epoch)
+    def train_stage(self, stage_config, index):
+        """依据训练计划中的一个阶段进行训练，所有阶段共用这一个训练流程
 
-            # 学习率衰减
-            lr_scheduler.step()
+        Args:
+            stage_config: get_stage_schedule返回的某一个阶段的配置
+            index: 当前为第几个fold
+        """
+        stage = stage_config['stage']
+        epoch_stage = stage_config['epoch']
+        epoch_accumulation = stage_config.get('epoch_accumulation', 0)
+        accumulation_steps = stage_config.get('accumulation_steps', 1)
+        criterion = self.criterions[stage]
+        # 训练集由调用者按照该阶段的配置生成，在进入训练循环之前检查一次
+        if self.train_loader.image_size != stage_config['image_size']:
+            raise ValueError('The train loader of stage {} yields {}x{} images, but the schedule uses {}.'.format(
+                stage, self.train_loader.image_size, self.train_loader.image_size, stage_config['image_size']))
+        # 只在显存紧张的阶段打开激活重计算
+        set_activation_checkpoint(self.unet, stage_config.get('activation_checkpoint', False))
+        if self.writer is None:
+            self.open_writer()
 
-    # stage3, 接着stage2的训练，只训练有mask的样本
-    def train_stage3(self, index):
         # # 冻结BN层， see https://zhuanlan.zhihu.com/p/65439075 and https://www.kaggle.com/c/siim-acr-pneumothorax-segmentation/discussion/100736591271 for more information
         # def set_bn_eval(m):
         #     classname = m.__class__.__name__
@@ -394,61 +516,109 @@ class Train(object):
         # self.unet.apply(set_bn_eval)
 
         # self.optimizer = optim.Adam([{'params': self.unet.decoder.parameters(), 'lr': 1e-5}, {'params': self.unet.encoder.parameters(), 'lr': 1e-7},])
-        self.optimizer = optim.Adam(self.unet.module.parameters(), self.lr_stage3, weight_decay=self.weight_decay_stage3)
-
-        # 如果是 train_stage23，则resume只在第二阶段起作用
-        if self.mode == 'train_stage23':
-            self.resume = None
-        # 加载的resume分为两种情况：之前没有训练第三个阶段，现在要加载第二个阶段的参数；第三个阶段训练了一半要继续训练
-        if self.resume:
-            # 若第三个阶段训练一半，要重新加载 TODO
-            if self.resume.split('_')[2] == '3':
-                self.load_checkpoint(load_optimizer=True) # 当load_optimizer为True会重新加载学习率和优化器
-                '''
-                CosineAnnealingLR：若存在['initial_lr']，则从initial_lr开始衰减；
-                若不存在，则执行CosineAnnealingLR会在optimizer.param_groups中添加initial_lr键值，其值等于lr
-
-                重置初始学习率，在load_checkpoint中会加载优化器，但其中的initial_lr还是之前的，所以需要覆盖为self.lr，让其从self.lr衰减
-                '''
-                self.optimizer.param_groups[0]['initial_lr'] = self.lr
-
-            # 若第二阶段结束后没有直接进行第三个阶段，中间暂停了
-            elif self.resume.split('_')[2] == '2':
-                self.load_checkpoint(load_optimizer=False)
-                self.start_epoch = 0
-                self.max_dice = 0
+        self.optimizer = optim.Adam(self.unet.module.parameters(), stage_config['lr'], weight_decay=stage_config['weight_decay'])
+
+        # 加载的resume分为两种情况：当前阶段训练了一半要继续训练；之前没有训练当前阶段，现在要加载上一个阶段的参数
+        resume_stage = self.resume_stage()
+        checkpoint = None
+        if resume_stage == stage:
+            checkpoint = self.load_checkpoint(load_optimizer=True) # 当load_optimizer为True会重新加载学习率和优化器
+            '''
+            CosineAnnealingLR：若存在['initial_lr']，则从initial_lr开始衰减；
+            若不存在，则执行CosineAnnealingLR会在optimizer.param_groups中添加initial_lr键值，其值等于lr
 
-        # 第二阶段结束后直接进行第三个阶段，中间并没有暂停
+            重置初始学习率，在load_checkpoint中会加载优化器，但其中的initial_lr还是之前的，所以需要覆盖为当前阶段的初始学习率
+            '''
+            for param_group in self.optimizer.param_groups:
+                param_group['initial_lr'] = stage_config['lr']
         else:
-            print('start stage3 after stage2 directly!')
+            # 若上一阶段结束后没有直接进行当前阶段，中间暂停了
+            if resume_stage == stage - 1:
+                self.load_checkpoint(load_optimizer=False)
+            # 上一阶段结束后直接进行当前阶段，中间并没有暂停
             self.start_epoch = 0
             self.max_dice = 0
+        # resume只在第一个训练的阶段起作用，例如train_stage23时只在第二阶段加载
+        self.resume = None
+
+        # 前epoch_freeze个epoch冻结编码器，只训练解码器；不进行数据增强时编码器特征只计算一次并缓存
+        epoch_freeze = stage_config.get('epoch_freeze', 0) if self.encoder_freeze else 0
+        feature_loader = None
+        if self.start_epoch < epoch_freeze:
+            feature_loader = self.feature_cache_loader(stage_config, index)
 
         # 防止训练到一半暂停重新训练，日志被覆盖
         global_step_before = self.start_epoch*len(self.train_loader)
-
-        stage3_epoches = self.epoch_stage3 - self.start_epoch
-        lr_scheduler = optim.lr_scheduler.CosineAnnealingLR(self.optimizer, stage3_epoches+5)
-
-        for epoch in range(self.start_epoch, self.epoch_stage3):
+        # 当前折在本阶段之后还要训练的阶段，用于估计当前折剩余的时间
+        later_stages = [(later, self.stage_config(later)['epoch']) for later in TRAIN_MODE_STAGES.get(self.mode, []) if later > stage]
+
+        # 余弦退火的周期为整个阶段，继续训练时恢复学习率策略的状态，学习率与没有中断时一致
+        lr_scheduler = optim.lr_scheduler.CosineAnnealingLR(self.optimizer, epoch_stage+stage_config['annealing_epoch_extra'])
+        resume_step, resume_epoch_loss = 0, 0
+        if checkpoint is not None:
+            if checkpoint.get('lr_scheduler'):
+                lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
+                # epoch结束时保存的状态还没有进行该epoch之后的衰减
+                if not checkpoint.get('step'):
+                    lr_scheduler.step()
+            else:
+                # 旧的权重没有保存学习率策略，从初始学习率开始衰减已经训练的epoch数
+                for param_group in self.optimizer.param_groups:
+                    param_group['lr'] = stage_config['lr']
+                lr_scheduler = optim.lr_scheduler.CosineAnnealingLR(self.optimizer, epoch_stage+stage_config['annealing_epoch_extra'])
+                for _ in range(self.start_epoch):
+                    lr_scheduler.step()
+            # 从epoch中间继续训练
+            if checkpoint.get('step'):
+                resume_step, resume_epoch_loss = checkpoint['step'], checkpoint['epoch_loss']
+                global_step_before = checkpoint['global_step'] - resume_step
+        self.profiler.start_stage(stage, index)
+        if self.async_validator is not None:
+            self.async_validator.start_stage(stage, index, self.max_dice)
+
+        for epoch in range(self.start_epoch, epoch_stage):
             epoch += 1
             self.unet.train(True)
+            frozen = epoch <= epoch_freeze
+            set_encoder_frozen(self.unet.module, frozen)
+            train_loader = feature_loader if frozen and feature_loader is not None else self.train_loader
+            # 损失在设备上累加，epoch结束时才同步
             epoch_loss = 0
+            start_step, last_step_checkpoint = 0, 0
+            if resume_step:
+                # 从保存时的下一个批次继续，采样器沿用保存的顺序
+                self.restore_step_state(checkpoint, train_loader)
+                start_step, last_step_checkpoint, epoch_loss = resume_step, resume_step, resume_epoch_loss
+                resume_step = 0
 
             self.reset_grad() # 梯度累加的时候需要使用
-            
-            tbar = tqdm.tqdm(self.train_loader)
-            for i, (images, masks) in enumerate(tbar):
+
+            # 特征缓存中的样本没有增强
+            device_augmentation = stage_config['augmentation_flag'] and stage_config.get('augmentation') == DEVICE_AUGMENTATION \
+                and train_loader is self.train_loader
+            tbar = tqdm.tqdm(train_loader, disable=not is_main_process(), initial=start_step)
+            self.throughput.start_epoch(stage, len(tbar), epoch_stage - epoch + 1, start_step)
+            # 打开profile时统计各阶段的耗时，profiler.iterate统计等待数据的时间
+            for i, (images, masks) in enumerate(self.profiler.iterate(tbar), start_step):
                 # GT : Ground Truth
-                images = images.to(self.device)
-                masks = masks.to(self.device)
-                assert images.size(2) == 1024
+                with self.profiler.phase('h2d'):
+                    # 使用特征缓存时images为CachedBatch，其中的特征保存的精度与训练时一致，不需要转换类型
+                    images = images.to(self.device)
+                    masks = masks.to(self.device)
+                if device_augmentation:
+                    with self.profiler.phase('augmentation'):
+                        # 种子由阶段、折、epoch、步数以及进程决定，从epoch中间继续训练时与没有中断时一致
+                        images, masks = self.batch_augmentation(images, masks, batch_seed(stage, index, epoch, i, get_rank()))
 
                 # SR : Segmentation Result
-                net_output = self.unet(images)
-                net_output_flat = net_output.view(net_output.size(0), -1)
-                masks_flat = masks.view(masks.size(0), -1)
-                loss_set = self.criterion_stage3(net_output_flat, masks_flat)
+                with autocast(self.device, enabled=self.amp):
+                    with self.profiler.phase('forward'):
+                        net_output = self.unet(images)
+                    with self.profiler.phase('loss'):
+                        # 损失中有sum等归约操作，转为float32计算以免溢出
+                        net_output_flat = net_output.view(net_output.size(0), -1).float()
+                        masks_flat = masks.view(masks.size(0), -1)
+                        loss_set = criterion(net_output_flat, masks_flat)
 
                 try:
                     loss_num = len(loss_set)
@@ -458,135 +628,252 @@ class Train(object):
                 if loss_num > 1:
                     for loss_index, loss_item in enumerate(loss_set):
                         if loss_index > 0:
-                            loss_name = 'stage3_loss_%d' % loss_index
-                            self.writer.add_scalar(loss_name, loss_item.item(), global_step_before + i)
+                            loss_name = 'stage%d_loss_%d' % (stage, loss_index)
+                            self.telemetry.scalar(loss_name, loss_item, global_step_before + i)
                     loss = loss_set[0]
                 else:
                     loss = loss_set
-                epoch_loss += loss.item()
+                epoch_loss += loss.detach().float()
 
                 # Backprop + optimize, see https://discuss.pytorch.org/t/why-do-we-need-to-set-the-gradients-manually-to-zero-in-pytorch/4903/20 for Accumulating Gradients
-                if epoch <= self.epoch_stage3 - self.epoch_stage3_accumulation:
-                    self.reset_grad()
-                    loss.backward()
-                    self.optimizer.step()
-                else:
-                    # loss = loss / self.accumulation_steps                # Normalize our loss (if averaged)
-                    loss.backward()                                      # Backward pass
-                    if (i+1) % self.accumulation_steps == 0:             # Wait for several backward steps
-                        self.optimizer.step()                            # Now we can do an optimizer step
+                if epoch <= epoch_stage - epoch_accumulation:
+                    with self.profiler.phase('backward'):
                         self.reset_grad()
-
-                params_groups_lr = str()
-                for group_ind, param_group in enumerate(self.optimizer.param_groups):
-                    params_groups_lr = params_groups_lr + 'params_group_%d' % (group_ind) + ': %.12f, ' % (param_group['lr'])
-
-                # 保存到tensorboard，每一步存储一个
-                self.writer.add_scalar('Stage3_train_loss', loss.item(), global_step_before+i)
-
-                descript = "Train Loss: %.7f, lr: %s" % (loss.item(), params_groups_lr)
-                tbar.set_description(desc=descript)
+                        self.scaler.scale(loss).backward()
+                    with self.profiler.phase('optimizer'):
+                        self.scaler.step(self.optimizer)
+                        self.scaler.update()
+                else:
+                    # loss = loss / accumulation_steps                     # Normalize our loss (if averaged)
+                    with self.profiler.phase('backward'):
+                        self.scaler.scale(loss).backward()               # Backward pass
+                    if (i+1) % accumulation_steps == 0:                  # Wait for several backward steps
+                        # 累加期间缩放系数保持不变，只在真正更新参数时step和update
+                        with self.profiler.phase('optimizer'):
+                            self.scaler.step(self.optimizer)             # Now we can do an optimizer step
+                            self.scaler.update()
+                            self.reset_grad()
+
+                with self.profiler.phase('logging'):
+                    # 每一步的损失放入缓冲区，由后台线程写入tensorboard，这里不需要同步
+                    self.telemetry.scalar('Stage%d_train_loss' % stage, loss, global_step_before+i)
+                    self.throughput.step(masks.size(0))
+
+                    # 每隔log_interval步才同步一次损失，更新进度条
+                    if is_main_process() and (i % self.log_interval == 0 or i + 1 == len(tbar)):
+                        params_groups_lr = str()
+                        for group_ind, param_group in enumerate(self.optimizer.param_groups):
+                            params_groups_lr = params_groups_lr + 'params_group_%d' % (group_ind) + ': %.12f, ' % (param_group['lr'])
+                        descript = "Train Loss: %.7f, lr: %s%.1f images/s, ETA stage %s, fold %s" % (
+                            loss.item(), params_groups_lr, self.throughput.images_per_second(),
+                            format_seconds(self.throughput.stage_eta()), format_seconds(self.throughput.fold_eta(later_stages)))
+                        tbar.set_description(desc=descript)
+
+                # 每隔step_checkpoint_interval步保存一次，梯度累加时只在参数更新之后保存
+                accumulating = epoch > epoch_stage - epoch_accumulation and (i+1) % accumulation_steps != 0
+                if self.step_checkpoint_interval and i + 1 - last_step_checkpoint >= self.step_checkpoint_interval \
+                        and i + 1 < len(tbar) and not accumulating:
+                    last_step_checkpoint = i + 1
+                    if is_main_process():
+                        with self.profiler.phase('checkpoint'):
+                            self.save_step_checkpoint(stage, index, epoch, i + 1, global_step_before + i + 1, epoch_loss, lr_scheduler, train_loader)
             # 更新global_step_before为下次迭代做准备
             global_step_before += len(tbar)
+            epoch_loss_mean = float(epoch_loss) / len(tbar)
+            self.log_throughput(stage, epoch, later_stages)
 
-            # Print the log info
-            print('Finish Stage3 Epoch [%d/%d], Average Loss: %.7f' % (epoch, self.epoch_stage3, epoch_loss/len(tbar)))
-            write_txt(self.save_path, 'Finish Stage3 Epoch [%d/%d], Average Loss: %.7f' % (epoch, self.epoch_stage3, epoch_loss/len(tbar)))
-
-            # 验证模型，保存权重，并保存日志
-            loss_mean, dice_mean = self.validation(stage=3)
-            if dice_mean > self.max_dice: 
-                is_best = True
-                self.max_dice = dice_mean
-            else: is_best = False
-            
-            self.lr = lr_scheduler.get_lr()            
-            state = {'epoch': epoch,
-                'state_dict': self.unet.module.state_dict(),
-                'max_dice': self.max_dice,
-                'optimizer' : self.optimizer.state_dict(),
-                'lr' : self.lr}
-            
-            self.save_checkpoint(state, 3, index, is_best)
-
-            self.writer.add_scalar('Stage3_val_loss', loss_mean, epoch)
-            self.writer.add_scalar('Stage3_val_dice', dice_mean, epoch)
-            self.writer.add_scalar('Stage3_lr', self.lr[0], epoch)
+            # 分布式模式下只有主进程验证、保存权重和日志，其它进程在barrier处等待
+            if is_main_process():
+                self.end_epoch(stage, index, epoch, epoch_stage, epoch_loss_mean, lr_scheduler)
+            barrier()
+            self.log_profile(stage, epoch)
 
             # 学习率衰减
             lr_scheduler.step()
-            
 
-    def validation(self, stage=1):
+        set_encoder_frozen(self.unet.module, False)
+
+        # 等待本阶段的验证结果以及权重写完，并按照保留规则删除较早的权重，本阶段已经完成，epoch中间的权重不再需要
+        if is_main_process():
+            self.drain_validation()
+            self.checkpoint_writer.flush()
+            if (stage, index) in self.trained_units:
+                self.trained_units.remove((stage, index))
+            self.trained_units.append((stage, index))
+            apply_retention(self.save_path, self.model_type, self.trained_units, self.keep_last_units)
+            if os.path.exists(self.step_checkpoint_path(stage, index)):
+                os.remove(self.step_checkpoint_path(stage, index))
+        self.telemetry.flush()
+
+    def feature_cache_loader(self, stage_config, index):
+        """冻结编码器且不进行数据增强时，计算并缓存训练集的编码器特征，返回从缓存中读取的loader
+
+        分布式训练时各进程只有一部分样本，不使用缓存
+        Return:
+            不满足条件或者缓存超出大小限制时返回None，冻结的epoch仍然从图片开始训练，只是编码器不计算梯度
+        """
+        if not self.feature_cache or stage_config['augmentation_flag'] or is_distributed():
+            return None
+        cache = FeatureCache(os.path.join(self.feature_cache, '%s_%d_%d' % (self.model_type, stage_config['stage'], index)),
+                             self.feature_cache_max_gb)
+        model = self.unet.module
+        model.eval()
+        built = cache.build(model, self.train_loader.ordered_view(), self.device, self.amp)
+        if not built:
+            return None
+        return cache.loader(self.train_loader.batch_size, shuffle=self.train_loader.shuffle, weights=self.train_loader.weights)
+
+    def log_profile(self, stage, epoch):
+        """打开profile时，输出上一个epoch各阶段耗时的p50/p95/p99
+        """
+        summary = self.profiler.report()
+        if not summary:
+            return
+        report = 'Stage%d Epoch %d profile:\n%s' % (stage, epoch, format_report(summary))
+        if is_main_process():
+            print(report)
+        self.telemetry.log(report)
+        for name, item in summary.items():
+            for key in ['p50', 'p95', 'p99']:
+                self.telemetry.scalar('Stage%d_profile_%s_%s_ms' % (stage, name, key), item[key], epoch)
+
+    def log_throughput(self, stage, epoch, later_stages):
+        """记录一个epoch的耗时、样本数、images/s以及剩余时间的估计
+        """
+        seconds, n_images, images_per_second = self.throughput.end_epoch()
+        stage_eta, fold_eta = self.throughput.stage_eta(), self.throughput.fold_eta(later_stages)
+        self.telemetry.scalar('Stage%d_images_per_second' % stage, images_per_second, epoch)
+        self.telemetry.scalar('Stage%d_samples_per_epoch' % stage, n_images, epoch)
+        self.telemetry.scalar('Stage%d_epoch_seconds' % stage, seconds, epoch)
+        self.telemetry.scalar('Stage%d_eta_stage_seconds' % stage, stage_eta, epoch)
+        self.telemetry.scalar('Stage%d_eta_fold_seconds' % stage, fold_eta, epoch)
+        self.telemetry.log('Stage%d Epoch %d: %d samples in %s, %.1f images/s, ETA stage %s, fold %s' % (
+            stage, epoch, n_images, format_seconds(seconds), images_per_second, format_seconds(stage_eta), format_seconds(fold_eta)))
+
+    def end_epoch(self, stage, index, epoch, epoch_stage, epoch_loss_mean, lr_scheduler):
+        """一个epoch训练结束后，打印日志，验证模型，保存权重
+        """
+        # Print the log info
+        print('Finish Stage%d Epoch [%d/%d], Average Loss: %.7f' % (stage, epoch, epoch_stage, epoch_loss_mean))
+        self.telemetry.log('Finish Stage%d Epoch [%d/%d], Average Loss: %.7f' % (stage, epoch, epoch_stage, epoch_loss_mean))
+
+        self.lr = lr_scheduler.get_lr()
+        self.telemetry.scalar('Stage%d_lr' % stage, self.lr[0], epoch)
+        if self.async_validator is not None:
+            # 验证交给评估进程，当前epoch的权重在之后按顺序合并结果时保存，其中的max_dice包含该epoch的结果
+            self.submit_validation(stage, index, epoch, self.epoch_state(epoch, lr_scheduler))
+            return
+
+        # 验证模型，保存权重，并保存日志
+        loss_mean, dice_mean = self.validation(stage=stage, index=index)
+        if dice_mean > self.max_dice: 
+            is_best = True
+            self.max_dice = dice_mean
+            self.ledger.promote('%s_%d_%d' % (self.model_type, stage, index), '%s_%d_%d_best' % (self.model_type, stage, index))
+        else: is_best = False
+
+        self.save_checkpoint(self.epoch_state(epoch, lr_scheduler), stage, index, is_best)
+
+        self.telemetry.scalar('Stage%d_val_loss' % stage, loss_mean, epoch)
+        self.telemetry.scalar('Stage%d_val_dice' % stage, dice_mean, epoch)
+
+    def epoch_state(self, epoch, lr_scheduler):
+        return {'epoch': epoch,
+            'state_dict': self.unet.module.state_dict(),
+            'max_dice': self.max_dice,
+            'optimizer' : self.optimizer.state_dict(),
+            'scaler': self.scaler.state_dict(),
+            'lr_scheduler': lr_scheduler.state_dict(),
+            'lr' : self.lr}
+
+    def submit_validation(self, stage, index, epoch, state):
+        """将一个epoch的权重交给评估进程，并合并已经完成的验证结果
+        """
+        state = snapshot_state(state)
+        images, masks = valid_samples(self.valid_loader)
+        stage_config = self.stage_config(stage)
+        task = {'stage': stage, 'index': index, 'epoch': epoch, 'name': '%s_%d_%d' % (self.model_type, stage, index),
+                'state_dict': state['state_dict'], 'images': images, 'masks': masks,
+                'image_size': stage_config['image_size'], 'batch_size': self.valid_loader.batch_size, 'loss': stage_config['loss']}
+        self.merge_validation(self.async_validator.submit(task, state))
+
+    def drain_validation(self):
+        """等待并合并全部异步验证的结果，之后写入或者读取的权重中max_dice都是最新的
+        """
+        if self.async_validator is not None:
+            self.merge_validation(self.async_validator.poll(max_pending=0))
+
+    def merge_validation(self, merged):
+        """按照epoch的顺序合并异步验证的结果：写入日志和TensorBoard，更新最优dice，保存该epoch的权重以及最优权重
+
+        Args:
+            merged: AsyncValidator.poll的返回值，[(result, 该epoch完整的权重), ...]
+        """
+        for result, state in merged:
+            stage, index, epoch = result['stage'], result['index'], result['epoch']
+            print('Stage%d Epoch %d Val Loss: %.7f, dice: %.7f' % (stage, epoch, result['loss'], result['dice']))
+            self.telemetry.log('Stage%d Epoch %d Val Loss: %.7f, dice: %.7f' % (stage, epoch, result['loss'], result['dice']))
+            best_path = None
+            if result['is_best']:
+                self.max_dice = result['dice']
+                print('Saving Best Model (Stage%d Epoch %d).' % (stage, epoch))
+                self.telemetry.log('Saving Best Model (Stage%d Epoch %d).' % (stage, epoch))
+                best_path = os.path.join(self.save_path, '%s_%d_%d_best.pth' % (self.model_type, stage, index))
+            # epoch的权重在得到验证结果之后才保存，从该权重继续训练时恢复的max_dice不会落后于已经验证过的epoch
+            state['max_dice'] = self.max_dice
+            pth_path = os.path.join(self.save_path, '%s_%d_%d.pth' % (self.model_type, stage, index))
+            with self.profiler.phase('checkpoint'):
+                self.checkpoint_writer.save(state, pth_path, best_path)
+            self.telemetry.scalar('Stage%d_val_loss' % stage, result['loss'], epoch)
+            self.telemetry.scalar('Stage%d_val_dice' % stage, result['dice'], epoch)
+
+    def validation(self, stage=1, index=None):
         # 验证的时候，train(False)是必须的0，设置其中的BN层、dropout等为eval模式
         # with torch.no_grad(): 可以有，在这个上下文管理器中，不反向传播，会加快速度，可以使用较大batch size
         self.unet.eval()
-        tbar = tqdm.tqdm(self.valid_loader)
-        loss_sum, dice_sum = 0, 0
-        if stage == 1:
-            criterion = self.criterion
-        elif stage == 2:
-            criterion = self.criterion_stage2
-        elif stage == 3:
-            criterion = self.criterion_stage3
-        with torch.no_grad(): 
-            for i, (images, masks) in enumerate(tbar):
-                images = images.to(self.device)
-                masks = masks.to(self.device)
+        # 分布式模式下只有主进程进行验证，直接使用原始模型，避免DistributedDataParallel的同步
+        net = self.unet.module if is_distributed() else self.unet
+        # 训练过程中的验证，将逐图片的结果写入当前epoch权重对应的账本
+        recorder = None
+        if index is not None:
+            recorder = LedgerRecorder(self.ledger, '%s_%d_%d' % (self.model_type, stage, index), index, stage, 0.5)
+        loss_mean, dice_mean = evaluate(net, self.valid_loader, self.criterions[stage], self.device, self.amp, recorder, self.valid_image_ids())
+        self.telemetry.log("Val Loss: {:.7f}, dice: {:.7f}".format(loss_mean, dice_mean))
+        return loss_mean, dice_mean
 
-                net_output = self.unet(images)
-                net_output_flat = net_output.view(net_output.size(0), -1)
-                masks_flat = masks.view(masks.size(0), -1)
-                
-                loss_set = criterion(net_output_flat, masks_flat)
-                try:
-                    loss_num = len(loss_set)
-                except:
-                    loss_num = 1
-                
-                # 依据返回的损失个数分情况处理
-                if loss_num > 1:
-                    loss = loss_set[0]
-                else:
-                    loss = loss_set
-                loss_sum += loss.item()
+    def valid_image_ids(self):
+        """验证集各样本的ImageId，验证集不打乱顺序，因此可以依据批次下标对应到具体图片
+        """
+        if hasattr(self.valid_loader, 'image_names'):
+            return image_ids_of(self.valid_loader.image_names)
+        return image_ids_of(self.valid_loader.dataset.image_names)
 
-                # 计算dice系数，预测出的矩阵要经过sigmoid含义以及阈值，阈值默认为0.5
-                net_output_flat_sign = (torch.sigmoid(net_output_flat)>0.5).float()
-                dice = self.dice_overall(net_output_flat_sign, masks_flat).mean()
-                dice_sum += dice.item()
+    def record_ledger(self, model_path, stage, index, threshold, pixel_threshold):
+        '''在选定的阈值和像素阈值下，将验证集上逐图片的评估结果写入账本
 
-                descript = "Val Loss: {:.7f}, dice: {:.7f}".format(loss.item(), dice.item())
-                tbar.set_description(desc=descript)
-        
-        loss_mean, dice_mean = loss_sum/len(tbar), dice_sum/len(tbar)
-        print("Val Loss: {:.7f}, dice: {:.7f}".format(loss_mean, dice_mean))
-        write_txt(self.save_path, "Val Loss: {:.7f}, dice: {:.7f}".format(loss_mean, dice_mean))
-        return loss_mean, dice_mean
+        Args:
+            model_path: 当前评估的权重路径，账本与其同名
+            stage: 第几阶段
+            index: 当前为第几个fold
+            threshold: 阈值
+            pixel_threshold: 像素阈值
+        '''
+        recorder = LedgerRecorder(self.ledger, model_path, index, stage, threshold, pixel_threshold)
+        image_ids = self.valid_image_ids()
+        self.unet.eval()
+        with torch.no_grad():
+            batch_start = 0
+            for i, (images, masks) in enumerate(tqdm.tqdm(self.valid_loader)):
+                images = images.to(self.device)
+                probs = torch.sigmoid(self.unet(images))
+                recorder.add_batch(image_ids[batch_start:batch_start+images.size(0)], probs, masks)
+                batch_start += images.size(0)
+        ledger_path = recorder.close()
+        print('Save per-image evaluation to %s' % ledger_path)
 
     # dice for threshold selection
     def dice_overall(self, preds, targs):
-        n = preds.shape[0]  # batch size为多少
-        preds = preds.view(n, -1)
-        targs = targs.view(n, -1)
-        # preds, targs = preds.to(self.device), targs.to(self.device)
-        preds, targs = preds.cpu(), targs.cpu()
-
-        # tensor之间按位相成，求两个集合的交(只有1×1等于1)后。按照第二个维度求和，得到[batch size]大小的tensor，每一个值代表该输入图片真实类标与预测类标的交集大小
-        intersect = (preds * targs).sum(-1).float()
-        # tensor之间按位相加，求两个集合的并。然后按照第二个维度求和，得到[batch size]大小的tensor，每一个值代表该输入图片真实类标与预测类标的并集大小
-        union = (preds + targs).sum(-1).float()
-        '''
-        输入图片真实类标与预测类标无并集有两种情况：第一种为预测与真实均没有类标，此时并集之和为0；第二种为真实有类标，但是预测完全错误，此时并集之和不为0;
-
-        寻找输入图片真实类标与预测类标并集之和为0的情况，将其交集置为1，并集置为2，最后还有一个2*交集/并集，值为1；
-        其余情况，直接按照2*交集/并集计算，因为上面的并集并没有减去交集，所以需要拿2*交集，其最大值为1
-        '''
-        u0 = union == 0
-        intersect[u0] = 1
-        union[u0] = 2
-        
-        return (2. * intersect / union)
+        return dice_overall(preds, targs)
 
     def classify_score(self, preds, targs):
         '''若当前图像中有mask，则为正类，若当前图像中无mask，则为负类。从分类的角度得分当前的准确率
@@ -681,6 +968,7 @@ class Train(object):
             elif stage == 3:
                 best_pixel_thr, score = 0, dices_little.max()
             print('best_thr:{}, best_pixel_thr:{}, score:{}'.format(best_thr, best_pixel_thr, score))
+        self.record_ledger(model_path, stage, index, best_thr, best_pixel_thr)
 
         plt.figure(figsize=(10.4, 4.8))
         plt.subplot(1, 3, 1)
@@ -806,6 +1094,7 @@ class Train(object):
         else: best_thr, best_pixel_thr, score, dices_big = best_thr1, best_pixel_thr1, score1, dices_big1
             
         print('best_thr:{}, best_pixel_thr:{}, score:{}'.format(best_thr, best_pixel_thr, score))
+        self.record_ledger(model_path, stage, index, best_thr, best_pixel_thr)
 
         f, (ax1, ax2) = plt.subplots(figsize=(14.4, 4.8), ncols=2)
 
@@ -16,14 +16,18 @@ from albumentations import CLAHE
 import json
 from models.Transpose_unet.unet.model import Unet as Unet_t
 from models.octave_unet.unet.model import OctaveUnet
+from utils.eval_ledger import EvalLedger, LEDGER_DTYPE, image_ids_of
 import torch
+from utils.torch_compile import compile_model
 
 
 class Test(object):
-    def __init__(self, model_type, image_size, mean, std, t=None):
+    def __init__(self, model_type, image_size, mean, std, t=None, compile_mode=''):
         # Models
         self.unet = None
         self.image_size = image_size # 模型的输入大小
+        # torch.compile的模式，为空时不编译
+        self.compile_mode = compile_mode
 
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.model_type = model_type
@@ -95,6 +99,8 @@ class Test(object):
         # 对于每一折加载模型，对所有测试集测试，并取平均
         # preds_cla存放模型的分类结果，而preds存放模型的分割结果，其中分割模型默认为1024的分辨率
         preds = np.zeros([len(images_path), self.image_size, self.image_size])
+        # 投票策略下preds中只有票数，另外累加各折分割模型输出的最大概率，账本中记录其平均值
+        max_probs = np.zeros(len(images_path))
         
         for fold in n_splits:
             # 加载分类模型，进行测试
@@ -117,6 +123,9 @@ class Test(object):
             print('Load segmentation weight from %s.' % unet_path)
             seg_unet.load_state_dict(torch.load(unet_path)['state_dict'])
             seg_unet.eval()
+            # 每一折的两个模型各自编译，编译失败时退回eager
+            compile_model(self.unet, self.model_type, self.compile_mode, self.device)
+            compile_model(seg_unet, self.model_type, self.compile_mode, self.device)
 
             count_mask_classify = 0
             with torch.no_grad():
@@ -134,6 +143,7 @@ class Test(object):
                     if np.sum(pred) > 0:
                         count_mask_classify += 1
                         pred = self.tta(img, seg_unet)
+                        max_probs[index] += pred.max()
                         # 如果不是采用平均策略，即投票策略，则进行阈值处理，变成0或1
                         if not seg_average_vote:
                             pred = np.where(pred > thresholds_seg[fold], 1, 0)
@@ -150,8 +160,15 @@ class Test(object):
 
         count_has_mask = 0
         masks = np.zeros([len(images_path), 1024, 1024])
+        # 逐图片的评估结果，fold记为-1表示多折集成的结果
+        records = np.zeros(len(images_path), dtype=LEDGER_DTYPE)
+        records['image_id'] = [image_id.encode('utf-8') for image_id in image_ids_of(images_path)]
+        records['fold'] = -1
+        records['stage'] = stage_seg
+        records['threshold'] = vote_ticket if not seg_average_vote else average_threshold
         for index, (image_path, mask_path) in enumerate(tqdm(zip(images_path, masks_path), total=len(images_path))):
             pred = preds[index,...]
+            records['max_prob'][index] = pred.max() if seg_average_vote else max_probs[index] / len(n_splits)
             if not seg_average_vote:
                 pred = np.where(pred > vote_ticket, 1, 0)
             else:
@@ -162,6 +179,18 @@ class Test(object):
             masks[index,...] = np.around(np.array(mask.convert('L'))/256.)
             if np.sum(pred)>0:
                 count_has_mask += 1
+            records['pred_pixels'][index] = np.sum(pred > 0)
+            records['true_pixels'][index] = np.sum(masks[index] > 0)
+            records['intersection'][index] = np.sum((pred > 0) & (masks[index] > 0))
+        union = records['pred_pixels'] + records['true_pixels']
+        records['dice'] = np.where(union == 0, 1.0, 2. * records['intersection'] / np.maximum(union, 1))
+        ledger = EvalLedger(os.path.join('checkpoints', self.model_type, 'ledger'))
+        # 名称以权重类型和集成策略结尾，不会被EvalLedger.worst当作某一折某一阶段(_stage_fold、_stage_fold_best)的账本
+        ledger_name = '%s_test_stage1_%d_%d_%s_%s' % (self.model_type, stage_cla, stage_seg, 'best' if test_best_model else 'last',
+                                                      'average' if seg_average_vote else 'vote')
+        ledger_path = ledger.write(ledger_name, records)
+        print('Save per-image evaluation to %s' % ledger_path)
+
         preds_tensor = torch.from_numpy(preds)
         masks_tensor = torch.from_numpy(masks)
         del preds, masks
@@ -315,7 +344,9 @@ if __name__ == "__main__":
         print('Using vating strategy, thresholds_seg: ', thresholds_seg)
     print('less_than_sum: ', less_than_sum)
 
-    solver = Test(model_name, image_size, mean, std)
+    # torch.compile的模式，例如default、reduce-overhead、max-autotune，为空时不编译
+    compile_mode = ''
+    solver = Test(model_name, image_size, mean, std, compile_mode=compile_mode)
     solver.test_model(
         thresholds_classify=thresholds_classify,
         thresholds_seg=thresholds_seg,
@@ -1,31 +1,43 @@
 import argparse
 import os,glob
-from datasets.siim import get_loader
+from datasets.siim import StageLoader
+from datasets.shards import build_shards
 from torch.backends import cudnn
 import random
 import json,codecs
 from pprint import pprint
 from utils.mask_functions import write_txt
 from utils.datasets_statics import DatasetsStatic
+from utils.data_augmentation import PIPELINES
+from utils.batch_augmentation import DEVICE_AUGMENTATION
+from datasets.aug_dataset import AUG
 from argparse import Namespace
 from sklearn.model_selection import KFold, StratifiedKFold
 import numpy as np
-import pickle
 from datetime import datetime
-from solver import Train
+from solver import Train, get_stage_schedule, TRAIN_MODE_STAGES
+from utils.batch_planner import BatchPlanner
+from utils.fold_scheduler import save_split, load_split, folds_suffix
+from utils.distributed import init_distributed, is_main_process, get_rank, get_world_size, barrier, cleanup
 
 
 def main(config):
     cudnn.benchmark = True
 
+    # 使用torchrun启动时进入分布式模式，每一个进程训练各自的一份样本
+    distributed = init_distributed(config.dist_backend)
+    if distributed and 'choose_threshold' in config.mode:
+        raise ValueError('choose_threshold does not support distributed mode, please run it in a single process.')
+
     config.save_path = config.model_path + '/' + config.model_type
-    if not os.path.exists(config.save_path):
+    if is_main_process() and not os.path.exists(config.save_path):
         print('Making pth folder...')
         os.makedirs(config.save_path)
 
     # 打印配置参数，并输出到文件中
-    pprint(config)
-    if 'choose_threshold' not in config.mode:
+    if is_main_process():
+        pprint(config)
+    if 'choose_threshold' not in config.mode and is_main_process():
         TIMESTAMP = "{0:%Y-%m-%dT%H-%M-%S}".format(datetime.now()) 
         with codecs.open(config.save_path + '/'+ TIMESTAMP + '.json', 'w', "utf-8") as json_file:
             json.dump({k: v for k, v in config._get_kwargs()}, json_file, ensure_ascii=False)
@@ -34,144 +46,123 @@ def main(config):
     # 存储每一次交叉验证的最高得分，最优阈值
     scores, best_thrs, best_pixel_thrs = [], [], []
 
-    # 统计各样本是否有Mask
-    if os.path.exists('dataset_static.pkl'):
-        print('Extract dataset static information form: dataset_static.pkl.')
-        with open('dataset_static.pkl', 'rb') as f:
-            static = pickle.load(f)
-            images_path, masks_path, masks_bool = static[0], static[1], static[2]
-    else:
-        print('Calculate dataset static information.')
-        # 为了确保每次重新运行，交叉验证每折选取的下标均相同(因为要选阈值),以及交叉验证的种子固定。
-        dataset_static = DatasetsStatic(config.dataset_root, 'test_images', 'test_mask', True)
-        images_path, masks_path, masks_bool = dataset_static.mask_static_bool()
-        with open('dataset_static.pkl', 'wb') as f:
-            pickle.dump([images_path, masks_path, masks_bool], f)
-    
-    # 统计各样本是否有Mask
-    if os.path.exists('dataset_static_mask.pkl'):
-        print('Extract dataset static information form: dataset_static_mask.pkl.')
-        with open('dataset_static_mask.pkl', 'rb') as f:
-            static_mask = pickle.load(f)
-            images_path_mask, masks_path_mask, masks_bool_mask = static_mask[0], static_mask[1], static_mask[2]
-    else:
-        print('Calculate dataset with mask static information.')
-        # 为了确保每次重新运行，交叉验证每折选取的下标均相同(因为要选阈值),以及交叉验证的种子固定。
-        dataset_static_mask = DatasetsStatic(config.dataset_root, 'test_images', 'test_mask', True)
-        images_path_mask, masks_path_mask, masks_bool_mask = dataset_static_mask.mask_static_bool_stage3()
-        with open('dataset_static_mask.pkl', 'wb') as f:
-            pickle.dump([images_path_mask, masks_path_mask, masks_bool_mask], f)
+    # 样本统计信息由主进程计算并缓存，其它进程等待主进程完成后直接读取
+    if not is_main_process():
+        barrier()
 
-    # 统计各样本是否有Mask
-    if os.path.exists('dataset_static_stage1.pkl'):
-        print('Extract dataset static information form: dataset_static_stage1.pkl.')
-        with open('dataset_static_stage1.pkl', 'rb') as f:
-            static_stage1 = pickle.load(f)
-            images_path_stage1, masks_path_stage1, masks_bool_stage1 = static_stage1[0], static_stage1[1], static_stage1[2]    
-    else:
-        print('Calculate dataset static information.')
-        # 为了确保每次重新运行，交叉验证每折选取的下标均相同(因为要选阈值),以及交叉验证的种子固定。
-        dataset_static_stage1 = DatasetsStatic(config.dataset_root, 'train_images', 'train_mask', True)
-        images_path_stage1, masks_path_stage1, masks_bool_stage1 = dataset_static_stage1.mask_static_bool()
-        with open('dataset_static_stage1.pkl', 'wb') as f:
-            pickle.dump([images_path_stage1, masks_path_stage1, masks_bool_stage1], f)
-    
-    # 统计各样本是否有Mask
-    if os.path.exists('dataset_static_mask_stage1.pkl'):
-        print('Extract dataset static information form: dataset_static_mask_stage1.pkl.')
-        with open('dataset_static_mask_stage1.pkl', 'rb') as f:
-            static_mask_stage1 = pickle.load(f)
-            images_path_mask_stage1, masks_path_mask_stage1, masks_bool_mask_stage1 = static_mask_stage1[0], static_mask_stage1[1], static_mask_stage1[2]
-    else:
-        print('Calculate dataset with mask static information.')
-        # 为了确保每次重新运行，交叉验证每折选取的下标均相同(因为要选阈值),以及交叉验证的种子固定。
-        dataset_static_mask_stage1 = DatasetsStatic(config.dataset_root, 'train_images', 'train_mask', True)
-        images_path_mask_stage1, masks_path_mask_stage1, masks_bool_mask_stage1 = dataset_static_mask_stage1.mask_static_bool_stage3()
-        with open('dataset_static_mask_stage1.pkl', 'wb') as f:
-            pickle.dump([images_path_mask_stage1, masks_path_mask_stage1, masks_bool_mask_stage1], f)
+    # 统计各样本是否有Mask，由样本清单查询得到，清单只在样本有变化时增量更新
+    # 为了确保每次重新运行，交叉验证每折选取的下标均相同(因为要选阈值),以及交叉验证的种子固定。
+    dataset_static = DatasetsStatic(config.dataset_root, 'test_images', 'test_mask', True)
+    images_path, masks_path, masks_bool = dataset_static.mask_static_bool()
+    images_path_mask, masks_path_mask, masks_bool_mask = dataset_static.mask_static_bool_stage3()
 
-    result = {}
-    skf = StratifiedKFold(n_splits=config.n_splits, shuffle=True, random_state=1)
-    split1, split2 = skf.split(images_path, masks_bool), skf.split(images_path_mask, masks_bool_mask)
-    split1_stage1, split2_stage1 = skf.split(images_path_stage1, masks_bool_stage1), skf.split(images_path_mask_stage1, masks_bool_mask_stage1)
-    for index, ((train_index, val_index), (train_index_mask, val_index_mask), (train_index_stage1, val_index_stage1), (train_index_mask_stage1, val_index_mask_stage1)) in enumerate(zip(split1, split2, split1_stage1, split2_stage1)):
-        # if index > 1:    if index < 2 or index > 3:    if index < 4:
-        # 不管是选阈值还是训练，均需要对下面几句话进行调整，来选取测试哪些fold。另外，选阈值的时候，也要对choose_threshold参数更改(是否使用best)
-        # if index != 0:
-        #     print("Fold {} passed".format(index))
-        #     continue
-        # 比赛第一阶段测试集划分
-        train_image = [images_path[x] for x in train_index]
-        train_mask = [masks_path[x] for x in train_index]
-        val_image = [images_path[x] for x in val_index]
-        val_mask = [masks_path[x] for x in val_index]
+    dataset_static_stage1 = DatasetsStatic(config.dataset_root, 'train_images', 'train_mask', True)
+    images_path_stage1, masks_path_stage1, masks_bool_stage1 = dataset_static_stage1.mask_static_bool()
+    images_path_mask_stage1, masks_path_mask_stage1, masks_bool_mask_stage1 = dataset_static_stage1.mask_static_bool_stage3()
+
+    if is_main_process():
+        barrier()
 
-        train_image_mask = [images_path_mask[x] for x in train_index_mask]
-        train_mask_mask = [masks_path_mask[x] for x in train_index_mask]
-        val_image_mask = [images_path_mask[x] for x in val_index_mask]
-        val_mask_mask = [masks_path_mask[x] for x in val_index_mask]
+    # 交叉验证的划分只计算一次并保存，并行调度各折时所有进程读取同一份划分
+    if config.split_file and os.path.exists(config.split_file):
+        print('Extract folds from: {}'.format(config.split_file))
+        folds = load_split(config.split_file)
+    else:
+        folds = []
+        skf = StratifiedKFold(n_splits=config.n_splits, shuffle=True, random_state=1)
+        split1, split2 = skf.split(images_path, masks_bool), skf.split(images_path_mask, masks_bool_mask)
+        split1_stage1, split2_stage1 = skf.split(images_path_stage1, masks_bool_stage1), skf.split(images_path_mask_stage1, masks_bool_mask_stage1)
+        for index, ((train_index, val_index), (train_index_mask, val_index_mask), (train_index_stage1, val_index_stage1), (train_index_mask_stage1, val_index_mask_stage1)) in enumerate(zip(split1, split2, split1_stage1, split2_stage1)):
+            # 比赛第一阶段测试集划分
+            train_image = [images_path[x] for x in train_index]
+            train_mask = [masks_path[x] for x in train_index]
+            val_image = [images_path[x] for x in val_index]
+            val_mask = [masks_path[x] for x in val_index]
 
-        # 比赛第一阶段训练集的划分
-        train_image_stage1 = [images_path_stage1[x] for x in train_index_stage1]
-        train_mask_stage1 = [masks_path_stage1[x] for x in train_index_stage1]
-        val_image_stage1 = [images_path_stage1[x] for x in val_index_stage1]
-        val_mask_stage1 = [masks_path_stage1[x] for x in val_index_stage1]
+            train_image_mask = [images_path_mask[x] for x in train_index_mask]
+            train_mask_mask = [masks_path_mask[x] for x in train_index_mask]
+            val_image_mask = [images_path_mask[x] for x in val_index_mask]
+            val_mask_mask = [masks_path_mask[x] for x in val_index_mask]
 
-        train_image_mask_stage1 = [images_path_mask_stage1[x] for x in train_index_mask_stage1]
-        train_mask_mask_stage1 = [masks_path_mask_stage1[x] for x in train_index_mask_stage1]
-        val_image_mask_stage1 = [images_path_mask_stage1[x] for x in val_index_mask_stage1]
-        val_mask_mask_stage1 = [masks_path_mask_stage1[x] for x in val_index_mask_stage1]
+            # 比赛第一阶段训练集的划分
+            train_image_stage1 = [images_path_stage1[x] for x in train_index_stage1]
+            train_mask_stage1 = [masks_path_stage1[x] for x in train_index_stage1]
+            val_image_stage1 = [images_path_stage1[x] for x in val_index_stage1]
+            val_mask_stage1 = [masks_path_stage1[x] for x in val_index_stage1]
 
-        # 对于第一个阶段方法的处理
-        train_loader, val_loader = get_loader(train_image_stage1 + train_image, train_mask_stage1 + train_mask, val_image_stage1 + val_image, val_mask_stage1 + val_mask, config.image_size_stage1,
-                                        config.batch_size_stage1, config.num_workers, config.stage1_augmentation_flag, weights_sample=config.weight_sample)
-        solver = Train(config, train_loader, val_loader)
-        # 针对不同mode，在第一阶段的处理方式
-        if config.mode == 'train' or config.mode == 'train_stage1':
-            solver.train(index)
-        elif config.mode == 'choose_threshold1':
-            best_thr, best_pixel_thr, score = solver.choose_threshold(os.path.join(config.save_path, '%s_%d_%d_best.pth' % (config.model_type, 1, index)), index)
-            scores.append(score)
-            best_thrs.append(best_thr)
-            best_pixel_thrs.append(best_pixel_thr)
-            result[str(index)] = [best_thr, best_pixel_thr, score]
-        del train_loader, val_loader
+            train_image_mask_stage1 = [images_path_mask_stage1[x] for x in train_index_mask_stage1]
+            train_mask_mask_stage1 = [masks_path_mask_stage1[x] for x in train_index_mask_stage1]
+            val_image_mask_stage1 = [images_path_mask_stage1[x] for x in val_index_mask_stage1]
+            val_mask_mask_stage1 = [masks_path_mask_stage1[x] for x in val_index_mask_stage1]
 
-        # 对于第二个阶段的处理方法
-        train_loader_stage2, val_loader_stage2 = get_loader(train_image_stage1 + train_image, train_mask_stage1 + train_mask, val_image_stage1 + val_image, val_mask_stage1 + val_mask, config.image_size_stage2,
-                                    config.batch_size_stage2, config.num_workers, config.stage2_augmentation_flag, weights_sample=config.weight_sample)
-        # 更新类的训练集以及验证集
-        solver.train_loader, solver.valid_loader = train_loader_stage2, val_loader_stage2
-        # 针对不同mode，在第二阶段的处理方式
-        if config.mode == 'train' or config.mode == 'train_stage2' or config.mode == 'train_stage23':
-            solver.train_stage2(index)
-            # solver.get_dice_onval(os.path.join(config.save_path, '%s_%d_%d_best.pth' % (config.model_type, 2, index)), 0.67, 2048)
-        elif config.mode == 'choose_threshold2':
-            # solver.pred_mask_count(os.path.join(config.save_path, '%s_%d_%d_best.pth' % (config.model_type, 2, index)), masks_bool, val_index, 0.80, 1280)
-            best_thr, best_pixel_thr, score = solver.choose_threshold_grid(os.path.join(config.save_path, '%s_%d_%d_best.pth' % (config.model_type, 2, index)), index)
-            scores.append(score)
-            best_thrs.append(best_thr)
-            best_pixel_thrs.append(best_pixel_thr)
-            result[str(index)] = [best_thr, best_pixel_thr, score]
-        del train_loader_stage2, val_loader_stage2
+            # 各阶段使用的样本，all为全部样本，mask为只包含有掩膜的样本
+            folds.append({
+                'all': (train_image_stage1 + train_image, train_mask_stage1 + train_mask, val_image_stage1 + val_image, val_mask_stage1 + val_mask),
+                'mask': (train_image_mask_stage1 + train_image_mask, train_mask_mask_stage1 + train_mask_mask, val_image_mask_stage1 + val_image_mask, val_mask_mask_stage1 + val_mask_mask),
+            })
+        if config.split_file and is_main_process():
+            save_split(config.split_file, folds)
+    if config.mode == 'split':
+        return
+
+    result = {}
+    schedule = get_stage_schedule(config)
+    if config.shard_root:
+        # 将各阶段分辨率下的样本和掩膜预先解码到内存映射的分片中，只需要构建一次
+        if is_main_process():
+            build_shards(images_path_stage1 + images_path, masks_path_stage1 + masks_path, config.shard_root, sorted(set(x['image_size'] for x in schedule)), config.num_workers)
+        barrier()
+    # 所有折、所有阶段共用一个数据加载器和一个模型，worker进程只创建一次，模型和预训练权重也只加载一次
+    stage_loader = StageLoader(images_path_stage1 + images_path, masks_path_stage1 + masks_path, config.num_workers, get_rank(), get_world_size(), config.shard_root,
+                               os.path.join(config.save_path, 'augmentation_timing' + folds_suffix(config.folds)) if config.augmentation_timing else '',
+                               AUG if config.virtual_aug else (), config.virtual_aug_seed)
+    if config.auto_batch and 'choose_threshold' not in config.mode:
+        # 在当前设备上试探各阶段能放下的最大batch size，结果会缓存下来，下次直接读取；
+        # 分布式模式下由主进程试探，其它进程直接读取缓存，得到的是每一张卡上的batch size
+        if not is_main_process():
+            barrier()
+        planner = BatchPlanner(os.path.join(config.model_path, 'batch_plan.json'), config.batch_headroom)
+        effective_batch_sizes = {1: config.effective_batch_size_stage1, 2: config.effective_batch_size_stage2, 3: config.effective_batch_size_stage2}
+        schedule = planner.plan_schedule(schedule, config, effective_batch_sizes)
+        if is_main_process():
+            barrier()
+    solver = Train(config, schedule=schedule)
+    for index, samples in enumerate(folds):
+        # 只训练指定的折，为空时训练所有折
+        if config.folds and index not in config.folds:
+            print("Fold {} passed".format(index))
+            continue
+        # 恢复初始权重，开始新的一折
+        solver.reset_fold(index)
 
-        # 对于第三个阶段的处理方法
-        # 第三阶段和第二阶段使用的图片大小一致，最大batch_size一致
-        train_loader_stage3, val_loader_stage3 = get_loader(train_image_mask_stage1 + train_image_mask, train_mask_mask_stage1 + train_mask_mask, val_image_mask_stage1 + val_image_mask, val_mask_mask_stage1 + val_mask_mask, config.image_size_stage2,
-                                    config.batch_size_stage2, config.num_workers, config.stage3_augmentation_flag, weights_sample=config.weight_sample)
-        # 更新类的训练集以及验证集
-        solver.train_loader, solver.valid_loader = train_loader_stage3, val_loader_stage3        
-        # 针对不同mode，在第三阶段的处理方式
-        if config.mode == 'train' or config.mode == 'train_stage3' or config.mode == 'train_stage23':
-            solver.train_stage3(index)
-            # solver.get_dice_onval(os.path.join(config.save_path, '%s_%d_%d_best.pth' % (config.model_type, 3, index)), 0.67, 2048)
-        elif config.mode == 'choose_threshold3':
-            # solver.pred_mask_count(os.path.join(config.save_path, '%s_%d_%d_best.pth' % (config.model_type, 3, index)), masks_bool_mask, val_index_mask, 0.67, 0)
-            best_thr, best_pixel_thr, score = solver.choose_threshold(os.path.join(config.save_path, '%s_%d_%d_best.pth' % (config.model_type, 3, index)), index)
-            scores.append(score)
-            best_thrs.append(best_thr)
-            best_pixel_thrs.append(best_pixel_thr)
-            result[str(index)] = [best_thr, best_pixel_thr, score]
+        for stage_config in schedule:
+            stage = stage_config['stage']
+            train_stage = stage in TRAIN_MODE_STAGES.get(config.mode, [])
+            choose_threshold = config.mode == 'choose_threshold%d' % stage
+            if not train_stage and not choose_threshold:
+                continue
+            # 更新类的训练集以及验证集
+            solver.train_loader, solver.valid_loader = stage_loader.get_loaders(*samples[stage_config['sample_filter']], stage_config['image_size'],
+                                    stage_config['batch_size'], stage_config['augmentation_flag'] and stage_config.get('augmentation', 'default'),
+                                    weights_sample=config.weight_sample)
+            # 针对不同mode，在各阶段的处理方式
+            if train_stage:
+                solver.train_stage(stage_config, index)
+                # 各数据增强变换在所有worker中累计的耗时
+                timings = stage_loader.augmentation_timings()
+                if timings and is_main_process():
+                    print(timings)
+                    solver.telemetry.log(timings)
+            else:
+                model_path = os.path.join(config.save_path, '%s_%d_%d_best.pth' % (config.model_type, stage, index))
+                if stage_config.get('threshold_search', 'linear') == 'grid':
+                    best_thr, best_pixel_thr, score = solver.choose_threshold_grid(model_path, index)
+                else:
+                    best_thr, best_pixel_thr, score = solver.choose_threshold(model_path, index)
+                scores.append(score)
+                best_thrs.append(best_thr)
+                best_pixel_thrs.append(best_pixel_thr)
+                result[str(index)] = [best_thr, best_pixel_thr, score]
 
     # 若为选阈值操作，则输出n_fold折验证集结果的平均值
     if 'choose_threshold' in config.mode:
@@ -184,6 +175,9 @@ def main(config):
         with codecs.open(config.save_path + '/result_stage{}.json'.format(config.mode[-1]), 'w', "utf-8") as json_file:
             json.dump(result, json_file, ensure_ascii=False)
         print('save the result')
+    # 写完缓冲的日志，结束异步验证的进程
+    solver.close()
+    cleanup()
 
 
 if __name__ == '__main__':
@@ -198,6 +192,7 @@ if __name__ == '__main__':
         '''
         第一阶段为768，第二阶段为1024，unet_resnet34时各个电脑可以设置的最大batch size
         zdaiot:10,6 z840:12,6 mxq:20,10
+        也可以使用--auto_batch在当前设备上自动试探
         '''
         parser.add_argument('--image_size_stage1', type=int, default=768, help='image size in the first stage')
         parser.add_argument('--batch_size_stage1', type=int, default=12, help='batch size in the first stage')
@@ -216,22 +211,55 @@ if __name__ == '__main__':
         parser.add_argument('--stage1_augmentation_flag', type=bool, default=True, help='if true, use augmentation method in stage1 train set')
         parser.add_argument('--stage2_augmentation_flag', type=bool, default=True, help='if true, use augmentation method in stage2 train set')
         parser.add_argument('--stage3_augmentation_flag', type=bool, default=True, help='if true, use augmentation method in stage3 train set')
+        parser.add_argument('--stage1_augmentation', type=str, default='default', choices=list(PIPELINES) + [DEVICE_AUGMENTATION], help='augmentation pipeline of stage1 train set, device: augment on the training device in batches')
+        parser.add_argument('--stage2_augmentation', type=str, default='default', choices=list(PIPELINES) + [DEVICE_AUGMENTATION], help='augmentation pipeline of stage2 train set, device: augment on the training device in batches')
+        parser.add_argument('--stage3_augmentation', type=str, default='default', choices=list(PIPELINES) + [DEVICE_AUGMENTATION], help='augmentation pipeline of stage3 train set, device: augment on the training device in batches')
+        parser.add_argument('--augmentation_timing', action='store_true', help='if true, record the cumulative time of each augmentation transform in the workers and log it after each stage')
         parser.add_argument('--n_splits', type=int, default=5, help='n_splits_fold')
+        parser.add_argument('--amp', action='store_true', help='if true, use mixed precision (float16 on GPU, bfloat16 on CPU) in training')
+        parser.add_argument('--stage_schedule', type=str, default='', help='if has value, read the stage schedule (a json list, one dict per stage) from this file')
+        parser.add_argument('--checkpoint_mode', type=str, default='none', choices=['none', 'decoder', 'encoder', 'all'],
+                            help='activation checkpointing (recompute activations in backward to save memory), used in the stages whose schedule enables it')
+        parser.add_argument('--auto_batch', action='store_true', help='if true, probe the max batch size of each stage on this device instead of using batch_size_stage1/2')
+        parser.add_argument('--effective_batch_size_stage1', type=int, default=0, help='with auto_batch, accumulate gradients to reach this batch size in stage1, 0 means no accumulation')
+        parser.add_argument('--effective_batch_size_stage2', type=int, default=0, help='with auto_batch, accumulate gradients to reach this batch size in stage2 and stage3, 0 means no accumulation')
+        parser.add_argument('--keep_last_units', type=int, default=0, help='keep the last-epoch checkpoints of only this many recent (stage, fold), best checkpoints are always kept, 0 keeps all; only the units trained by this run are removed')
+        parser.add_argument('--shard_root', type=str, default='', help='if has value, read the samples from memory-mapped shards in this folder (built at the first run)')
+        parser.add_argument('--virtual_aug', action='store_true', help='if true, expand the train set with the AUG transforms of datasets/aug_dataset.py applied on the fly, instead of saving augmented copies')
+        parser.add_argument('--virtual_aug_seed', type=int, default=0, help='seed of the virtual augmentation, the same seed as dataset_aug gives the same samples')
+        parser.add_argument('--folds', type=int, nargs='*', default=[], help='which folds to run, all folds if empty')
+        parser.add_argument('--split_file', type=str, default='', help='if has value, load the folds from this json file (or compute and save them if it does not exist)')
+        parser.add_argument('--dist_backend', type=str, default='', help='backend of distributed training launched by torchrun, nccl on gpu and gloo on cpu by default')
+        parser.add_argument('--log_interval', type=int, default=20, help='sync the train loss and update the progress bar every this many steps')
+        parser.add_argument('--telemetry_flush_interval', type=float, default=10, help='seconds between two writes of the buffered scalars and logs (tensorboard, telemetry.jsonl and log.txt)')
+        parser.add_argument('--profile', action='store_true', help='if true, time each phase of the train steps (with device synchronization) and report p50/p95/p99 per epoch')
+        parser.add_argument('--profile_trace_start', type=int, default=10, help='with profile, the first step of each stage written to the chrome trace')
+        parser.add_argument('--profile_trace_steps', type=int, default=20, help='with profile, how many steps are written to the chrome trace, 0 means no trace')
+        parser.add_argument('--compile', action='store_true', help='if true, compile the model with torch.compile (falls back to eager if compiling fails), artifacts are cached in model_path/compile_cache')
+        parser.add_argument('--compile_mode', type=str, default='default', choices=['default', 'reduce-overhead', 'max-autotune', 'max-autotune-no-cudagraphs'], help='mode of torch.compile')
+        parser.add_argument('--feature_cache', type=str, default='', help='if has value, cache the encoder features in this folder during the epochs with frozen encoder and no augmentation')
+        parser.add_argument('--feature_cache_max_gb', type=float, default=100, help='do not cache the encoder features if they need more disk space than this')
+        parser.add_argument('--step_checkpoint_interval', type=int, default=0, help='save a mid-epoch checkpoint (model_type_stage_fold_step.pth) every this many steps to resume from the exact batch, 0 means only at the end of epochs')
+        parser.add_argument('--async_validation', type=str, default='',
+                            help='validate the checkpoint of every epoch in a separate process on this device (e.g. cuda:1 or cpu) while training continues, empty to validate in place')
+        parser.add_argument('--async_validation_threads', type=int, default=4, help='cpu threads of the async validation process')
+        parser.add_argument('--batch_headroom', type=float, default=0.1, help='with auto_batch, the fraction of gpu memory kept free')
 
         # model set 
         parser.add_argument('--resume', type=str, default='', help='if has value, must be the name of Weight file.')
         '''mode可选值 没有考虑各自阶段训练到一半重新加载的情况，因为学习率为余弦衰减，不可控 TODO
-        train: 训练所有阶段, resume必须为空
-        train_stage1: 只训练第一阶段, resume必须为空
+        train: 训练所有阶段, resume为空时从头训练，也可以为第一阶段的权重(包括epoch中间的权重)，从中断处继续
+        train_stage1: 只训练第一阶段, resume同train
         train_stage2: 只训练第二阶段，resume不能为空
         train_stage3: 只训练第三阶段，resume不能为空
         train_stage23: 只训练第二和第三阶段，resume不能为空
         choose_threshold1: 只选第一阶段的阈值
         choose_threshold2: 只选第二阶段的阈值
         choose_threshold3: 只选第三阶段的阈值
+        split: 只计算交叉验证的划分并保存到split_file
         '''
         parser.add_argument('--mode', type=str, default='train', \
-            help='train/train_stage1/train_stage2/train_stage3/train_stage23/choose_threshold1/choose_threshold2/choose_threshold3.')
+            help='train/train_stage1/train_stage2/train_stage3/train_stage23/choose_threshold1/choose_threshold2/choose_threshold3/split.')
         parser.add_argument('--model_type', type=str, default='unet_resnet34', \
             help='U_Net/R2U_Net/AttU_Net/R2AttU_Net/unet_resnet34/linknet/deeplabv3plus/pspnet_resnet34/unet_se_resnext50_32x4d/unet_densenet121')
 
@@ -257,6 +285,4 @@ if __name__ == '__main__':
 
     if config.mode == 'train_stage2' or config.mode == 'train_stage3' or config.mode == 'train_stage23':
         assert config.resume != ''
-    elif config.mode == 'train' or config.mode == 'train_stage1':
-        assert config.resume == ''
     main(config)
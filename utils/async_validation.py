@@ -0,0 +1,154 @@
+import time
+import queue
+import traceback
+from collections import OrderedDict
+import torch
+import torch.multiprocessing as mp
+
+
+def valid_samples(valid_loader):
+    """验证集的图片路径和掩膜路径，评估进程依据它们重新构建验证集
+    """
+    if hasattr(valid_loader, 'stage_loader'):
+        dataset = valid_loader.stage_loader.dataset
+        return list(valid_loader.image_names), [dataset.mask_names[index] for index in valid_loader.indices]
+    return list(valid_loader.dataset.image_names), list(valid_loader.dataset.mask_names)
+
+
+def evaluator_main(tasks, results, model_type, output_ch, t, ledger_root, device, amp, num_threads):
+    """评估进程：依次读取每一个epoch的权重，在验证集上计算损失和dice、写入账本，并判断是否为当前阶段的最优权重
+
+    进程以daemon方式运行，不能再创建DataLoader的worker，因此在本进程中读取图片
+    """
+    # 在子进程中导入，避免solver与本模块循环导入
+    from solver import get_model, evaluate, LOSSES
+    from datasets.siim import SIIMDataset
+    from utils.eval_ledger import EvalLedger, LedgerRecorder, image_ids_of
+
+    device = torch.device(device)
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
+    torch.set_num_threads(num_threads)
+    # 每一个epoch都加载训练进程的权重，不需要(也不一定能在离线的节点上)加载预训练权重
+    model = get_model(model_type, output_ch, t, pretrained=False).to(device)
+    ledger = EvalLedger(ledger_root)
+    criterions = dict()
+    loaders = dict()
+    # 各(阶段, 折)当前的最优dice
+    max_dices = dict()
+
+    while True:
+        message = tasks.get()
+        if message is None:
+            return
+        kind, task = message
+        key = (task['stage'], task['index'])
+        if kind == 'start':
+            max_dices[key] = task['max_dice']
+            continue
+        try:
+            model.load_state_dict(task['state_dict'])
+            model.eval()
+            samples = (tuple(task['images']), task['image_size'], task['batch_size'])
+            if samples not in loaders:
+                # 每一个阶段每一折的验证集只构建一次
+                loaders.clear()
+                dataset = SIIMDataset(task['images'], task['masks'], task['image_size'], augmentation_flag=False)
+                loaders[samples] = torch.utils.data.DataLoader(dataset, batch_size=task['batch_size'], shuffle=False)
+            if task['loss'] not in criterions:
+                criterions[task['loss']] = LOSSES[task['loss']]().to(device)
+
+            recorder = LedgerRecorder(ledger, task['name'], task['index'], task['stage'], 0.5)
+            loss_mean, dice_mean = evaluate(model, loaders[samples], criterions[task['loss']], device, amp, recorder,
+                                            image_ids_of(task['images']), progress=False)
+            is_best = dice_mean > max_dices.get(key, 0)
+            if is_best:
+                max_dices[key] = dice_mean
+                ledger.promote(task['name'], task['name'] + '_best')
+            results.put({'stage': task['stage'], 'index': task['index'], 'epoch': task['epoch'],
+                         'loss': loss_mean, 'dice': dice_mean, 'is_best': is_best})
+        except Exception:
+            results.put({'stage': task['stage'], 'index': task['index'], 'epoch': task['epoch'], 'error': traceback.format_exc()})
+
+
+class AsyncValidator(object):
+    """在单独的进程(另一张卡或者CPU)中验证每一个epoch的权重，训练进程不需要等待验证，直接开始下一个epoch
+
+    权重通过共享内存传给评估进程；评估进程只有一个，按照提交的顺序依次验证，因此结果也按照epoch的顺序返回，
+    训练进程在poll时按顺序合并到TensorBoard和最优权重的记录中
+    """
+    def __init__(self, model_type, output_ch, t, ledger_root, device, amp=False, num_threads=4, max_pending=2):
+        """
+        Args:
+            model_type, output_ch, t: 与get_model的参数一致，评估进程中构建同样的模型
+            ledger_root: 逐图片评估结果的账本目录
+            device: 评估进程使用的设备，例如cuda:1或者cpu
+            amp: 验证时是否使用混合精度
+            num_threads: 评估进程使用的CPU线程数
+            max_pending: 最多有多少个epoch等待验证，超过时submit会等待最早的结果，避免验证跟不上训练时占用过多内存
+        """
+        self.max_pending = max_pending
+        context = mp.get_context('spawn')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        # 已经提交、还没有返回结果的epoch，值为训练进程保留的完整权重，成为最优时保存
+        self.pending = OrderedDict()
+        self.process = context.Process(target=evaluator_main, daemon=True,
+                                       args=(self.tasks, self.results, model_type, output_ch, t, ledger_root, device, amp, num_threads))
+        self.process.start()
+
+    def start_stage(self, stage, index, max_dice=0):
+        """开始训练一个阶段时调用，从头训练时max_dice为0，继续训练时为权重中记录的最优dice
+        """
+        self.tasks.put(('start', {'stage': stage, 'index': index, 'max_dice': max_dice}))
+
+    def submit(self, task, state):
+        """提交一个epoch的权重，必要时等待较早的结果
+
+        Args:
+            task: 包含stage, index, epoch, name(账本名), state_dict(CPU上的模型参数), images, masks, image_size, batch_size, loss
+            state: 该epoch完整的权重，成为最优时由训练进程保存
+        Return:
+            为了不超过max_pending而等到的结果，[(result, state), ...]
+        """
+        task['state_dict'] = {key: value.share_memory_() for key, value in task['state_dict'].items()}
+        self.tasks.put(('evaluate', task))
+        self.pending[(task['stage'], task['index'], task['epoch'])] = state
+        return self.poll(max_pending=self.max_pending)
+
+    def get(self, block):
+        while True:
+            try:
+                return self.results.get(block=block, timeout=1. if block else None)
+            except queue.Empty:
+                if not block:
+                    return None
+                if not self.process.is_alive():
+                    raise RuntimeError('The async validation process exited with code {}'.format(self.process.exitcode))
+
+    def poll(self, max_pending=None):
+        """按照提交的顺序取回已经完成的结果
+
+        Args:
+            max_pending: 为None时只取回已经完成的结果，否则等待到未完成的epoch不超过max_pending个，为0时等待全部完成
+        Return:
+            [(result, state), ...]，result包含stage, index, epoch, loss, dice, is_best
+        """
+        merged = list()
+        while self.pending:
+            block = max_pending is not None and len(self.pending) > max_pending
+            result = self.get(block)
+            if result is None:
+                break
+            key, state = self.pending.popitem(last=False)
+            if 'error' in result:
+                raise RuntimeError('Async validation of stage {} fold {} epoch {} failed:\n{}'.format(
+                    result['stage'], result['index'], result['epoch'], result['error']))
+            assert key == (result['stage'], result['index'], result['epoch'])
+            merged.append((result, state))
+        return merged
+
+    def close(self):
+        if self.process.is_alive():
+            self.tasks.put(None)
+            self.process.join(timeout=60)
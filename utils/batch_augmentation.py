@@ -0,0 +1,243 @@
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+# 增强方法的名称：worker中不进行增强，以uint8的批次传到训练设备上，由BatchAugmentation增强并归一化
+DEVICE_AUGMENTATION = 'device'
+
+
+def batch_seed(*values):
+    """由(阶段, 折, epoch, 步数, 进程序号)等整数得到一个批次的随机种子，从epoch中间继续训练时增强结果不变
+    """
+    return int(np.random.SeedSequence([int(value) for value in values]).generate_state(1)[0])
+
+
+def clahe(images, clip_limits, grid=8):
+    """批量的限制对比度自适应直方图均衡化，与cv2.createCLAHE一致：每一个tile的直方图截断后求累积分布得到查找表，
+    像素值由相邻四个tile的查找表双线性插值得到
+
+    Args:
+        images: [B, H, W]，取值0~255的float
+        clip_limits: [B]，各图片的clip limit
+    Return:
+        与images形状相同，取值0~255
+    """
+    batch_size, height, width = images.shape
+    pad_h, pad_w = (-height) % grid, (-width) % grid
+    values = images.round().clamp(0, 255)
+    padded = values
+    if pad_h or pad_w:
+        padded = F.pad(values.unsqueeze(1), (0, pad_w, 0, pad_h), mode='reflect').squeeze(1)
+    tile_h, tile_w = (height + pad_h) // grid, (width + pad_w) // grid
+    tiles = padded.long().view(batch_size, grid, tile_h, grid, tile_w).permute(0, 1, 3, 2, 4).reshape(batch_size, grid * grid, -1)
+    hist = images.new_zeros(batch_size, grid * grid, 256).scatter_add_(2, tiles, images.new_ones(tiles.shape))
+
+    # 截断直方图，超出的部分平均分配到所有灰度级
+    limit = (clip_limits * tile_h * tile_w / 256.).clamp(min=1).view(batch_size, 1, 1)
+    excess = (hist - limit).clamp(min=0).sum(-1, keepdim=True)
+    hist = torch.min(hist, limit) + excess / 256.
+    lut = (hist.cumsum(-1) * (255. / (tile_h * tile_w))).clamp(0, 255).view(batch_size, -1)
+
+    # 各像素相对于tile中心的位置
+    def neighbours(size, tile_size):
+        position = (torch.arange(size, device=images.device, dtype=images.dtype) + 0.5) / tile_size - 0.5
+        low = position.floor()
+        weight = position - low
+        return low.clamp(0, grid - 1).long(), (low + 1).clamp(0, grid - 1).long(), weight
+
+    y0, y1, wy = neighbours(height, tile_h)
+    x0, x1, wx = neighbours(width, tile_w)
+    values = values.long().view(batch_size, -1)
+
+    def lookup(ty, tx):
+        index = ((ty.view(-1, 1) * grid + tx.view(1, -1)) * 256).view(1, -1) + values
+        return lut.gather(1, index).view(batch_size, height, width)
+
+    wy, wx = wy.view(1, -1, 1), wx.view(1, 1, -1)
+    top = lookup(y0, x0) * (1 - wx) + lookup(y0, x1) * wx
+    bottom = lookup(y1, x0) * (1 - wx) + lookup(y1, x1) * wx
+    return top * (1 - wy) + bottom * wy
+
+
+def median_blur3(images):
+    """3x3中值滤波，images为[B, C, H, W]
+    """
+    batch_size, channels, height, width = images.shape
+    patches = F.unfold(F.pad(images, (1, 1, 1, 1), mode='reflect'), 3)
+    return patches.view(batch_size, channels, 9, height * width).median(dim=2)[0].view(batch_size, channels, height, width)
+
+
+def motion_kernels(sizes, angles, max_size):
+    """运动模糊的卷积核：过中心、方向为angle、长度为size的线段，归一化后放在max_size×max_size的核中
+
+    Return:
+        [B, max_size, max_size]
+    """
+    kernels = torch.zeros(len(sizes), max_size, max_size)
+    center = max_size // 2
+    for index, (size, angle) in enumerate(zip(sizes, angles)):
+        steps = torch.linspace(-(size - 1) / 2., (size - 1) / 2., 2 * size)
+        rows = (center + steps * math.sin(angle)).round().long().clamp(0, max_size - 1)
+        cols = (center + steps * math.cos(angle)).round().long().clamp(0, max_size - 1)
+        kernels[index, rows, cols] = 1.
+    return kernels / kernels.sum((1, 2), keepdim=True)
+
+
+class BatchAugmentation(object):
+    """在训练设备上批量地对样本和掩膜进行数据增强，与utils.data_augmentation中的default一致：
+
+        几何变换(水平翻转、旋转)合并为一个仿射矩阵，样本和掩膜使用同一个grid_sample的采样网格，样本双线性插值、掩膜最近邻；
+        光度变换(CLAHE、gamma、亮度对比度、模糊、高斯噪声)为批量的张量运算，只对被选中的样本计算
+
+    随机参数由CPU上以seed初始化的生成器产生，噪声由设备上以同一个seed初始化的生成器产生，同一个seed在同一种设备上结果相同
+    """
+    def __init__(self, flip_p=0.4, rotate_p=0.4, rotate_limit=15, clahe_p=0.4, clahe_clip=(1., 4.), clahe_grid=8,
+                 gamma_p=0.1, gamma_limit=(80, 120), brightness_contrast_p=0.1, brightness_limit=0.2, contrast_limit=0.2,
+                 blur_p=0.3, motion_blur_limit=7, noise_p=0.2, noise_var=(10., 50.),
+                 mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        self.flip_p = flip_p
+        self.rotate_p = rotate_p
+        self.rotate_limit = rotate_limit
+        self.clahe_p = clahe_p
+        self.clahe_clip = clahe_clip
+        self.clahe_grid = clahe_grid
+        self.gamma_p = gamma_p
+        self.gamma_limit = gamma_limit
+        self.brightness_contrast_p = brightness_contrast_p
+        self.brightness_limit = brightness_limit
+        self.contrast_limit = contrast_limit
+        self.blur_p = blur_p
+        self.motion_blur_limit = motion_blur_limit
+        self.noise_p = noise_p
+        self.noise_var = noise_var
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+
+    def __call__(self, images, masks, seed):
+        """增强并归一化，得到模型的输入
+
+        Args:
+            images: [N, H, W]或者[N, C, H, W]，uint8，C为1(灰度图)或3
+            masks: [N, H, W]，uint8，值为0/255
+            seed: 随机种子
+        Return:
+            images: [N, 3, H, W]，与SIIMDataset中的Normalize一致
+            masks: [N, H, W]，float，值为0/1
+        """
+        images, masks = self.augment(images, masks, seed)
+        mean, std = self.mean.to(images.device), self.std.to(images.device)
+        return (images / 255. - mean) / std, (masks.float() / 256.).round()
+
+    def augment(self, images, masks, seed):
+        """
+        Return:
+            images: [N, C, H, W]，float，取值0~255
+            masks: [N, H, W]，uint8，值为0/255
+        """
+        if images.dim() == 3:
+            images = images.unsqueeze(1)
+        # 之后的变换原地修改被选中的样本
+        images = images.to(dtype=torch.float32, copy=True)
+        device = images.device
+        generator = torch.Generator().manual_seed(seed)
+        device_generator = torch.Generator(device=device).manual_seed(seed)
+        batch_size, channels, height, width = images.shape
+
+        def uniform(low, high, size=batch_size):
+            return torch.rand(size, generator=generator) * (high - low) + low
+
+        def chosen(p):
+            return torch.rand(batch_size, generator=generator) < p
+
+        # 几何变换
+        flip, rotate = chosen(self.flip_p), chosen(self.rotate_p)
+        angles = torch.where(rotate, uniform(-self.rotate_limit, self.rotate_limit), torch.zeros(batch_size)) * math.pi / 180
+        geometric = (flip | rotate).nonzero().view(-1)
+        if len(geometric):
+            cos, sin = angles.cos(), angles.sin()
+            # 归一化坐标下的旋转，需要考虑宽高比；翻转即输出的x坐标取反后再旋转
+            sign = torch.where(flip, -torch.ones(batch_size), torch.ones(batch_size))
+            theta = torch.zeros(batch_size, 2, 3)
+            theta[:, 0, 0], theta[:, 0, 1] = cos * sign, -sin * height / width
+            theta[:, 1, 0], theta[:, 1, 1] = sin * sign * width / height, cos
+            theta = theta[geometric].to(device)
+            grid = F.affine_grid(theta, [len(geometric), channels, height, width], align_corners=False)
+            masks = masks.clone()
+            images[geometric] = F.grid_sample(images[geometric], grid, mode='bilinear', padding_mode='reflection', align_corners=False)
+            masks[geometric] = F.grid_sample(masks[geometric].unsqueeze(1).float(), grid, mode='nearest',
+                                             padding_mode='reflection', align_corners=False).squeeze(1).to(masks.dtype)
+
+        # 直方图均衡化，各通道分别进行
+        index = chosen(self.clahe_p).nonzero().view(-1)
+        clip_limits = uniform(*self.clahe_clip)
+        if len(index):
+            selected = images[index].view(-1, height, width)
+            limits = clip_limits[index].repeat_interleave(channels).to(device)
+            images[index] = clahe(selected, limits, self.clahe_grid).view(len(index), channels, height, width)
+
+        # gamma
+        index = chosen(self.gamma_p).nonzero().view(-1)
+        gammas = uniform(self.gamma_limit[0] / 100., self.gamma_limit[1] / 100.)
+        if len(index):
+            images[index] = 255. * (images[index] / 255.).pow(gammas[index].to(device).view(-1, 1, 1, 1))
+
+        # 亮度、对比度
+        index = chosen(self.brightness_contrast_p).nonzero().view(-1)
+        alphas = 1. + uniform(-self.contrast_limit, self.contrast_limit)
+        betas = uniform(-self.brightness_limit, self.brightness_limit) * 255.
+        if len(index):
+            images[index] = (images[index] * alphas[index].to(device).view(-1, 1, 1, 1) +
+                             betas[index].to(device).view(-1, 1, 1, 1)).clamp(0, 255)
+
+        # 模糊：运动模糊、中值滤波、均值滤波三选一
+        blur = chosen(self.blur_p)
+        kinds = torch.randint(0, 3, (batch_size,), generator=generator)
+        sizes = torch.randint(1, self.motion_blur_limit // 2 + 1, (batch_size,), generator=generator) * 2 + 1
+        motion_angles = uniform(0, math.pi)
+        index = (blur & (kinds == 0)).nonzero().view(-1)
+        if len(index):
+            max_size = int(sizes[index].max())
+            kernels = motion_kernels(sizes[index].tolist(), motion_angles[index].tolist(), max_size).to(device)
+            selected = F.pad(images[index].view(1, -1, height, width), [max_size // 2] * 4, mode='reflect')
+            weight = kernels.repeat_interleave(channels, 0).unsqueeze(1)
+            images[index] = F.conv2d(selected, weight, groups=len(index) * channels).view(len(index), channels, height, width)
+        index = (blur & (kinds == 1)).nonzero().view(-1)
+        if len(index):
+            images[index] = median_blur3(images[index])
+        index = (blur & (kinds == 2)).nonzero().view(-1)
+        if len(index):
+            images[index] = F.avg_pool2d(F.pad(images[index], (1, 1, 1, 1), mode='reflect'), 3, 1)
+
+        # 高斯噪声，方差以像素值为单位
+        index = chosen(self.noise_p).nonzero().view(-1)
+        sigmas = uniform(*self.noise_var).sqrt()
+        if len(index):
+            noise = torch.randn(images[index].shape, generator=device_generator, device=device)
+            images[index] = (images[index] + noise * sigmas[index].to(device).view(-1, 1, 1, 1)).clamp(0, 255)
+
+        return images, masks
+
+
+class BatchAugmentationTransform(object):
+    """以albumentations变换的方式调用BatchAugmentation，一次增强一个样本，可以代替data_augmentation在worker中使用
+
+    随机种子取自np.random，SIIMStageDataset按照采样器给出的种子设置了np.random，因此结果可以复现
+    """
+    def __init__(self, augmentation=None):
+        self.augmentation = augmentation or BatchAugmentation()
+
+    def __call__(self, image, mask):
+        """
+        Args:
+            image: [H, W, C]或者[H, W]，uint8
+            mask: [H, W]，uint8
+        """
+        seed = int(np.random.randint(0, 2 ** 31 - 1))
+        image_tensor = torch.from_numpy(np.ascontiguousarray(image))
+        image_tensor = image_tensor.permute(2, 0, 1) if image_tensor.dim() == 3 else image_tensor.unsqueeze(0)
+        images, masks = self.augmentation.augment(image_tensor.unsqueeze(0), torch.from_numpy(np.ascontiguousarray(mask)).unsqueeze(0), seed)
+        image_aug = images[0].round().clamp(0, 255).byte()
+        image_aug = image_aug.permute(1, 2, 0) if image.ndim == 3 else image_aug[0]
+        return {'image': image_aug.numpy(), 'mask': masks[0].numpy()}
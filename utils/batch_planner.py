@@ -0,0 +1,218 @@
+import os
+import json
+import math
+import fcntl
+import argparse
+import torch
+from solver import get_model, LOSSES
+from utils.benchmark import train_step_benchmark
+from models.activation_checkpoint import apply_activation_checkpoint
+from utils.distributed import is_distributed, get_world_size
+
+
+def device_name(device):
+    """缓存的键中使用的设备名，GPU上包含型号和显存大小
+    """
+    if device.type == 'cuda':
+        properties = torch.cuda.get_device_properties(device)
+        return '{}_{}MB'.format(properties.name, properties.total_memory // 1024 ** 2)
+    return 'cpu'
+
+
+def try_batch_size(model_type, device, image_size, batch_size, amp=False, checkpoint_mode='none', loss='soft_bce_dice'):
+    """以batch_size跑一个完整的训练step，使用该阶段的损失函数(LOSSES中的键)，lovasz等损失函数的显存占用不同
+
+    Return:
+        peak_memory_mb: 显存峰值，显存不足时为None
+    """
+    model = get_model(model_type).to(device)
+    apply_activation_checkpoint(model, checkpoint_mode)
+    criterion = LOSSES[loss]().to(device)
+    try:
+        result = train_step_benchmark(model, criterion, device, image_size, batch_size, amp, steps=1, warmup=1)
+        peak_memory_mb = result['peak_memory_mb']
+    except RuntimeError as e:
+        if 'out of memory' not in str(e):
+            raise
+        peak_memory_mb = None
+    del model, criterion
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+    return peak_memory_mb
+
+
+def probe_max_batch_size(model_type, device, image_size, amp=False, checkpoint_mode='none', headroom=0.1, max_batch_size=64,
+                         loss='soft_bce_dice'):
+    """在当前设备上试探能放下的最大batch size：先倍增找到上界，再二分
+
+    Args:
+        headroom: 预留的显存比例，显存峰值超过(1-headroom)*总显存视为放不下
+        max_batch_size: 试探的上限
+        loss: 训练时使用的损失函数，LOSSES中的键
+    Return:
+        一张卡上的最大batch size；CPU上无法得到显存峰值，返回None
+    """
+    if device.type != 'cuda':
+        return None
+    memory_limit = (1 - headroom) * torch.cuda.get_device_properties(device).total_memory / 1024 ** 2
+
+    def fits(batch_size):
+        peak_memory_mb = try_batch_size(model_type, device, image_size, batch_size, amp, checkpoint_mode, loss)
+        fit = peak_memory_mb is not None and peak_memory_mb <= memory_limit
+        print('batch size: {}, peak memory: {}, fits: {}'.format(batch_size, peak_memory_mb, fit))
+        return fit
+
+    good, bad = 0, None
+    batch_size = 1
+    while batch_size <= max_batch_size:
+        if fits(batch_size):
+            good = batch_size
+            batch_size *= 2
+        else:
+            bad = batch_size
+            break
+    if bad is None:
+        if good == max_batch_size or fits(max_batch_size):
+            return max_batch_size
+        bad = max_batch_size
+    while bad - good > 1:
+        middle = (good + bad) // 2
+        if fits(middle):
+            good = middle
+        else:
+            bad = middle
+    if good == 0:
+        raise RuntimeError('{} does not fit in memory even with batch size 1 at {}'.format(model_type, image_size))
+    return good
+
+
+def data_parallel_devices(device):
+    """非分布式模式下wrap_model使用DataParallel，一个批次平均分到所有可见的GPU上
+    """
+    if device.type == 'cuda' and not is_distributed():
+        return max(torch.cuda.device_count(), 1)
+    return 1
+
+
+def plan_accumulation(max_batch_size, effective_batch_size=0):
+    """依据能放下的最大batch size得到micro batch size和梯度累加的步数
+
+    Args:
+        max_batch_size: 能放下的最大batch size
+        effective_batch_size: 想要的等效batch size，为0时不进行累加，直接使用最大batch size
+    Return:
+        batch_size, accumulation_steps: micro batch size 以及累加步数，两者之积不小于effective_batch_size
+    """
+    if effective_batch_size <= max_batch_size:
+        return (effective_batch_size or max_batch_size), 1
+    accumulation_steps = int(math.ceil(effective_batch_size / max_batch_size))
+    batch_size = int(math.ceil(effective_batch_size / accumulation_steps))
+    return batch_size, accumulation_steps
+
+
+class BatchPlanner(object):
+    """按(设备, 模型, 分辨率, 精度, 重计算模式, 损失函数)缓存试探出的最大batch size，再次运行时直接读取
+    """
+    def __init__(self, cache_path='./checkpoints/batch_plan.json', headroom=0.1, max_batch_size=64):
+        self.cache_path = cache_path
+        self.headroom = headroom
+        self.max_batch_size = max_batch_size
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.cache = self.load()
+
+    def key(self, model_type, image_size, amp, checkpoint_mode, loss):
+        return '|'.join([device_name(self.device), model_type, str(image_size), 'amp' if amp else 'fp32', checkpoint_mode, loss])
+
+    def max_batch_size_of(self, model_type, image_size, amp=False, checkpoint_mode='none', loss='soft_bce_dice'):
+        """
+        Return:
+            一张卡上的最大batch size，CPU上为None
+        """
+        if self.device.type != 'cuda':
+            return None
+        key = self.key(model_type, image_size, amp, checkpoint_mode, loss)
+        if key not in self.cache:
+            print('Probing the max batch size of {}...'.format(key))
+            self.cache[key] = probe_max_batch_size(model_type, self.device, image_size, amp, checkpoint_mode, self.headroom,
+                                                   self.max_batch_size, loss)
+            self.save(key)
+        return self.cache[key]
+
+    def load(self):
+        if not os.path.exists(self.cache_path):
+            return dict()
+        with open(self.cache_path, 'r') as f:
+            return json.load(f)
+
+    def save(self, key):
+        """并行调度的多个训练进程可能同时试探，在文件锁中读取其它进程已经写入的结果，合并本进程的结果后写入
+        """
+        cache_dir = os.path.dirname(self.cache_path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        with open(self.cache_path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            cache = self.load()
+            cache[key] = self.cache[key]
+            tmp_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(cache, f, indent=2)
+            os.replace(tmp_path, self.cache_path)
+        self.cache.update(cache)
+
+    def plan_schedule(self, schedule, config, effective_batch_sizes=None):
+        """依据试探结果修改训练计划中每一个阶段的batch_size，指定了等效batch size的阶段同时修改accumulation_steps
+
+        Args:
+            schedule: get_stage_schedule返回的训练计划
+            config: 训练配置，使用其中的model_type、amp、checkpoint_mode
+            effective_batch_sizes: dict，各阶段想要的全局等效batch size，缺省或为0时使用最大batch size，
+                保留训练计划中原有的梯度累加设置
+        Return:
+            schedule: 修改后的训练计划，分布式模式下batch_size为每一个进程的batch size
+        """
+        effective_batch_sizes = effective_batch_sizes or dict()
+        # 试探的是一张卡上的结果：DataParallel将批次分到各卡上，能放下的批次相应增大；
+        # 分布式模式下每一个进程一张卡，全局的等效batch size平均分给各个进程
+        devices, world_size = data_parallel_devices(self.device), get_world_size()
+        for stage_config in schedule:
+            checkpoint_mode = config.checkpoint_mode if stage_config.get('activation_checkpoint', False) else 'none'
+            max_batch_size = self.max_batch_size_of(config.model_type, stage_config['image_size'], config.amp, checkpoint_mode,
+                                                    stage_config['loss'])
+            if max_batch_size is None:
+                # CPU上不知道能放下多大的批次，保留训练计划中的batch size，只依据它规划梯度累加
+                max_batch_size = stage_config['batch_size']
+            else:
+                max_batch_size *= devices
+            effective_batch_size = int(math.ceil(effective_batch_sizes.get(stage_config['stage'], 0) / world_size))
+            batch_size, accumulation_steps = plan_accumulation(max_batch_size, effective_batch_size)
+            stage_config['batch_size'] = batch_size
+            if effective_batch_size > 0:
+                stage_config['accumulation_steps'] = accumulation_steps
+                # 需要累加时整个阶段都进行累加
+                stage_config['epoch_accumulation'] = stage_config['epoch'] if accumulation_steps > 1 else 0
+            print('Stage {}: max batch size {}, micro batch size {}, accumulation steps {} in the last {} epochs'.format(
+                stage_config['stage'], max_batch_size, batch_size, stage_config.get('accumulation_steps', 1),
+                stage_config.get('epoch_accumulation', 0)))
+        return schedule
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_type', type=str, default='unet_resnet34')
+    parser.add_argument('--image_size', type=int, default=1024)
+    parser.add_argument('--amp', action='store_true')
+    parser.add_argument('--checkpoint_mode', type=str, default='none')
+    parser.add_argument('--loss', type=str, default='soft_bce_dice', choices=sorted(LOSSES))
+    parser.add_argument('--effective_batch_size', type=int, default=0)
+    parser.add_argument('--headroom', type=float, default=0.1)
+    parser.add_argument('--cache_path', type=str, default='./checkpoints/batch_plan.json')
+    args = parser.parse_args()
+
+    planner = BatchPlanner(args.cache_path, args.headroom)
+    max_batch_size = planner.max_batch_size_of(args.model_type, args.image_size, args.amp, args.checkpoint_mode, args.loss)
+    if max_batch_size is None:
+        parser.exit(message='The max batch size can only be probed on cuda devices.\n')
+    max_batch_size *= data_parallel_devices(planner.device)
+    batch_size, accumulation_steps = plan_accumulation(max_batch_size, args.effective_batch_size)
+    print('max batch size: {}, micro batch size: {}, accumulation steps: {}'.format(max_batch_size, batch_size, accumulation_steps))
@@ -0,0 +1,571 @@
+import argparse
+import os
+import time
+import json
+import numpy as np
+import torch
+from torch import nn
+import torch.nn.functional as F
+from solver import get_model
+from PIL import Image
+from datasets.shards import decode_gray
+from utils.data_augmentation import data_augmentation
+from utils.batch_augmentation import BatchAugmentation
+from utils.radam import RAdam, rectified_step_size
+from utils.loss import SoftBCEDiceLoss, LovaszLoss, DiceLoss, RobustFocalLoss2d, MultiDiceLoss, MultiFocalLoss
+from utils.mixed_precision import autocast, grad_scaler
+from models.activation_checkpoint import CHECKPOINT_MODES, apply_activation_checkpoint
+from utils.torch_compile import compile_model, DEFAULT_CACHE_DIR
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def train_step_benchmark(model, criterion, device, image_size, batch_size, amp=False, steps=10, warmup=3):
+    """测量训练时一个step(前向+损失+反向+优化器更新)的吞吐量和显存峰值
+
+    Args:
+        model: 待测模型
+        criterion: 损失函数
+        device: 设备
+        image_size: 输入图片大小
+        batch_size: batch size
+        amp: 是否使用混合精度
+        steps: 计时的step数目
+        warmup: 预热的step数目，不参与计时
+    Return:
+        result: dict，images_per_second为每秒处理的图片数，peak_memory_mb为显存峰值(CPU上为None)，
+            saved_mb为第一个预热step中为反向保存的张量大小(与设备无关，激活重计算的区域内保存的张量不计入)，没有预热时为None
+    """
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), 1e-4)
+    scaler = grad_scaler(device, enabled=amp)
+    images = torch.randn(batch_size, 3, image_size, image_size, device=device)
+    masks = (torch.rand(batch_size, image_size, image_size, device=device) > 0.99).float()
+
+    def step():
+        optimizer.zero_grad()
+        with autocast(device, enabled=amp):
+            output = model(images)
+            loss = criterion(output.view(batch_size, -1).float(), masks.view(batch_size, -1))
+        if isinstance(loss, (tuple, list)):
+            loss = loss[0]
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
+    saved_mb = None
+    for warmup_step in range(warmup):
+        if warmup_step == 0:
+            hooks, saved = saved_tensor_hooks([images, masks] + list(model.parameters()))
+            with hooks:
+                step()
+            saved_mb = sum(saved.values()) / 1024 ** 2
+        else:
+            step()
+    synchronize(device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+    start = time.time()
+    for _ in range(steps):
+        step()
+    synchronize(device)
+    elapsed = time.time() - start
+
+    peak_memory_mb = None
+    if device.type == 'cuda':
+        peak_memory_mb = torch.cuda.max_memory_allocated(device) / 1024 ** 2
+    return {'images_per_second': steps * batch_size / elapsed, 'peak_memory_mb': peak_memory_mb, 'saved_mb': saved_mb}
+
+
+def benchmark_amp(model_type, image_sizes=(768, 1024), batch_size=2, steps=10, warmup=3):
+    """对比float32和混合精度在不同分辨率下的显存和吞吐量
+    """
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    rows = list()
+    for image_size in image_sizes:
+        for amp in (False, True):
+            model = get_model(model_type, pretrained=False).to(device)
+            criterion = SoftBCEDiceLoss(weight=[0.25, 0.75]).to(device)
+            result = train_step_benchmark(model, criterion, device, image_size, batch_size, amp, steps, warmup)
+            result.update({'model_type': model_type, 'image_size': image_size, 'batch_size': batch_size, 'amp': amp, 'device': str(device)})
+            rows.append(result)
+            del model, criterion
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
+    return rows
+
+
+def benchmark_checkpoint(model_type, image_size=1024, batch_size=16, modes=CHECKPOINT_MODES, amp=False, steps=10, warmup=3):
+    """对比各种激活重计算模式下的显存和吞吐量，显存不足的模式记为oom
+
+    Return:
+        rows: 每一种模式一行，memory_ratio和time_ratio为相对于不重计算时的显存、耗时比例，
+            saved_ratio为为反向保存的张量大小的比例，CPU上没有显存峰值时以它比较
+    """
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    rows = list()
+    for mode in modes:
+        model = get_model(model_type, pretrained=False).to(device)
+        checkpoint_modules = apply_activation_checkpoint(model, mode)
+        criterion = SoftBCEDiceLoss(weight=[0.25, 0.75]).to(device)
+        row = {'model_type': model_type, 'checkpoint_mode': mode, 'checkpoint_modules': len(checkpoint_modules),
+               'image_size': image_size, 'batch_size': batch_size, 'amp': amp, 'device': str(device)}
+        try:
+            row.update(train_step_benchmark(model, criterion, device, image_size, batch_size, amp, steps, warmup))
+        except RuntimeError as e:
+            if 'out of memory' not in str(e):
+                raise
+            row.update({'images_per_second': None, 'peak_memory_mb': 'oom', 'saved_mb': None})
+        rows.append(row)
+        del model, criterion
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    baseline = rows[0] if rows and rows[0]['checkpoint_mode'] == 'none' else None
+    for row in rows:
+        if baseline is None or not row['images_per_second'] or not baseline['images_per_second']:
+            continue
+        row['time_ratio'] = baseline['images_per_second'] / row['images_per_second']
+        if isinstance(row['peak_memory_mb'], float) and isinstance(baseline['peak_memory_mb'], float):
+            row['memory_ratio'] = row['peak_memory_mb'] / baseline['peak_memory_mb']
+        if row['saved_mb'] and baseline['saved_mb']:
+            row['saved_ratio'] = row['saved_mb'] / baseline['saved_mb']
+    return rows
+
+
+def inference_benchmark(model, device, image_size, batch_size, steps=10, warmup=3):
+    """测量推理时的吞吐量，以及第一次前向的耗时(编译时包括编译的时间)
+    """
+    model.eval()
+    images = torch.randn(batch_size, 3, image_size, image_size, device=device)
+    with torch.no_grad():
+        start = time.time()
+        model(images)
+        synchronize(device)
+        first_step_seconds = time.time() - start
+        for _ in range(warmup):
+            model(images)
+        synchronize(device)
+        start = time.time()
+        for _ in range(steps):
+            model(images)
+        synchronize(device)
+    return {'images_per_second': steps * batch_size / (time.time() - start), 'first_step_seconds': first_step_seconds}
+
+
+def benchmark_compile(model_type, image_size=256, batch_size=2, mode='default', device=None, steps=10, warmup=3, cache_dir=DEFAULT_CACHE_DIR):
+    """对比eager和torch.compile在推理、训练时的吞吐量，编译失败时compiled为False，速度与eager相同
+
+    Return:
+        rows: 推理和训练各一行，speedup为编译后相对于eager的加速比
+    """
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    rows = list()
+    for task in ('inference', 'train'):
+        row = {'model_type': model_type, 'task': task, 'mode': mode, 'image_size': image_size, 'batch_size': batch_size, 'device': str(device)}
+        for compiled in (False, True):
+            torch.manual_seed(0)
+            model = get_model(model_type, pretrained=False).to(device)
+            if compiled:
+                row['compiled'] = compile_model(model, model_type, mode, device, cache_dir)
+            if task == 'inference':
+                result = inference_benchmark(model, device, image_size, batch_size, steps, warmup)
+            else:
+                criterion = SoftBCEDiceLoss(weight=[0.25, 0.75]).to(device)
+                start = time.time()
+                # 第一个预热的step包括编译的时间
+                train_step_benchmark(model, criterion, device, image_size, batch_size, steps=1, warmup=0)
+                first_step_seconds = time.time() - start
+                result = train_step_benchmark(model, criterion, device, image_size, batch_size, steps=steps, warmup=warmup)
+                result['first_step_seconds'] = first_step_seconds
+            prefix = 'compiled' if compiled else 'eager'
+            row[prefix + '_images_per_second'] = result['images_per_second']
+            row[prefix + '_first_step_seconds'] = result['first_step_seconds']
+            del model
+        row['speedup'] = row['compiled_images_per_second'] / row['eager_images_per_second']
+        rows.append(row)
+    return rows
+
+
+class OneHotFocalLoss(nn.Module):
+    """RobustFocalLoss2d(sigmoid)原来的实现：拼接(1-prob, prob)后与one-hot的select矩阵相乘，只用于对比
+    """
+    def forward(self, logit, target):
+        target = target.view(-1, 1).long()
+        prob = torch.sigmoid(logit).view(-1, 1)
+        prob = torch.cat((1 - prob, prob), 1)
+        select = prob.new_zeros(len(prob), 2).scatter_(1, target, 1.)
+        class_weight = torch.gather(prob.new_ones(2, 1), 0, target)
+        prob = torch.clamp((prob * select).sum(1).view(-1, 1), 1e-8, 1 - 1e-8)
+        return (-class_weight * torch.clamp((1 - prob) ** 2, 0, 2) * prob.log()).mean()
+
+
+class OneHotMultiDiceLoss(nn.Module):
+    """MultiDiceLoss原来的实现：先对类标进行one-hot编码，再逐类计算DiceLoss，只用于对比
+    """
+    def __init__(self, class_num):
+        super(OneHotMultiDiceLoss, self).__init__()
+        self.class_num = class_num
+        self.dice_loss = DiceLoss()
+
+    def forward(self, input, target):
+        target_oh = F.one_hot(target, self.class_num).permute(0, 3, 1, 2).float()
+        return sum(self.dice_loss(input[:, i], target_oh[:, i]) for i in range(self.class_num))
+
+
+class TransposedMultiFocalLoss(nn.Module):
+    """MultiFocalLoss原来的实现：先将[N, C, H, W]转置拷贝为[N*H*W, C]，只用于对比
+    """
+    def __init__(self, gamma=2):
+        super(TransposedMultiFocalLoss, self).__init__()
+        self.gamma = gamma
+
+    def forward(self, input, target):
+        input = input.view(input.size(0), input.size(1), -1).transpose(1, 2).contiguous().view(-1, input.size(1))
+        logpt = F.log_softmax(input, 1).gather(1, target.view(-1, 1)).view(-1)
+        pt = logpt.detach().exp()
+        return (-1 * (1 - pt) ** self.gamma * logpt).mean()
+
+
+# 损失函数的对比：名称 -> (原始实现, 优化后的实现, 类别数)，类别数为1时输入为展开的二分类logits和掩膜
+LOSS_BENCHMARKS = {
+    'soft_bce_dice': (lambda: SoftBCEDiceLoss(weight=[0.25, 0.75], fused=False), lambda: SoftBCEDiceLoss(weight=[0.25, 0.75]), 1),
+    'lovasz': (lambda: LovaszLoss(batched=False), lambda: LovaszLoss(), 1),
+    # 与完整排序相比的近似误差
+    'lovasz_topk': (lambda: LovaszLoss(), lambda: LovaszLoss(top_k=1 << 16), 1),
+    'focal': (lambda: OneHotFocalLoss(), lambda: RobustFocalLoss2d(), 1),
+    'multi_dice': (lambda: OneHotMultiDiceLoss(4), lambda: MultiDiceLoss(4, None), 4),
+    'multi_focal': (lambda: TransposedMultiFocalLoss(2), lambda: MultiFocalLoss(2), 4),
+}
+
+
+def saved_tensor_hooks(inputs):
+    """统计前向中为反向保存的张量(不包括输入本身)，与设备无关，CPU上同样可以比较不同实现的激活占用
+
+    Return:
+        saved_tensors_hooks上下文，以及{storage地址: 字节数}，在上下文中前向后填充
+    """
+    input_storages = {tensor.untyped_storage().data_ptr() for tensor in inputs}
+    storages = dict()
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in input_storages:
+            storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    return torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor), storages
+
+
+def loss_step_benchmark(criterion, logits, masks, steps=10, warmup=3):
+    """测量一个损失函数前向+反向的耗时、显存峰值以及为反向保存的张量大小
+
+    Return:
+        result: dict，另外返回第一次的损失和梯度，用于与原始实现比较
+    """
+    device = logits.device
+
+    def step():
+        logits.grad = None
+        loss = criterion(logits, masks)
+        if isinstance(loss, (tuple, list)):
+            loss = loss[0]
+        loss.backward()
+        return loss
+
+    hooks, saved = saved_tensor_hooks([logits, masks])
+    with hooks:
+        loss = step()
+    grad = logits.grad.clone()
+    for _ in range(warmup):
+        step()
+    synchronize(device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    allocated = torch.cuda.memory_allocated(device) if device.type == 'cuda' else 0
+
+    start = time.time()
+    for _ in range(steps):
+        step()
+    synchronize(device)
+    elapsed = time.time() - start
+
+    peak_memory_mb = None
+    if device.type == 'cuda':
+        peak_memory_mb = (torch.cuda.max_memory_allocated(device) - allocated) / 1024 ** 2
+    return {'ms_per_step': 1000 * elapsed / steps, 'peak_memory_mb': peak_memory_mb,
+            'saved_mb': sum(saved.values()) / 1024 ** 2, 'loss_value': loss.item(), 'grad': grad}
+
+
+def benchmark_losses(image_size=1024, batch_size=2, device=None, names=None, steps=10, warmup=3):
+    """对比LOSS_BENCHMARKS中各损失函数原始实现与优化实现的耗时和显存，以及两者损失、梯度的最大差值
+
+    Return:
+        rows: 每一个损失函数的每一种实现一行，peak_memory_mb为损失前向+反向额外的显存峰值(CPU上为None)
+    """
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    rows = list()
+    for name in names or LOSS_BENCHMARKS:
+        torch.manual_seed(0)
+        class_num = LOSS_BENCHMARKS[name][2]
+        if class_num == 1:
+            # 与模型输出一致：展开后的float32 logits，掩膜中约1%的像素为正类
+            logits = (torch.randn(batch_size, image_size * image_size, device=device) * 3).requires_grad_()
+            masks = (torch.rand(batch_size, image_size * image_size, device=device) > 0.99).float()
+        else:
+            logits = torch.randn(batch_size, class_num, image_size, image_size, device=device).requires_grad_()
+            masks = torch.randint(0, class_num, (batch_size, image_size, image_size), device=device)
+        reference = None
+        for implementation, factory in zip(('reference', 'optimized'), LOSS_BENCHMARKS[name][:2]):
+            criterion = factory().to(device)
+            result = loss_step_benchmark(criterion, logits, masks, steps, warmup)
+            grad = result.pop('grad')
+            row = {'loss': name, 'implementation': implementation, 'image_size': image_size, 'batch_size': batch_size, 'device': str(device)}
+            row.update(result)
+            if reference is None:
+                reference = (row['loss_value'], grad)
+            else:
+                row['loss_diff'] = abs(row['loss_value'] - reference[0])
+                row['max_grad_diff'] = (grad - reference[1]).abs().max().item()
+            rows.append(row)
+            del criterion, grad
+        del logits, masks, reference
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+    return rows
+
+
+class LoopRAdam(torch.optim.Optimizer):
+    """RAdam原来的实现：逐个参数转为float32计算后再拷贝回参数，只用于对比
+    """
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0):
+        super(LoopRAdam, self).__init__(params, dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay))
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                grad = p.grad.float()
+                p_data_fp32 = p.float()
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(p_data_fp32)
+                    state['exp_avg_sq'] = torch.zeros_like(p_data_fp32)
+                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                state['step'] += 1
+                step_size, adaptive = rectified_step_size(state['step'], group['lr'], beta1, beta2)
+                if group['weight_decay'] != 0:
+                    p_data_fp32.add_(p_data_fp32, alpha=-group['weight_decay'] * group['lr'])
+                if adaptive:
+                    p_data_fp32.addcdiv_(exp_avg, exp_avg_sq.sqrt().add_(group['eps']), value=-step_size)
+                else:
+                    p_data_fp32.add_(exp_avg, alpha=-step_size)
+                p.copy_(p_data_fp32)
+
+
+def benchmark_optimizer(model_type, device=None, dtypes=('float32',), steps=10, warmup=3):
+    """对比RAdam原来逐参数的实现与multi-tensor实现一步更新的耗时，以及更新后参数的最大差值
+
+    梯度为固定的随机数，与模型的前向、反向无关；foreach在GPU上更快，per_tensor在CPU上更快，RAdam默认按设备选择；
+    半精度参数额外测试保存float32主权重的master_weights
+
+    Return:
+        rows: 每一种数据类型的每一种实现一行
+    """
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    rows = list()
+    for dtype_name in dtypes:
+        dtype = getattr(torch, dtype_name)
+        implementations = [('loop', LoopRAdam, {}), ('foreach', RAdam, {'foreach': True}), ('per_tensor', RAdam, {'foreach': False})]
+        if dtype != torch.float32:
+            implementations.append(('master_weights', RAdam, {'master_weights': True}))
+        reference = None
+        for implementation, optimizer_class, kwargs in implementations:
+            torch.manual_seed(0)
+            model = get_model(model_type, 1, 2).to(device=device, dtype=dtype)
+            params = [p for p in model.parameters() if p.requires_grad]
+            for p in params:
+                p.grad = torch.randn_like(p) * 1e-3
+            optimizer = optimizer_class(params, lr=1e-3, weight_decay=1e-4, **kwargs)
+            for _ in range(warmup):
+                optimizer.step()
+            synchronize(device)
+            start = time.time()
+            for _ in range(steps):
+                optimizer.step()
+            synchronize(device)
+            elapsed = time.time() - start
+            flat = torch.cat([p.detach().float().view(-1) for p in params])
+            row = {'model_type': model_type, 'implementation': implementation, 'dtype': dtype_name, 'device': str(device),
+                   'tensors': len(params), 'ms_per_step': 1000 * elapsed / steps}
+            if reference is None:
+                reference = flat
+            else:
+                row['max_param_diff'] = (flat - reference).abs().max().item()
+            rows.append(row)
+            del model, params, optimizer, flat
+        del reference
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+    return rows
+
+
+def benchmark_decode(image_dir, image_sizes=(768, 1024), num_images=100):
+    """对比原来的解码方式(完整解码为RGB后缩放)与灰度、DCT域缩小解码后缩放的单张耗时，以及两者像素的最大差值
+
+    Return:
+        rows: 每一种尺寸的每一种实现一行
+    """
+    image_names = sorted(os.listdir(image_dir))[:num_images]
+    image_paths = [os.path.join(image_dir, image_name) for image_name in image_names]
+    implementations = [
+        ('full_rgb', lambda path, size: np.asarray(Image.open(path).convert('RGB').resize((size, size), Image.BILINEAR))[..., 0]),
+        ('draft_gray', lambda path, size: np.asarray(decode_gray(path, size).resize((size, size), Image.BILINEAR))),
+    ]
+    rows = list()
+    for image_size in image_sizes:
+        reference = None
+        for implementation, decode in implementations:
+            start = time.time()
+            images = [decode(path, image_size) for path in image_paths]
+            elapsed = time.time() - start
+            row = {'implementation': implementation, 'image_size': image_size, 'images': len(images),
+                   'ms_per_image': 1000 * elapsed / len(images)}
+            if reference is None:
+                reference = images
+            else:
+                row['max_pixel_diff'] = max(int(np.abs(image.astype(np.int16) - ref).max()) for image, ref in zip(images, reference))
+            rows.append(row)
+    return rows
+
+
+def benchmark_augmentation(image_size=1024, batch_size=16, device=None, steps=10, warmup=3):
+    """对比worker中逐样本的default增强(CPU单进程)与训练设备上批量增强的单张耗时，两者都包括归一化之前的全部增强
+
+    Return:
+        rows: 每一种实现一行
+    """
+    device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    generator = torch.Generator().manual_seed(0)
+    images = torch.randint(0, 256, (batch_size, image_size, image_size), generator=generator, dtype=torch.uint8)
+    masks = (torch.rand(batch_size, image_size, image_size, generator=generator) > 0.9).byte() * 255
+    rgb_images = [np.stack([image] * 3, axis=-1) for image in images.numpy()]
+
+    rows = list()
+    for step in range(warmup + steps):
+        if step == warmup:
+            start = time.time()
+        for image, mask in zip(rgb_images, masks.numpy()):
+            data_augmentation(image, mask, 'default')
+    rows.append({'implementation': 'per_sample', 'device': 'cpu', 'image_size': image_size, 'batch_size': batch_size,
+                 'ms_per_image': 1000 * (time.time() - start) / (steps * batch_size)})
+
+    augmentation = BatchAugmentation()
+    device_images, device_masks = images.to(device), masks.to(device)
+    for step in range(warmup + steps):
+        if step == warmup:
+            synchronize(device)
+            start = time.time()
+        augmentation(device_images, device_masks, step)
+    synchronize(device)
+    rows.append({'implementation': 'batched', 'device': str(device), 'image_size': image_size, 'batch_size': batch_size,
+                 'ms_per_image': 1000 * (time.time() - start) / (steps * batch_size)})
+    return rows
+
+
+def print_report(rows, keys):
+    """以表格形式打印测试结果
+    """
+    print(' | '.join(keys))
+    for row in rows:
+        values = list()
+        for key in keys:
+            value = row.get(key)
+            if isinstance(value, float):
+                value = '%.2f' % value
+            values.append(str(value))
+        print(' | '.join(values))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--report', type=str, default='amp', choices=['amp', 'checkpoint', 'compile', 'loss', 'optimizer', 'decode', 'augmentation'],
+                        help='amp: float32 vs mixed precision; checkpoint: memory/time of each activation checkpointing mode; '
+                             'compile: eager vs torch.compile; loss: reference vs optimized loss functions; '
+                             'optimizer: original vs foreach/per-tensor RAdam; decode: full RGB vs reduced grayscale jpeg decode')
+    parser.add_argument('--model_type', type=str, nargs='+', default=['unet_resnet34'])
+    parser.add_argument('--image_sizes', type=int, nargs='+', default=[768, 1024])
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--amp', action='store_true', help='use mixed precision in the checkpoint report')
+    parser.add_argument('--compile_mode', type=str, default='default', help='torch.compile mode in the compile report')
+    parser.add_argument('--device', type=str, default='', help='device of the compile, loss, optimizer and augmentation reports, e.g. cpu, gpu if available by default')
+    parser.add_argument('--losses', type=str, nargs='+', default=None, choices=list(LOSS_BENCHMARKS),
+                        help='losses of the loss report, all by default')
+    parser.add_argument('--dtypes', type=str, nargs='+', default=['float32', 'float16'], choices=['float32', 'float16', 'bfloat16'],
+                        help='parameter dtypes of the optimizer report')
+    parser.add_argument('--image_dir', type=str, default='./datasets/SIIM_data/train_images', help='images of the decode report')
+    parser.add_argument('--num_images', type=int, default=100, help='number of images in the decode report')
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--output', type=str, default='', help='if has value, save the report to this json file')
+    args = parser.parse_args()
+
+    rows = list()
+    # 损失函数、解码、数据增强的对比与模型无关
+    model_types = list() if args.report in ('loss', 'decode', 'augmentation') else args.model_type
+    if args.report == 'decode':
+        rows.extend(benchmark_decode(args.image_dir, args.image_sizes, args.num_images))
+    if args.report == 'augmentation':
+        device = torch.device(args.device) if args.device else None
+        for image_size in args.image_sizes:
+            rows.extend(benchmark_augmentation(image_size, args.batch_size, device, args.steps, args.warmup))
+    if args.report == 'loss':
+        device = torch.device(args.device) if args.device else None
+        for image_size in args.image_sizes:
+            rows.extend(benchmark_losses(image_size, args.batch_size, device, args.losses, args.steps, args.warmup))
+    for model_type in model_types:
+        if args.report == 'amp':
+            rows.extend(benchmark_amp(model_type, args.image_sizes, args.batch_size, args.steps, args.warmup))
+        elif args.report == 'optimizer':
+            device = torch.device(args.device) if args.device else None
+            rows.extend(benchmark_optimizer(model_type, device, args.dtypes, args.steps, args.warmup))
+        elif args.report == 'compile':
+            device = torch.device(args.device) if args.device else None
+            for image_size in args.image_sizes:
+                rows.extend(benchmark_compile(model_type, image_size, args.batch_size, args.compile_mode, device, args.steps, args.warmup))
+        else:
+            for image_size in args.image_sizes:
+                rows.extend(benchmark_checkpoint(model_type, image_size, args.batch_size, amp=args.amp, steps=args.steps, warmup=args.warmup))
+    if args.report == 'amp':
+        print_report(rows, ['model_type', 'device', 'image_size', 'batch_size', 'amp', 'images_per_second', 'peak_memory_mb', 'saved_mb'])
+    elif args.report == 'loss':
+        print_report(rows, ['loss', 'implementation', 'device', 'image_size', 'batch_size', 'ms_per_step', 'peak_memory_mb',
+                            'saved_mb', 'loss_value', 'loss_diff', 'max_grad_diff'])
+    elif args.report == 'decode':
+        print_report(rows, ['implementation', 'image_size', 'images', 'ms_per_image', 'max_pixel_diff'])
+    elif args.report == 'augmentation':
+        print_report(rows, ['implementation', 'device', 'image_size', 'batch_size', 'ms_per_image'])
+    elif args.report == 'optimizer':
+        print_report(rows, ['model_type', 'implementation', 'dtype', 'device', 'tensors', 'ms_per_step', 'max_param_diff'])
+    elif args.report == 'compile':
+        print_report(rows, ['model_type', 'task', 'mode', 'device', 'image_size', 'batch_size', 'compiled', 'eager_images_per_second',
+                            'compiled_images_per_second', 'speedup', 'eager_first_step_seconds', 'compiled_first_step_seconds'])
+    else:
+        print_report(rows, ['model_type', 'checkpoint_mode', 'checkpoint_modules', 'image_size', 'batch_size', 'amp',
+                            'images_per_second', 'peak_memory_mb', 'saved_mb', 'time_ratio', 'memory_ratio', 'saved_ratio'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
@@ -0,0 +1,111 @@
+import os
+import queue
+import shutil
+import threading
+import torch
+
+
+def snapshot_state(state):
+    """将state中的tensor拷贝到CPU，得到与训练过程无关的快照，之后训练继续更新参数也不会影响待保存的内容
+    """
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot_state(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_state(value) for value in state)
+    return state
+
+
+def atomic_save(state, path):
+    """先写入同目录下的临时文件，再重命名为目标文件，中途崩溃不会损坏已有的权重
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def atomic_link(source_path, link_path):
+    """使link_path指向与source_path相同的文件内容：优先使用硬链接，不支持硬链接的文件系统上退化为拷贝
+
+    source_path之后被os.replace覆盖时只是换了一个新的文件，硬链接仍然指向原来的内容
+    """
+    tmp_path = link_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source_path, tmp_path)
+    except OSError:
+        shutil.copyfile(source_path, tmp_path)
+    os.replace(tmp_path, link_path)
+
+
+class CheckpointWriter(object):
+    """在后台线程中保存权重，训练循环只需要将快照放入队列
+    """
+    def __init__(self, max_pending=2):
+        """
+        Args:
+            max_pending: 队列中最多等待写入的权重数目，超过时save会阻塞，避免占用过多内存
+        """
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            state, path, best_path = self.queue.get()
+            try:
+                if self.error is None:
+                    atomic_save(state, path)
+                    if best_path:
+                        atomic_link(path, best_path)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Failed to save checkpoint: {}'.format(error))
+
+    def save(self, state, path, best_path=None):
+        """
+        Args:
+            state: 待保存的内容，会先拷贝到CPU
+            path: 权重路径
+            best_path: 若不为None，保存完成后将其链接到该路径
+        """
+        self.check()
+        self.queue.put((snapshot_state(state), path, best_path))
+
+    def flush(self):
+        """等待队列中的权重全部写完
+        """
+        self.queue.join()
+        self.check()
+
+
+def apply_retention(save_path, model_type, units, keep_last_units=0):
+    """限制磁盘占用：只保留最近keep_last_units个(阶段, 折)的最后一个epoch的权重，最优权重全部保留
+
+    后一阶段从前一阶段最后一个epoch的权重继续训练，因此最近的几个需要保留，为0时不删除。
+    只考虑本次运行训练过的单元，并行调度时其它进程(其它折)的权重不会被删除
+    Args:
+        units: 本次运行训练过的(阶段, 折)，按照训练的先后顺序
+    """
+    if keep_last_units <= 0:
+        return list()
+    removed = list()
+    # epoch中间的权重(_step.pth)可能属于正在训练的阶段，由训练过程自己删除
+    for stage, index in units[:-keep_last_units]:
+        path = os.path.join(save_path, '%s_%d_%d.pth' % (model_type, stage, index))
+        if os.path.exists(path):
+            os.remove(path)
+            removed.append(path)
+    return removed
@@ -1,9 +1,13 @@
+import os
+import json
+import time
 import numpy as np
 import cv2
 import random
 import glob
 from matplotlib import pyplot as plt
 from PIL import Image
+from collections import OrderedDict
 
 from albumentations import (
     Compose, HorizontalFlip, VerticalFlip, CLAHE, RandomRotate90, HueSaturationValue,
@@ -12,6 +16,7 @@ from albumentations import (
     RGBShift, RandomBrightnessContrast, RandomContrast, Blur, MotionBlur, MedianBlur, GaussNoise,CenterCrop,
     IAAAdditiveGaussianNoise,GaussNoise,Cutout,Rotate
 )
+from utils.batch_augmentation import BatchAugmentationTransform
 
 
 def visualize(image, mask, original_image=None, original_mask=None):
@@ -39,21 +44,13 @@ def visualize(image, mask, original_image=None, original_mask=None):
 
         plt.show()
 
-def data_augmentation(original_image, original_mask):
-    """进行样本和掩膜的随机增强
-    
-    Args:
-        original_image: 原始图片
-        original_mask: 原始掩膜
-    Return:
-        image_aug: 增强后的图片
-        mask_aug: 增强后的掩膜
+def default_pipeline(height, width):
+    """原来的增强方法：翻转、旋转、中心裁剪、直方图均衡化、亮度对比度、模糊以及噪声
     """
-    original_height, original_width = original_image.shape[:2]
-    augmentations = Compose([
+    return [
         HorizontalFlip(p=0.4),
         Rotate(limit=15, p=0.4),   
-        CenterCrop(p=0.3, height=original_height, width=original_width),
+        CenterCrop(p=0.3, height=height, width=width),
         # 直方图均衡化
         CLAHE(p=0.4),
 
@@ -72,13 +69,146 @@ def data_augmentation(original_image, original_mask):
                 IAAAdditiveGaussianNoise(),
                 GaussNoise(),
             ], p=0.2)
-    ])
+    ]
+
+
+def geometric_pipeline(height, width):
+    """只进行翻转和旋转，worker的CPU跟不上时使用
+    """
+    return [
+        HorizontalFlip(p=0.4),
+        Rotate(limit=15, p=0.4),
+    ]
+
+
+def batched_pipeline(height, width):
+    """与default相同的增强，由utils.batch_augmentation中的张量运算实现，用于与default对比速度
+    """
+    return [BatchAugmentationTransform()]
+
+
+# 增强方法的名称 -> 由输入尺寸生成变换列表的函数，各阶段通过名称选择
+PIPELINES = {
+    'default': default_pipeline,
+    'geometric': geometric_pipeline,
+    'batched': batched_pipeline,
+}
+
+
+def transform_name(transform):
+    if isinstance(transform, OneOf):
+        return 'OneOf(%s)' % ','.join(transform_name(t) for t in transform.transforms)
+    return type(transform).__name__
+
+
+class AugmentationPipeline(object):
+    """依次对样本和掩膜应用各个变换，与Compose相同；输入输出均为numpy数组
+
+    每一个变换累计调用次数和耗时，用于查看哪些增强占用了worker的CPU
+    """
+    def __init__(self, transforms):
+        self.transforms = transforms
+        self.names = ['%d.%s' % (index, transform_name(transform)) for index, transform in enumerate(transforms)]
+        # 变换名称 -> [调用次数, 累计秒数]
+        self.timings = OrderedDict((name, [0, 0.]) for name in self.names)
+
+    def __call__(self, image, mask):
+        data = {'image': image, 'mask': mask}
+        for name, transform in zip(self.names, self.transforms):
+            start = time.perf_counter()
+            data = transform(**data)
+            timing = self.timings[name]
+            timing[0] += 1
+            timing[1] += time.perf_counter() - start
+        return data['image'], data['mask']
+
+
+# 每一个进程(DataLoader的worker)中已经构建好的增强方法，(名称, 高, 宽) -> AugmentationPipeline
+_PIPELINE_CACHE = dict()
+
+
+def get_pipeline(name, height, width):
+    """返回当前进程中的增强方法，每一种名称和输入尺寸只构建一次
+    """
+    key = (name, height, width)
+    if key not in _PIPELINE_CACHE:
+        _PIPELINE_CACHE[key] = AugmentationPipeline(PIPELINES[name](height, width))
+    return _PIPELINE_CACHE[key]
+
+
+def data_augmentation(original_image, original_mask, name='default'):
+    """进行样本和掩膜的随机增强
     
-    augmented = augmentations(image=original_image, mask=original_mask)
-    image_aug = augmented['image']
-    mask_aug = augmented['mask']
+    Args:
+        original_image: 原始图片，numpy数组
+        original_mask: 原始掩膜，numpy数组
+        name: 增强方法，为PIPELINES中的键
+    Return:
+        image_aug: 增强后的图片
+        mask_aug: 增强后的掩膜
+    """
+    original_height, original_width = original_image.shape[:2]
+    return get_pipeline(name, original_height, original_width)(original_image, original_mask)
+
 
-    return image_aug, mask_aug
+def pipeline_timings():
+    """当前进程中各增强方法、各变换累计的调用次数和耗时
+
+    Return:
+        {增强方法名称: {变换名称: [调用次数, 累计秒数]}}，同名不同尺寸的增强方法合并
+    """
+    timings = dict()
+    for (name, _, _), pipeline in _PIPELINE_CACHE.items():
+        merged = timings.setdefault(name, OrderedDict())
+        for transform, (count, seconds) in pipeline.timings.items():
+            total = merged.setdefault(transform, [0, 0.])
+            total[0] += count
+            total[1] += seconds
+    return timings
+
+
+def dump_timings(timing_dir):
+    """将当前进程的耗时写入timing_dir/augmentation_<pid>.json，由训练进程汇总
+    """
+    if not os.path.exists(timing_dir):
+        os.makedirs(timing_dir, exist_ok=True)
+    path = os.path.join(timing_dir, 'augmentation_%d.json' % os.getpid())
+    with open(path + '.tmp', 'w') as f:
+        json.dump(pipeline_timings(), f)
+    os.replace(path + '.tmp', path)
+
+
+def load_timings(timing_dir):
+    """汇总timing_dir中各个worker的耗时
+    """
+    timings = dict()
+    if not os.path.exists(timing_dir):
+        return timings
+    for file_name in sorted(os.listdir(timing_dir)):
+        if not (file_name.startswith('augmentation_') and file_name.endswith('.json')):
+            continue
+        with open(os.path.join(timing_dir, file_name), 'r') as f:
+            worker_timings = json.load(f)
+        for name, transforms in worker_timings.items():
+            merged = timings.setdefault(name, OrderedDict())
+            for transform, (count, seconds) in transforms.items():
+                total = merged.setdefault(transform, [0, 0.])
+                total[0] += count
+                total[1] += seconds
+    return timings
+
+
+def format_timings(timings):
+    """按照累计耗时从大到小列出各变换，以及每次调用的平均耗时和所占的比例
+    """
+    lines = list()
+    for name, transforms in timings.items():
+        total_seconds = sum(seconds for _, seconds in transforms.values()) or 1.
+        lines.append('Augmentation %s:' % name)
+        for transform, (count, seconds) in sorted(transforms.items(), key=lambda item: -item[1][1]):
+            lines.append('  {:<50s} calls: {:>8d}, total: {:>8.1f}s, {:>7.2f}ms/call, {:>5.1f}%'.format(
+                transform, count, seconds, 1000 * seconds / max(count, 1), 100 * seconds / total_seconds))
+    return '\n'.join(lines)
 
 
 if __name__ == "__main__":
@@ -2,23 +2,151 @@ from PIL import Image
 import numpy as np
 import os
 import matplotlib.pyplot as plt
-import numpy as np
 import math
+from multiprocessing import Pool
+from tqdm import tqdm
+from datasets.mask_index import MaskAreaIndex, DEFAULT_INDEX_PATH
+
+
+DEFAULT_MANIFEST_DIR = './checkpoints/manifests'
+
+
+def manifest_dtype(path_length, mask_pixels=True):
+    """清单的结构化数组，每一个样本一行；bbox为掩膜的外接矩形(y0, x0, y1, x1)，不含y1、x1，没有掩膜时全为0
+
+    掩膜像素数目只保存在datasets.mask_index.MaskAreaIndex中，保存的清单不含mask_pixels，读取清单时再填入
+    """
+    fields = [('image_path', 'U%d' % path_length), ('mask_path', 'U%d' % path_length),
+              ('image_mtime', 'i8'), ('mask_mtime', 'i8'), ('height', 'i4'), ('width', 'i4'),
+              ('bbox', 'i4', (4,)), ('components', 'i4')]
+    if mask_pixels:
+        fields.append(('mask_pixels', 'i8'))
+    return np.dtype(fields)
+
+
+def scan_sample(paths):
+    """读取一个样本的统计信息，在进程池中运行；图片只读取文件头得到尺寸，不进行解码
+
+    Return:
+        height, width, mask_pixels, bbox, components
+    """
+    # 只有扫描样本时需要cv2，在worker中导入
+    import cv2
+    image_path, mask_path = paths
+    with Image.open(image_path) as image:
+        width, height = image.size
+    with Image.open(mask_path) as mask_img:
+        mask_np = np.asarray(mask_img) > 0
+    mask_pixels = int(np.count_nonzero(mask_np))
+    bbox, components = (0, 0, 0, 0), 0
+    if mask_pixels:
+        rows, cols = np.flatnonzero(mask_np.any(axis=1)), np.flatnonzero(mask_np.any(axis=0))
+        bbox = (rows[0], cols[0], rows[-1] + 1, cols[-1] + 1)
+        # 连通域的个数，去掉背景
+        components = cv2.connectedComponents(mask_np.astype(np.uint8), connectivity=8)[0] - 1
+    return height, width, mask_pixels, bbox, components
 
 
 class DatasetsStatic(object):
-    def __init__(self, data_root, image_folder, mask_folder, sort_flag=True):
+    """数据集的统计信息，全部由一份样本清单得到
+
+    清单记录每一个样本的路径、尺寸、外接矩形以及连通域个数，保存为.npy，掩膜像素数目取自与采样权重共用的MaskAreaIndex；
+    再次运行时只重新读取修改时间发生变化或者新增的样本，各统计方法都是对清单的查询
+    """
+    def __init__(self, data_root, image_folder, mask_folder, sort_flag=True, manifest_path=None, num_workers=None,
+                 index_path=DEFAULT_INDEX_PATH):
         """
         Args: 
             data_root: 数据集的根目录
             image_folder: 样本文件夹名
             mask_folder: 掩膜文件夹名
             sort_flag: bool，是否对样本路径进行排序
+            manifest_path: 清单的保存路径，默认为./checkpoints/manifests/<image_folder>.npy
+            num_workers: 构建清单时的进程数，默认为CPU核数
+            index_path: 掩膜像素数目的索引文件
         """
         self.data_root = data_root
         self.image_folder = os.path.join(self.data_root, image_folder)
         self.mask_folder = os.path.join(self.data_root, mask_folder)
         self.sort_flag = sort_flag
+        self.manifest_path = manifest_path or os.path.join(DEFAULT_MANIFEST_DIR, image_folder + '.npy')
+        self.num_workers = num_workers or os.cpu_count()
+        self.index_path = index_path
+        self._manifest = None
+
+    def sample_paths(self):
+        """样本路径以及对应的掩膜路径
+        """
+        image_names = os.listdir(self.image_folder)
+        if self.sort_flag:
+            image_names = sorted(image_names)
+        images_path = [os.path.join(self.image_folder, image_name) for image_name in image_names]
+        masks_path = [os.path.join(self.mask_folder, image_name.replace('jpg', 'png')) for image_name in image_names]
+        return images_path, masks_path
+
+    def manifest(self):
+        """读取并增量更新样本清单
+
+        Return:
+            manifest: 结构化数组，字段见manifest_dtype(包含mask_pixels)，顺序与sample_paths一致
+        """
+        if self._manifest is not None:
+            return self._manifest
+        images_path, masks_path = self.sample_paths()
+        mtimes = [(os.stat(image_path).st_mtime_ns, os.stat(mask_path).st_mtime_ns)
+                  for image_path, mask_path in zip(images_path, masks_path)]
+
+        previous = dict()
+        if os.path.exists(self.manifest_path):
+            for row in np.load(self.manifest_path):
+                previous[(str(row['image_path']), str(row['mask_path']))] = row
+
+        path_length = max([len(path) for path in images_path + masks_path] + [1])
+        manifest = np.zeros(len(images_path), dtype=manifest_dtype(path_length))
+        stale = list()
+        for index, (image_path, mask_path, (image_mtime, mask_mtime)) in enumerate(zip(images_path, masks_path, mtimes)):
+            row = previous.get((image_path, mask_path))
+            if row is not None and row['image_mtime'] == image_mtime and row['mask_mtime'] == mask_mtime:
+                manifest[index] = (image_path, mask_path, image_mtime, mask_mtime, row['height'], row['width'],
+                                   row['bbox'], row['components'], 0)
+            else:
+                manifest[index] = (image_path, mask_path, image_mtime, mask_mtime, 0, 0, (0, 0, 0, 0), 0, 0)
+                stale.append(index)
+
+        mask_index = MaskAreaIndex(self.index_path)
+
+        if stale or len(previous) != len(manifest):
+            if stale:
+                print('Scanning {} of {} samples in {}.'.format(len(stale), len(manifest), self.image_folder))
+                paths = [(images_path[index], masks_path[index]) for index in stale]
+                if self.num_workers > 1 and len(stale) > 64:
+                    with Pool(self.num_workers) as pool:
+                        results = list(tqdm(pool.imap(scan_sample, paths, chunksize=32), total=len(paths)))
+                else:
+                    results = [scan_sample(path) for path in tqdm(paths)]
+                for index, (height, width, mask_pixels, bbox, components) in zip(stale, results):
+                    manifest['height'][index], manifest['width'][index] = height, width
+                    manifest['bbox'][index], manifest['components'][index] = bbox, components
+                    # 扫描时已经读取了掩膜，直接记录到像素数目的索引中
+                    mask_index.record(masks_path[index], mask_pixels)
+            self.save(manifest)
+        manifest['mask_pixels'] = mask_index.areas(masks_path)
+        self._manifest = manifest
+        return manifest
+
+    def save(self, manifest):
+        """保存除mask_pixels之外的字段
+        """
+        saved = np.zeros(len(manifest), dtype=manifest_dtype(manifest.dtype['image_path'].itemsize // 4, mask_pixels=False))
+        for name in saved.dtype.names:
+            saved[name] = manifest[name]
+        manifest_dir = os.path.dirname(self.manifest_path)
+        if manifest_dir and not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir, exist_ok=True)
+        # 分布式训练时各进程可能同时写入，先写入各自的临时文件再替换
+        tmp_path = '%s.%d.tmp.npy' % (self.manifest_path[:-len('.npy')], os.getpid())
+        np.save(tmp_path, saved)
+        os.replace(tmp_path, self.manifest_path)
 
     def mask_static_bool(self):
         """统计数据集中的每一个样本是否存在掩膜
@@ -28,24 +156,8 @@ class DatasetsStatic(object):
             masks_path: 样本对应的掩膜的路径
             masks_bool: 各样本是否有掩膜
         """
-        image_names = os.listdir(self.image_folder)
-        if self.sort_flag:
-            image_names = sorted(image_names)
-        
-        images_path, masks_path, masks_bool = list(), list(), list()
-        for index, image_name in enumerate(image_names):
-            image_path = os.path.join(self.image_folder, image_name)
-            mask_name = image_name.replace('jpg', 'png')
-            mask_path = os.path.join(self.mask_folder, mask_name)
-
-            mask_pixes_num = self.cal_mask_pixes(mask_path)
-            mask_flag = bool(mask_pixes_num)
-
-            images_path.append(image_path)
-            masks_path.append(mask_path)
-            masks_bool.append(mask_flag)
-        
-        return images_path, masks_path, masks_bool
+        manifest = self.manifest()
+        return manifest['image_path'].tolist(), manifest['mask_path'].tolist(), (manifest['mask_pixels'] > 0).tolist()
 
     def mask_static_bool_stage3(self):
         """统计数据集中的每一个样本是否存在掩膜
@@ -55,84 +167,36 @@ class DatasetsStatic(object):
             masks_path: 所有有掩模样本对应的掩膜的路径
             masks_bool: 所有有掩模样本是否有掩膜
         """
-        image_names = os.listdir(self.image_folder)
-        if self.sort_flag:
-            image_names = sorted(image_names)
-        
-        images_path, masks_path, masks_bool = list(), list(), list()
-        for index, image_name in enumerate(image_names):
-            image_path = os.path.join(self.image_folder, image_name)
-            mask_name = image_name.replace('jpg', 'png')
-            mask_path = os.path.join(self.mask_folder, mask_name)
-
-            mask_pixes_num = self.cal_mask_pixes(mask_path)
-            mask_flag = bool(mask_pixes_num)
-
-            if mask_flag:
-                images_path.append(image_path)
-                masks_path.append(mask_path)
-                masks_bool.append(mask_flag)
-        
-        return images_path, masks_path, masks_bool
+        manifest = self.manifest()
+        manifest = manifest[manifest['mask_pixels'] > 0]
+        return manifest['image_path'].tolist(), manifest['mask_path'].tolist(), [True] * len(manifest)
 
     def mask_static_level(self, level=16):
         """ 依照掩膜的大小，按照指定的等级数对各样本包含的掩膜进行分级
         """
-        image_names = os.listdir(self.image_folder)
-        if self.sort_flag:
-            image_names = sorted(image_names)
-        images_path = list()
-        masks_path = list()
-        masks_pixes_num = list()
-        for index, image_name in enumerate(image_names):
-            image_path = os.path.join(self.image_folder, image_name)
-            mask_name = image_name.replace('jpg', 'png')
-            mask_path = os.path.join(self.mask_folder, mask_name)
-
-            mask_pixes_num = self.cal_mask_pixes(mask_path)
-
-            images_path.append(image_path)
-            masks_path.append(mask_path)
-            masks_pixes_num.append(mask_pixes_num)
-        
-        masks_pixes_num_np = np.asarray(masks_pixes_num)
+        manifest = self.manifest()
+        masks_pixes_num_np = manifest['mask_pixels']
         
         # 最大掩膜和最小掩膜
         mask_max = np.max(masks_pixes_num_np)
         mask_min = np.min(masks_pixes_num_np)
         # 相邻两个等级之间相差的掩膜大小，采用向上取证以保证等级数不会超出level
-        step = math.ceil((mask_max - mask_min) / level)
+        step = max(math.ceil((mask_max - mask_min) / level), 1)
         # 每一个元素表示对应掩膜大小所属的等级
-        masks_level = np.zeros_like(masks_pixes_num_np)
-        for index, start in enumerate(range(mask_min, mask_max, step)):
-            end = start + step
-            mask_index = np.where((masks_pixes_num_np >= start) & (masks_pixes_num_np < end))
-            masks_level[mask_index] = index
+        masks_level = np.minimum((masks_pixes_num_np - mask_min) // step, level - 1)
         
-        return images_path, masks_path, masks_level
+        return manifest['image_path'].tolist(), manifest['mask_path'].tolist(), masks_level
 
     def statistical_pixel(self):
         """按像素点计算所有掩模中正负样本的比例
         """
-        image_names = os.listdir(self.image_folder)
-        if self.sort_flag:
-            image_names = sorted(image_names)
-        
-        masks_pixes_num, masks_bool = list(), list()
-        for index, image_name in enumerate(image_names):
-            mask_name = image_name.replace('jpg', 'png')
-            mask_path = os.path.join(self.mask_folder, mask_name)
-
-            mask_pixes_num = self.cal_mask_pixes(mask_path)
-            if mask_pixes_num:
-                masks_pixes_num.append(mask_pixes_num)
-            else:
-                masks_pixes_num.append(0)
-            masks_bool.append(bool(mask_pixes_num))
-        positive_sum = np.sum(masks_pixes_num)
-        negative_sum = len(image_names)*1024*1024 - positive_sum
-        negative_sum_mask = sum(masks_bool)*1024*1024 - positive_sum
-        return positive_sum, negative_sum, negative_sum/positive_sum, sum(masks_bool), negative_sum_mask/positive_sum
+        manifest = self.manifest()
+        masks_bool = manifest['mask_pixels'] > 0
+        image_pixels = manifest['height'].astype(np.int64) * manifest['width']
+        positive_sum = np.sum(manifest['mask_pixels'])
+        negative_sum = np.sum(image_pixels) - positive_sum
+        negative_sum_mask = np.sum(image_pixels[masks_bool]) - positive_sum
+        return positive_sum, negative_sum, negative_sum/positive_sum, int(np.sum(masks_bool)), negative_sum_mask/positive_sum
 
     def mask_pixes_average_num(self):
         """统计每个样本所包含的掩膜的像素的平均数目
@@ -140,35 +204,16 @@ class DatasetsStatic(object):
         Return:
             average: 每个样本所包含的像素的平均数目
         """
-        mask_names = os.listdir(self.mask_folder)
-        # 有掩膜的样本的总数
-        mask_num = 0
-        # 掩膜像素总数
-        mask_pixes_sum = 0
-        for index, mask_name in enumerate(mask_names):
-            mask_path = os.path.join(self.mask_folder, mask_name)
-            mask_pixes_num = self.cal_mask_pixes(mask_path)
-            
-            mask_pixes_sum += mask_pixes_num
-            if mask_pixes_num:
-                mask_num += 1
-        
-        average = mask_pixes_sum / mask_num
+        mask_pixels = self.manifest()['mask_pixels']
+        average = np.sum(mask_pixels) / np.count_nonzero(mask_pixels)
         return average
     
     def mask_num_static(self):
         """统计数据集掩膜分布情况
         """
-        mask_names = os.listdir(self.mask_folder)
+        mask_pixels = self.manifest()['mask_pixels']
         # 各样本掩膜的像素数目
-        mask_pix_num = list()
-
-        for index, mask_name in enumerate(mask_names):
-            mask_path = os.path.join(self.mask_folder, mask_name)
-            
-            mask_pix_per_image = self.cal_mask_pixes(mask_path)
-            if mask_pix_per_image:
-                mask_pix_num.append(mask_pix_per_image)
+        mask_pix_num = mask_pixels[mask_pixels > 0].tolist()
 
         mask_pix_num_np = np.asarray(mask_pix_num)
         # 掩膜像素数目的最小值
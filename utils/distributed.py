@@ -0,0 +1,98 @@
+import os
+import datetime
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend=''):
+    """依据torchrun设置的环境变量初始化进程组，没有使用torchrun启动时什么也不做
+
+    Args:
+        backend: 通信后端，为空时GPU上使用nccl，CPU上使用gloo
+    Return:
+        是否处于分布式模式
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return False
+    if dist.is_initialized():
+        return True
+    if not backend:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if torch.cuda.is_available():
+        torch.cuda.set_device(get_local_rank())
+    # 只有主进程进行验证，其它进程在barrier处等待，超时时间需要长于一次验证
+    dist.init_process_group(backend=backend, timeout=datetime.timedelta(hours=2))
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def get_local_rank():
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_main_process():
+    """只有主进程保存权重、写TensorBoard日志以及进行验证
+    """
+    return get_rank() == 0
+
+
+def get_device():
+    """当前进程使用的设备，分布式模式下每一个进程使用一张卡
+    """
+    if torch.cuda.is_available():
+        return torch.device('cuda', get_local_rank()) if is_distributed() else torch.device('cuda')
+    return torch.device('cpu')
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def wrap_model(model, device, find_unused_parameters=False):
+    """分布式模式下转换为原生SyncBatchNorm并使用DistributedDataParallel，否则使用DataParallel
+
+    SyncBatchNorm只支持GPU，CPU(gloo)上保留普通的BN，各进程使用各自批次的统计量，
+    DistributedDataParallel会在每次前向时将主进程的running_mean/running_var广播给其它进程
+
+    Args:
+        find_unused_parameters: 部分参数在某些step中没有梯度时(例如冻结编码器)需要为True
+    """
+    if not is_distributed():
+        # 没有GPU时DataParallel直接调用module，这样CPU上也可以统一使用model.module
+        return torch.nn.DataParallel(model.to(device))
+    if device.type == 'cuda':
+        model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+        model = model.to(device)
+        return torch.nn.parallel.DistributedDataParallel(model, device_ids=[device.index], output_device=device.index,
+                                                         find_unused_parameters=find_unused_parameters)
+    return torch.nn.parallel.DistributedDataParallel(model.to(device), find_unused_parameters=find_unused_parameters)
+
+
+class NullWriter(object):
+    """非主进程使用的SummaryWriter，不写任何日志
+    """
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+    def add_image(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,159 @@
+import os
+import glob
+import argparse
+import numpy as np
+import torch
+
+
+# 每一条记录对应一张图片在某一个权重下的评估结果，全部使用定长类型，方便直接以内存映射的方式读取
+LEDGER_DTYPE = np.dtype([
+    ('image_id', 'S64'),
+    ('fold', 'i1'),
+    ('stage', 'i1'),
+    ('pred_pixels', 'i4'),
+    ('true_pixels', 'i4'),
+    ('intersection', 'i4'),
+    ('dice', 'f4'),
+    ('threshold', 'f4'),
+    ('pixel_threshold', 'i4'),
+    ('max_prob', 'f4'),
+])
+
+
+class EvalLedger(object):
+    """按权重保存逐图片评估结果的列式账本
+
+    每一个权重对应ledger_root下的一个.npy文件，文件名与权重名相同(不含.pth)。记录在写入时按照dice升序排列，
+    因此"某一折某一阶段最差的n张图片"只需要以mmap方式打开文件并取前n行。
+    """
+    def __init__(self, ledger_root):
+        """
+        Args:
+            ledger_root: 账本的存放目录，一般为 save_path/ledger
+        """
+        self.ledger_root = ledger_root
+        # 分布式训练时各进程会同时创建
+        os.makedirs(self.ledger_root, exist_ok=True)
+
+    def path(self, checkpoint_name):
+        checkpoint_name = os.path.basename(checkpoint_name)
+        if checkpoint_name.endswith('.pth'):
+            checkpoint_name = checkpoint_name[:-4]
+        return os.path.join(self.ledger_root, checkpoint_name + '.npy')
+
+    def write(self, checkpoint_name, records):
+        """按dice升序写入一个权重的全部记录，先写临时文件再重命名，避免中断时留下损坏的文件
+
+        Args:
+            checkpoint_name: 权重名称，可以带.pth后缀或路径
+            records: LEDGER_DTYPE类型的结构化数组
+        """
+        records = np.sort(records, order=['dice', 'image_id'])
+        ledger_path = self.path(checkpoint_name)
+        tmp_path = ledger_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, records)
+        os.replace(tmp_path, ledger_path)
+        return ledger_path
+
+    def promote(self, checkpoint_name, best_checkpoint_name):
+        """当前权重成为最优权重时，将其账本复制一份到最优权重名下
+        """
+        records = self.load(checkpoint_name)
+        self.write(best_checkpoint_name, np.array(records))
+
+    def load(self, checkpoint_name):
+        return np.load(self.path(checkpoint_name), mmap_mode='r')
+
+    def worst(self, fold, stage, n=100, best=True):
+        """查询某一折某一阶段得分最低的n张图片
+
+        Args:
+            fold: 第几折
+            stage: 第几阶段
+            n: 返回的图片数目
+            best: 是否查询最优权重的账本
+        Return:
+            records: 按dice升序排列的前n条记录
+        """
+        pattern = '*_%d_%d_best.npy' if best else '*_%d_%d.npy'
+        ledger_paths = glob.glob(os.path.join(self.ledger_root, pattern % (stage, fold)))
+        if not ledger_paths:
+            raise FileNotFoundError("Can not find ledger of fold {} stage {} in {}".format(fold, stage, self.ledger_root))
+        return np.load(sorted(ledger_paths)[0], mmap_mode='r')[:n]
+
+
+class LedgerRecorder(object):
+    """在验证过程中逐批次累积每张图片的统计量，结束时一次性写入账本
+    """
+    def __init__(self, ledger, checkpoint_name, fold, stage, threshold, pixel_threshold=0):
+        self.ledger = ledger
+        self.checkpoint_name = checkpoint_name
+        self.fold = fold
+        self.stage = stage
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self.batches = list()
+
+    def add_batch(self, image_ids, probs, masks):
+        """
+        Args:
+            image_ids: 当前批次各图片的ImageId
+            probs: 经过sigmoid的预测概率，[batch_size, ...]
+            masks: 真实掩膜，[batch_size, ...]
+        """
+        n = probs.shape[0]
+        probs = probs.view(n, -1)
+        masks = masks.view(n, -1).to(probs.device)
+
+        preds = (probs > self.threshold).float()
+        # 过滤噪声点，与选阈值时的处理保持一致
+        preds[preds.sum(-1) < self.pixel_threshold, ...] = 0.0
+        pred_pixels = preds.sum(-1)
+        true_pixels = masks.sum(-1)
+        intersection = (preds * masks).sum(-1)
+        max_prob = probs.max(-1)[0]
+
+        # 只把每张图片的几个标量拷回CPU
+        stats = torch.stack([pred_pixels, true_pixels, intersection, max_prob.float()], dim=1).cpu().numpy()
+        records = np.zeros(n, dtype=LEDGER_DTYPE)
+        records['image_id'] = [image_id.encode('utf-8') for image_id in image_ids]
+        records['fold'] = self.fold
+        records['stage'] = self.stage
+        records['pred_pixels'] = stats[:, 0]
+        records['true_pixels'] = stats[:, 1]
+        records['intersection'] = stats[:, 2]
+        records['max_prob'] = stats[:, 3]
+        records['threshold'] = self.threshold
+        records['pixel_threshold'] = self.pixel_threshold
+        # 与dice_overall一致：预测和真实均为空时dice为1
+        union = stats[:, 0] + stats[:, 1]
+        records['dice'] = np.where(union == 0, 1.0, 2. * stats[:, 2] / np.maximum(union, 1))
+        self.batches.append(records)
+
+    def close(self):
+        if not self.batches:
+            return None
+        return self.ledger.write(self.checkpoint_name, np.concatenate(self.batches))
+
+
+def image_ids_of(image_paths):
+    """由图片路径得到ImageId
+    """
+    return [os.path.splitext(os.path.basename(image_path))[0] for image_path in image_paths]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ledger_root', type=str, default='./checkpoints/unet_resnet34/ledger')
+    parser.add_argument('--fold', type=int, default=0)
+    parser.add_argument('--stage', type=int, default=2)
+    parser.add_argument('--n', type=int, default=100, help='how many worst images to show')
+    parser.add_argument('--last', action='store_true', help='query the last checkpoint instead of the best one')
+    args = parser.parse_args()
+
+    ledger = EvalLedger(args.ledger_root)
+    for record in ledger.worst(args.fold, args.stage, args.n, best=not args.last):
+        print('{}  dice: {:.4f}  pred: {}  true: {}  inter: {}  max_prob: {:.4f}'.format(
+            record['image_id'].decode('utf-8'), record['dice'], record['pred_pixels'],
+            record['true_pixels'], record['intersection'], record['max_prob']))
@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import subprocess
+
+
+def save_split(split_file, folds):
+    """保存交叉验证的划分，folds中每一折为 {'all': (train_image, train_mask, val_image, val_mask), 'mask': (...)}
+    """
+    split_dir = os.path.dirname(split_file)
+    if split_dir and not os.path.exists(split_dir):
+        os.makedirs(split_dir)
+    tmp_path = split_file + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(folds, f)
+    os.replace(tmp_path, split_file)
+
+
+def load_split(split_file):
+    with open(split_file, 'r') as f:
+        return json.load(f)
+
+
+def folds_suffix(folds):
+    """只训练部分折时各进程私有文件的后缀，并行训练的各折共用save_path时互不覆盖
+    """
+    if not folds:
+        return ''
+    return '_fold' + '_'.join(str(fold) for fold in sorted(folds))
+
+
+class Slot(object):
+    """一个资源槽：使用的设备、CPU线程数以及DataLoader的worker数目
+    """
+    def __init__(self, name, device, cpu_threads, num_workers):
+        self.name = name
+        self.device = device
+        self.cpu_threads = cpu_threads
+        self.num_workers = num_workers
+        self.unit = None
+
+    def env(self):
+        env = dict(os.environ)
+        # cpu表示不使用GPU
+        env['CUDA_VISIBLE_DEVICES'] = '' if self.device == 'cpu' else self.device
+        env['OMP_NUM_THREADS'] = str(self.cpu_threads)
+        env['MKL_NUM_THREADS'] = str(self.cpu_threads)
+        return env
+
+
+class Unit(object):
+    """一个调度单元：某一折的全部阶段，或者某一折的某一个阶段
+    """
+    def __init__(self, fold, stage=None, depends=None):
+        self.fold = fold
+        self.stage = stage
+        self.depends = depends
+        self.name = 'fold%d' % fold if stage is None else 'fold%d_stage%d' % (fold, stage)
+        # pending/running/done/failed/skipped
+        self.status = 'pending'
+        self.attempts = 0
+        self.slot = None
+        self.process = None
+        self.log_file = None
+        self.start_time = None
+        self.end_time = None
+
+    def ready(self):
+        return self.status == 'pending' and (self.depends is None or self.depends.status == 'done')
+
+
+class FoldScheduler(object):
+    """以独立的进程并行训练交叉验证的各折(或各折的各阶段)
+
+    交叉验证的划分先由训练脚本以split模式计算一次并保存，各个进程通过--split_file读取同一份划分，
+    因此结果与顺序运行时一致。每一个单元占用一个资源槽，失败后重试，进度表写入progress.md。
+    """
+    def __init__(self, script, script_args, slots, model_type, model_path, folds=None, stages=None, mode='train', retries=1, poll_interval=10):
+        """
+        Args:
+            script: 训练脚本，train_sfold.py或train_sfold_stage2.py
+            script_args: 传给训练脚本的其它参数
+            slots: Slot列表
+            folds: 需要训练的折，为None时训练所有折
+            stages: 为None时每一折作为一个单元；否则每一折的每一个阶段作为一个单元，后一阶段依赖前一阶段
+            mode: 每一折作为一个单元时使用的训练模式
+            retries: 失败后的重试次数
+        """
+        self.script = script
+        self.script_args = list(script_args)
+        self.slots = slots
+        self.model_type = model_type
+        self.model_path = model_path
+        self.save_path = os.path.join(model_path, model_type)
+        self.folds = folds
+        self.stages = stages
+        self.mode = mode
+        self.retries = retries
+        self.poll_interval = poll_interval
+        self.split_file = os.path.join(self.save_path, 'folds.json')
+        self.log_dir = os.path.join(self.save_path, 'scheduler_logs')
+        self.units = list()
+
+    def base_command(self):
+        return [sys.executable, self.script] + self.script_args + \
+               ['--model_type', self.model_type, '--model_path', self.model_path, '--split_file', self.split_file]
+
+    def prepare_split(self):
+        """在所有单元开始之前计算一次交叉验证的划分
+        """
+        if not os.path.exists(self.split_file):
+            print('Computing the folds once: {}'.format(self.split_file))
+            subprocess.run(self.base_command() + ['--mode', 'split'], check=True)
+        return load_split(self.split_file)
+
+    def build_units(self, n_folds):
+        folds = self.folds if self.folds else list(range(n_folds))
+        for fold in folds:
+            if self.stages is None:
+                self.units.append(Unit(fold))
+                continue
+            previous = None
+            for stage in self.stages:
+                previous = Unit(fold, stage, depends=previous)
+                self.units.append(previous)
+
+    def checkpoint_name(self, stage, fold):
+        return '%s_%d_%d.pth' % (self.model_type, stage, fold)
+
+    def latest_checkpoint(self, stage, fold):
+        """本阶段最近保存的权重：epoch结束时的权重，或者epoch中间的权重(_step.pth)，都不存在时返回None
+        """
+        names = [self.checkpoint_name(stage, fold), self.checkpoint_name(stage, fold).replace('.pth', '_step.pth')]
+        names = [name for name in names if os.path.exists(os.path.join(self.save_path, name))]
+        if not names:
+            return None
+        return max(names, key=lambda name: os.path.getmtime(os.path.join(self.save_path, name)))
+
+    def command(self, unit, slot):
+        command = self.base_command() + ['--folds', str(unit.fold), '--num_workers', str(slot.num_workers)]
+        if unit.stage is None:
+            return command + ['--mode', self.mode]
+        command += ['--mode', 'train_stage%d' % unit.stage]
+        # 重试时从本阶段最后保存的权重继续训练，epoch中间保存的权重更新时从中断的批次继续；否则从上一阶段最后一个epoch的权重开始，与顺序运行时一致
+        resume = self.latest_checkpoint(unit.stage, unit.fold) if unit.attempts > 1 else None
+        if resume:
+            command += ['--resume', resume]
+        elif unit.depends is not None:
+            command += ['--resume', self.checkpoint_name(unit.depends.stage, unit.fold)]
+        return command
+
+    def launch(self, unit, slot):
+        unit.attempts += 1
+        unit.status = 'running'
+        unit.slot = slot
+        unit.start_time = time.time()
+        unit.end_time = None
+        slot.unit = unit
+        log_path = os.path.join(self.log_dir, '%s_attempt%d.log' % (unit.name, unit.attempts))
+        unit.log_file = open(log_path, 'w')
+        command = self.command(unit, slot)
+        print('Launch {} on slot {}: {}'.format(unit.name, slot.name, ' '.join(command)))
+        unit.process = subprocess.Popen(command, stdout=unit.log_file, stderr=subprocess.STDOUT, env=slot.env())
+
+    def finish(self, unit, return_code):
+        unit.end_time = time.time()
+        unit.log_file.close()
+        unit.slot.unit = None
+        unit.process = None
+        if return_code == 0:
+            unit.status = 'done'
+        elif unit.attempts <= self.retries:
+            print('{} failed with code {}, retry.'.format(unit.name, return_code))
+            unit.status = 'pending'
+        else:
+            print('{} failed with code {}.'.format(unit.name, return_code))
+            unit.status = 'failed'
+            # 依赖失败单元的后续阶段不再运行
+            for other in self.units:
+                if other.depends is not None and other.depends.status in ('failed', 'skipped') and other.status == 'pending':
+                    other.status = 'skipped'
+
+    def write_progress(self):
+        rows = list()
+        for unit in self.units:
+            duration = ''
+            if unit.start_time is not None:
+                duration = str(datetime.timedelta(seconds=int((unit.end_time or time.time()) - unit.start_time)))
+            rows.append({'unit': unit.name, 'status': unit.status, 'slot': unit.slot.name if unit.slot else '',
+                         'attempts': unit.attempts, 'duration': duration})
+        with open(os.path.join(self.save_path, 'progress.json'), 'w') as f:
+            json.dump(rows, f, indent=2)
+        keys = ['unit', 'status', 'slot', 'attempts', 'duration']
+        lines = ['| ' + ' | '.join(keys) + ' |', '|' + '---|' * len(keys)]
+        for row in rows:
+            lines.append('| ' + ' | '.join(str(row[key]) for key in keys) + ' |')
+        with open(os.path.join(self.save_path, 'progress.md'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def run(self):
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+        folds = self.prepare_split()
+        self.build_units(len(folds))
+        try:
+            while any(unit.status in ('pending', 'running') for unit in self.units):
+                for unit in self.units:
+                    if unit.status == 'running':
+                        return_code = unit.process.poll()
+                        if return_code is not None:
+                            self.finish(unit, return_code)
+                for slot in self.slots:
+                    if slot.unit is not None:
+                        continue
+                    ready = [unit for unit in self.units if unit.ready()]
+                    if not ready:
+                        break
+                    self.launch(ready[0], slot)
+                self.write_progress()
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            for unit in self.units:
+                if unit.status == 'running':
+                    unit.process.terminate()
+            raise
+        self.write_progress()
+        failed = [unit.name for unit in self.units if unit.status != 'done']
+        if failed:
+            print('Not finished: {}'.format(', '.join(failed)))
+        return not failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the folds of train_sfold.py/train_sfold_stage2.py in parallel, '
+                                                 'arguments after -- are passed to the training script.')
+    parser.add_argument('--script', type=str, default='train_sfold_stage2.py')
+    parser.add_argument('--model_type', type=str, default='unet_resnet34')
+    parser.add_argument('--model_path', type=str, default='./checkpoints')
+    parser.add_argument('--devices', type=str, nargs='+', default=['0'], help='one slot per item, a gpu id (e.g. 0 or 0,1) or cpu')
+    parser.add_argument('--cpu_threads', type=int, default=4, help='cpu threads of each slot')
+    parser.add_argument('--num_workers', type=int, default=4, help='dataloader workers of each slot')
+    parser.add_argument('--folds', type=int, nargs='*', default=[], help='which folds to run, all folds if empty')
+    parser.add_argument('--unit', type=str, default='fold', choices=['fold', 'stage'], help='schedule each fold, or each (fold, stage)')
+    parser.add_argument('--stages', type=int, nargs='+', default=[1, 2, 3], help='stages to run when unit is stage')
+    parser.add_argument('--mode', type=str, default='train', help='mode of the training script when unit is fold')
+    parser.add_argument('--retries', type=int, default=1)
+    parser.add_argument('--poll_interval', type=float, default=10)
+    args, script_args = parser.parse_known_args()
+    if script_args and script_args[0] == '--':
+        script_args = script_args[1:]
+
+    slots = [Slot('%s#%d' % (device, index), device, args.cpu_threads, args.num_workers) for index, device in enumerate(args.devices)]
+    scheduler = FoldScheduler(args.script, script_args, slots, args.model_type, args.model_path, args.folds,
+                              args.stages if args.unit == 'stage' else None, args.mode, args.retries, args.poll_interval)
+    sys.exit(0 if scheduler.run() else 1)
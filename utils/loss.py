@@ -7,6 +7,7 @@ import torch
 from torch import nn 
 import torch.nn.functional as F
 from torch.autograd import Variable
+from utils.mixed_precision import autocast_disabled
 
 
 def one_hot(target, class_num):
@@ -20,17 +21,11 @@ def one_hot(target, class_num):
     assert target.dim() == 2 or target.dim() == 3
 
     origin_size = target.size()
-    origin_numel = target.numel()
-    target_flat = target.view(origin_size[0], -1)
+    target_flat = target.view(origin_size[0], 1, -1)
 
-    # target_oh的大小为[batch_size, class_num, 单个样本包含的像素数]
-    target_oh = torch.zeros(origin_size[0], class_num, int(origin_numel/origin_size[0]))
-
-    for c in range(class_num):
-        # 找出真实标定中为第c类的样本
-        target_index = target_flat == c
-        # 将第c类中对应这些样本的位置 置为1
-        target_oh[:, c, :] = target_index
+    # target_oh的大小为[batch_size, class_num, 单个样本包含的像素数]，与target在同一设备上，一次比较得到所有类别
+    classes = torch.arange(class_num, device=target.device).view(1, class_num, 1)
+    target_oh = (target_flat == classes).float()
     
     if target.dim() > 2:
         target_oh =  target_oh.view(origin_size[0], class_num, origin_size[1], origin_size[2])
@@ -152,33 +147,134 @@ class SoftBceLoss(nn.Module):
             loss = loss.mean()
         return loss
 
+# 融合损失每次处理的元素数目，逐块计算时临时张量的大小与该值成正比
+FUSED_CHUNK_NUMEL = 1 << 22
+
+
+def column_chunks(batch_size, numel):
+    """按列将[batch_size, numel]切分为若干块，每一块约FUSED_CHUNK_NUMEL个元素
+    """
+    step = max(1, FUSED_CHUNK_NUMEL // batch_size)
+    for start in range(0, numel, step):
+        yield slice(start, min(start + step, numel))
+
+
+class SoftBCEDiceFunction(torch.autograd.Function):
+    """SoftBCEDiceLoss的融合实现：带pos_weight的BCE以及加权soft dice
+
+    前向逐块计算BCE的和以及soft dice需要的三个逐样本的和(交集、预测的平方和、真实的平方和)，
+    反向逐块重新计算sigmoid并直接写入梯度；只保存输入和每个样本的三个标量，
+    不保存sigmoid、权重以及p*2-1、t*2-1等与输入同样大小的中间结果；
+    前向和反向都关闭autocast，否则sigmoid之后的乘法和vecdot会以半精度计算和累加
+    """
+    @staticmethod
+    @autocast_disabled
+    def forward(ctx, logit, truth, weight_neg, weight_pos, pos_weight):
+        ctx.input_shape = logit.shape
+        batch_size = logit.size(0)
+        logit = logit.reshape(batch_size, -1)
+        truth = truth.reshape(batch_size, -1).to(logit.dtype)
+        # 半精度的输入也使用float32计算和累加
+        dtype = torch.promote_types(logit.dtype, torch.float32)
+        pos_weight_tensor = torch.tensor(pos_weight, dtype=dtype, device=logit.device)
+        bce_sum = logit.new_zeros((), dtype=dtype)
+        sums = logit.new_zeros(3, batch_size, dtype=dtype)
+        for chunk in column_chunks(batch_size, logit.size(1)):
+            x, t = logit[:, chunk].to(dtype), truth[:, chunk].to(dtype)
+            bce_sum += F.binary_cross_entropy_with_logits(x, t, pos_weight=pos_weight_tensor, reduction='sum')
+            # 与SoftDiceLoss一致：w为各像素的类别权重，p、t转换到[-1, 1]
+            w2 = t.mul(weight_pos - weight_neg).add_(weight_neg).square_()
+            p = torch.sigmoid(x).mul_(2).sub_(1)
+            t = t.mul(2).sub_(1)
+            wp = w2 * p
+            sums[0] += torch.linalg.vecdot(wp, t)
+            sums[1] += torch.linalg.vecdot(wp, p)
+            sums[2] += torch.linalg.vecdot(w2.mul_(t), t)
+        dice = 1 - 2 * sums[0] / (sums[1] + sums[2])
+
+        ctx.save_for_backward(logit, truth, sums)
+        ctx.weights = (weight_neg, weight_pos, pos_weight)
+        return bce_sum / logit.numel(), dice.mean()
+
+    @staticmethod
+    @autocast_disabled
+    def backward(ctx, grad_bce, grad_dice):
+        logit, truth, sums = ctx.saved_tensors
+        weight_neg, weight_pos, pos_weight = ctx.weights
+        batch_size = logit.size(0)
+        intersection, union = sums[0].view(-1, 1), (sums[1] + sums[2]).view(-1, 1)
+        # dice对p = 2*sigmoid(x)-1的导数为 -2*w2*(t*union - 2*intersection*p)/union^2，再对batch取平均；dp/dx = 2*s*(1-s)
+        dice_coef = grad_dice * (-4. / batch_size) / union ** 2
+        bce_coef = grad_bce / logit.numel()
+        grad = torch.empty_like(logit)
+        for chunk in column_chunks(batch_size, logit.size(1)):
+            x, t = logit[:, chunk].to(sums.dtype), truth[:, chunk].to(sums.dtype)
+            s = torch.sigmoid(x)
+            # BCE对x的导数为 s*(pos_weight*t + 1 - t) - pos_weight*t
+            bce_grad = t.mul(pos_weight - 1).add_(1).mul_(s).sub_(t, alpha=pos_weight).mul_(bce_coef)
+            w2 = t.mul(weight_pos - weight_neg).add_(weight_neg).square_()
+            dice_grad = t.mul(2).sub_(1).mul_(union).sub_(s.mul(2).sub_(1).mul_(2 * intersection))
+            dice_grad.mul_(w2).mul_(dice_coef).mul_(s)
+            # s已经用完，原地转为1-s
+            dice_grad.mul_(s.neg_().add_(1))
+            grad[:, chunk] = bce_grad.add_(dice_grad)
+        return grad.view(ctx.input_shape), None, None, None, None
+
+
 class SoftBCEDiceLoss(nn.Module):
     """加权BCE+DiceLoss
     """
-    def __init__(self, size_average=True, weight=[0.2, 0.8]):
+    def __init__(self, size_average=True, weight=[0.2, 0.8], fused=True):
         """
         weight: weight[0]为负类的权重，weight[1]为正类的权重
+        fused: 是否使用融合实现SoftBCEDiceFunction，只支持size_average为True
         """
         super(SoftBCEDiceLoss, self).__init__()
         self.size_average = size_average
         self.weight = weight
+        self.fused = fused and size_average
         self.bce_loss = nn.BCEWithLogitsLoss(size_average=self.size_average, pos_weight=torch.tensor(self.weight[1]))
         # self.bce_loss = SoftBceLoss(weight=weight)
         self.softdiceloss = SoftDiceLoss(size_average=self.size_average, weight=weight)
     
     def forward(self, input, target):
-        soft_bce_loss = self.bce_loss(input, target)
-        soft_dice_loss = self.softdiceloss(input, target)
+        if self.fused:
+            soft_bce_loss, soft_dice_loss = SoftBCEDiceFunction.apply(input, target, self.weight[0], self.weight[1], self.weight[1])
+        else:
+            soft_bce_loss = self.bce_loss(input, target)
+            soft_dice_loss = self.softdiceloss(input, target)
         loss = soft_bce_loss + soft_dice_loss
 
         return loss, soft_bce_loss, soft_dice_loss
 
+def lovasz_gradient(truth_sorted, truth_sum):
+    """按hinge降序排列的真实类标对应的Lovasz梯度，逐行(逐图片)计算
+
+    Args:
+        truth_sorted: [batch_size, k]，按hinge降序排列后的真实类标，可以只包含前k个
+        truth_sum: [batch_size, 1]，每张图片全部像素的真实类标之和
+    """
+    intersection = truth_sum - truth_sorted.cumsum(1)
+    union = truth_sum + (1 - truth_sorted).cumsum(1)
+    jaccard = 1. - intersection / union
+    return torch.cat((jaccard[:, :1], jaccard[:, 1:] - jaccard[:, :-1]), 1)
+
+
 class LovaszLoss(nn.Module):
     '''加权lovasz loss
     '''
-    def __init__(self, margin=[1,5]):
+    def __init__(self, margin=[1,5], top_k=0, batched=True):
+        """
+        Args:
+            margin: 负类、正类像素的margin
+            top_k: 大于0时每张图片只排序最大的top_k个hinge；第top_k个hinge不大于0时与完整排序的结果相同，
+                否则忽略了之后较小的hinge，是一种近似
+            batched: 是否一次对整个batch排序，为False时逐图片计算(原始实现，top_k无效)
+        """
         super(LovaszLoss, self).__init__()
         self.margin = margin
+        self.top_k = top_k
+        self.batched = batched
 
     def forward(self, logit_pixel, truth_pixel):
         batch_size = len(logit_pixel)
@@ -186,11 +282,31 @@ class LovaszLoss(nn.Module):
         truth = truth_pixel.view(batch_size,-1)
         assert(logit.shape==truth.shape)
     
-        loss = self.lovasz_loss(logit, truth, self.margin)  
+        if self.batched:
+            loss = self.lovasz_loss_batched(logit, truth, self.margin)
+        else:
+            loss = self.lovasz_loss(logit, truth, self.margin)
         loss = loss.mean()
         
         return loss
 
+    def lovasz_loss_batched(self, logit, truth, margin=[1,5]):
+        """一次对整个batch排序，并用逐行的cumsum计算Lovasz梯度
+
+        Return:
+            每张图片的损失，[batch_size]
+        """
+        truth = truth.float()
+        m = truth.detach()*(margin[1]-margin[0])+margin[0]
+        hinge = m - logit * (2. * truth - 1.)
+        if 0 < self.top_k < hinge.size(1):
+            hinge, permutation = torch.topk(hinge, self.top_k, dim=1, sorted=True)
+        else:
+            hinge, permutation = torch.sort(hinge, dim=1, descending=True)
+        truth_sorted = truth.gather(1, permutation)
+        gradient = lovasz_gradient(truth_sorted, truth.sum(1, keepdim=True))
+        return (F.relu(hinge) * gradient).sum(1)
+
     def lovasz_loss(self, logit, truth, margin=[1,5]):
 
         def compute_lovasz_gradient(truth): #sorted
@@ -225,7 +341,7 @@ class LovaszLoss(nn.Module):
         lovasz_one = lovasz_hinge_one
     
         batch_size = len(truth)
-        loss = torch.zeros(batch_size).cuda()
+        loss = logit.new_zeros(batch_size)
         for b in range(batch_size):
             l, t = logit[b].view(-1), truth[b].view(-1)
             loss[b] = lovasz_one(l, t)
@@ -240,17 +356,16 @@ class MultiDiceLoss(nn.Module):
         super(MultiDiceLoss, self).__init__()
         self.class_num = class_num
         self.weights = weights
-        self.dice_loss = DiceLoss()
 
     def forward(self, input, target):
-        # 对真实类标进行one-hot编码
-        target_oh = one_hot(target, self.class_num)
+        batch_size = input.size(0)
+        target = target.view(batch_size, -1)
 
         totalLoss = 0
 
-        # 针对每一类分别计算Dice损失
+        # 针对每一类分别计算Dice损失，与DiceLoss一致；不进行one-hot编码，直接用target == i选出第i类的像素
         for i in range(self.class_num):
-            diceLoss = self.dice_loss(input[:, i], target_oh[:, i])
+            diceLoss = 1 - dice_loss(torch.sigmoid(input[:, i]), (target == i).to(input.dtype))
             if self.weights is not None:
                 diceLoss *= self.weights[i]
             totalLoss += diceLoss
@@ -266,35 +381,28 @@ class RobustFocalLoss2d(nn.Module):
         self.size_average = size_average
 
     def forward(self, logit, target, class_weight=None, type='sigmoid'):
-        target = target.view(-1, 1).long()
-
         if type=='sigmoid':
+            target = target.view(-1, 1).long()
             if class_weight is None:
                 class_weight = [1]*2 # [0.5, 0.5]
 
-            prob = torch.sigmoid(logit)
-            prob = prob.view(-1, 1)
-            prob = torch.cat((1-prob, prob), 1)
-            # select表示样本属于的类别(one-hot)形式
-            select = torch.FloatTensor(len(prob), 2).zero_().cuda()
-            select.scatter_(1, target, 1.)
+            # 样本属于真实类别的概率：正类为prob，负类为1-prob
+            prob = torch.sigmoid(logit).view(-1, 1)
+            prob = torch.where(target == 1, prob, 1 - prob)
 
         elif type == 'softmax':
             B, C, H, W = logit.size()
             if class_weight is None:
                 class_weight =[1]*C #[1/C]*C
 
-            logit = logit.permute(0, 2, 3, 1).contiguous().view(-1, C)
-            prob = F.softmax(logit,1)
-            select = torch.FloatTensor(len(prob), C).zero_().cuda()
-            select.scatter_(1, target, 1.)
+            # 直接在[B, C, H, W]上沿类别维度取出真实类别的概率，不需要转置拷贝
+            prob = F.softmax(logit, 1).gather(1, target.view(B, 1, H, W).long()).view(-1, 1)
+            target = target.view(-1, 1).long()
 
         # 各个类别的损失对应的权重
-        class_weight = torch.FloatTensor(class_weight).cuda().view(-1,1)
+        class_weight = logit.new_tensor(class_weight).view(-1,1)
         class_weight = torch.gather(class_weight, 0, target)
 
-        # 样本属于真实类别的概率
-        prob = (prob * select).sum(1).view(-1, 1)
         prob = torch.clamp(prob, 1e-8, 1-1e-8)
 
         focus = torch.pow((1-prob), self.gamma)
@@ -326,22 +434,18 @@ class MultiFocalLoss(nn.Module):
             input: 模型的输入，取softmax后，表示对应样本属于各类的概率
             target: 真实类标
         """
-        if input.dim()>2:
-            input = input.view(input.size(0), input.size(1), -1)  # N,C,H,W => N,C,H*W
-            input = input.transpose(1, 2)    # N,C,H*W => N,H*W,C
-            input = input.contiguous().view(-1, input.size(2))   # N,H*W,C => N*H*W,C
-        target = target.view(-1, 1)
-
-        logpt = F.log_softmax(input)
+        # 直接在[N, C, ...]上沿类别维度计算log_softmax并取出真实类别，不需要转置拷贝
+        target = target.view(input.size(0), 1, -1)
+        logpt = F.log_softmax(input.view(input.size(0), input.size(1), -1), dim=1)
         logpt = logpt.gather(1, target)
         logpt = logpt.view(-1)
-        pt = Variable(logpt.data.exp())
+        pt = logpt.detach().exp()
 
         if self.alpha is not None:
-            if self.alpha.type() != input.data.type():
-                self.alpha = self.alpha.type_as(input.data)
-            at = self.alpha.gather(0, target.data.view(-1))
-            logpt = logpt * Variable(at)
+            if self.alpha.type() != input.type() or self.alpha.device != input.device:
+                self.alpha = self.alpha.to(input)
+            at = self.alpha.gather(0, target.view(-1))
+            logpt = logpt * at
 
         loss = -1 * (1-pt)**self.gamma * logpt
         if self.size_average: 
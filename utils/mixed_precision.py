@@ -0,0 +1,40 @@
+import functools
+import torch
+
+
+def autocast_dtype(device):
+    """混合精度下前向使用的数据类型：GPU上为float16，CPU上为bfloat16
+    """
+    device = torch.device(device)
+    return torch.float16 if device.type == 'cuda' else torch.bfloat16
+
+
+def autocast(device, enabled=True):
+    """返回对应设备的autocast上下文，enabled为False时不做任何转换
+    """
+    device = torch.device(device)
+    return torch.autocast(device_type=device.type, dtype=autocast_dtype(device), enabled=enabled)
+
+
+def grad_scaler(device, enabled=True):
+    """返回梯度缩放器；bfloat16的数值范围与float32相同，不需要缩放，因此只在GPU上启用
+    """
+    device = torch.device(device)
+    enabled = enabled and device.type == 'cuda'
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def autocast_disabled(function):
+    """装饰autograd.Function的forward/backward，在输入张量所在设备上关闭autocast
+
+    作用与torch.amp.custom_fwd(cast_inputs=torch.float32)/custom_bwd相同，但不限定设备类型，
+    CPU上的bfloat16混合精度同样适用；不转换输入的类型，由函数自己逐块转换为float32，避免保存float32的输入副本
+    """
+    @functools.wraps(function)
+    def wrapper(ctx, *args):
+        device = next(arg.device for arg in args if torch.is_tensor(arg))
+        with torch.autocast(device_type=device.type, enabled=False):
+            return function(ctx, *args)
+    return wrapper
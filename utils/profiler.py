@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import contextlib
+import numpy as np
+import torch
+
+
+# 训练循环中各阶段的顺序，报告按照该顺序输出
+PHASES = ['data', 'h2d', 'augmentation', 'forward', 'loss', 'backward', 'optimizer', 'logging', 'checkpoint']
+
+
+class PhaseProfiler(object):
+    """逐步统计训练循环中各阶段的耗时，用于判断一个epoch慢在读数据还是计算
+
+    打开时在每一个阶段的开始和结束同步设备，因此统计的是该阶段真实的耗时(同步本身会使训练变慢)；
+    每个epoch结束时输出各阶段的p50/p95/p99，并将一个采样窗口内的各步写为Chrome trace(chrome://tracing)
+    """
+    def __init__(self, save_path, device, enabled=False, trace_start=10, trace_steps=20):
+        """
+        Args:
+            save_path: trace文件的保存目录
+            device: 训练使用的设备，GPU上需要同步
+            enabled: 为False时所有操作均不做任何事
+            trace_start: 每一个阶段从第几步开始记录trace
+            trace_steps: trace记录的步数，为0时不记录(分布式模式下只有主进程记录)
+        """
+        self.save_path = save_path
+        self.device = device
+        self.enabled = enabled
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.durations = dict()
+        self.events = list()
+        self.trace_name = None
+        self.step = 0
+
+    def synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def start_stage(self, stage, index):
+        """每一个阶段开始时调用，该阶段的前trace_start步之后记录一个trace窗口
+        """
+        # 上一个阶段的步数不足以填满trace窗口时，保存已经记录的部分
+        if self.events:
+            self.write_trace()
+        self.step = 0
+        self.trace_name = 'profile_stage%d_fold%d.trace.json' % (stage, index) if self.trace_steps > 0 else None
+
+    def in_trace_window(self):
+        return self.trace_name is not None and self.trace_start <= self.step < self.trace_start + self.trace_steps
+
+    def record(self, name, start, end):
+        self.durations.setdefault(name, list()).append(end - start)
+        if self.in_trace_window():
+            # Chrome trace的时间单位为微秒
+            self.events.append({'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                                'pid': os.getpid(), 'tid': 0, 'args': {'step': self.step}})
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.synchronize()
+            self.record(name, start, time.perf_counter())
+
+    def iterate(self, loader):
+        """包装DataLoader，记录每一步等待数据的时间，并对步数计数
+        """
+        if not self.enabled:
+            return loader
+        return self._iterate(loader)
+
+    def _iterate(self, loader):
+        iterator = iter(loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.record('data', start, time.perf_counter())
+            yield batch
+            self.step += 1
+            if self.trace_name is not None and self.step == self.trace_start + self.trace_steps:
+                self.write_trace()
+
+    def write_trace(self):
+        if self.events:
+            with open(os.path.join(self.save_path, self.trace_name), 'w') as f:
+                json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+            print('Saved the profile trace of steps [{}, {}) to {}'.format(
+                self.trace_start, self.trace_start + self.trace_steps, os.path.join(self.save_path, self.trace_name)))
+        self.events = list()
+        self.trace_name = None
+
+    def report(self):
+        """一个epoch结束时调用，返回各阶段耗时的统计并清空
+
+        Return:
+            {phase: {'count': 步数, 'total': 总耗时(s), 'p50'/'p95'/'p99': 分位数(ms)}}
+        """
+        if not self.enabled:
+            return dict()
+        names = [name for name in PHASES if name in self.durations] + \
+                sorted(name for name in self.durations if name not in PHASES)
+        summary = dict()
+        for name in names:
+            durations = np.array(self.durations[name]) * 1000
+            p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+            summary[name] = {'count': len(durations), 'total': durations.sum() / 1000, 'p50': p50, 'p95': p95, 'p99': p99}
+        self.durations = dict()
+        return summary
+
+
+def format_report(summary):
+    total = sum(item['total'] for item in summary.values())
+    lines = ['%-12s %8s %10s %7s %10s %10s %10s' % ('phase', 'count', 'total(s)', 'share', 'p50(ms)', 'p95(ms)', 'p99(ms)')]
+    for name, item in summary.items():
+        lines.append('%-12s %8d %10.2f %6.1f%% %10.2f %10.2f %10.2f' % (
+            name, item['count'], item['total'], 100. * item['total'] / total if total > 0 else 0., item['p50'], item['p95'], item['p99']))
+    return '\n'.join(lines)
@@ -1,145 +1,185 @@
 import math
+from collections import defaultdict
 import torch
 from torch.optim.optimizer import Optimizer, required
 
-class RAdam(Optimizer):
 
-    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0):
-        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
-        self.buffer = [[None, None, None] for ind in range(10)]
-        super(RAdam, self).__init__(params, defaults)
-
-    def __setstate__(self, state):
-        super(RAdam, self).__setstate__(state)
-
-    def step(self, closure=None):
-
-        loss = None
-        if closure is not None:
-            loss = closure()
-
-        for group in self.param_groups:
-
-            for p in group['params']:
-                if p.grad is None:
-                    continue
-                grad = p.grad.data.float()
-                if grad.is_sparse:
-                    raise RuntimeError('RAdam does not support sparse gradients')
-
-                p_data_fp32 = p.data.float()
-
-                state = self.state[p]
-
-                if len(state) == 0:
-                    state['step'] = 0
-                    state['exp_avg'] = torch.zeros_like(p_data_fp32)
-                    state['exp_avg_sq'] = torch.zeros_like(p_data_fp32)
-                else:
-                    state['exp_avg'] = state['exp_avg'].type_as(p_data_fp32)
-                    state['exp_avg_sq'] = state['exp_avg_sq'].type_as(p_data_fp32)
-
-                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
-                beta1, beta2 = group['betas']
-
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
-
-                state['step'] += 1
-                buffered = self.buffer[int(state['step'] % 10)]
-                if state['step'] == buffered[0]:
-                    N_sma, step_size = buffered[1], buffered[2]
-                else:
-                    buffered[0] = state['step']
-                    beta2_t = beta2 ** state['step']
-                    N_sma_max = 2 / (1 - beta2) - 1
-                    N_sma = N_sma_max - 2 * state['step'] * beta2_t / (1 - beta2_t)
-                    buffered[1] = N_sma
-
-                    # more conservative since it's an approximated value
-                    if N_sma >= 5:
-                        step_size = group['lr'] * math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** state['step'])
-                    else:
-                        step_size = group['lr'] / (1 - beta1 ** state['step'])
-                    buffered[2] = step_size
+def rectified_step_size(step, lr, beta1, beta2):
+    """RAdam第step步的步长
 
-                if group['weight_decay'] != 0:
-                    p_data_fp32.add_(-group['weight_decay'] * group['lr'], p_data_fp32)
+    Return:
+        step_size, adaptive：方差的近似值还不可靠(N_sma < 5)时adaptive为False，此时不除以二阶矩，退化为带动量的SGD
+    """
+    beta2_t = beta2 ** step
+    N_sma_max = 2 / (1 - beta2) - 1
+    N_sma = N_sma_max - 2 * step * beta2_t / (1 - beta2_t)
+    # more conservative since it's an approximated value
+    if N_sma >= 5:
+        step_size = lr * math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** step)
+        return step_size, True
+    return lr / (1 - beta1 ** step), False
 
-                # more conservative since it's an approximated value
-                if N_sma >= 5:            
-                    denom = exp_avg_sq.sqrt().add_(group['eps'])
-                    p_data_fp32.addcdiv_(-step_size, exp_avg, denom)
-                else:
-                    p_data_fp32.add_(-step_size, exp_avg)
 
-                p.data.copy_(p_data_fp32)
+def foreach_copy_(targets, sources):
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(targets, sources)
+    else:
+        for target, source in zip(targets, sources):
+            target.copy_(source)
 
-        return loss
 
-class PlainRAdam(Optimizer):
+class _MultiTensorRAdam(Optimizer):
+    """RAdam的multi-tensor实现：参数按照(设备, 数据类型, step)分组，GPU上每一组只调用几次torch._foreach_*完成更新，
+    CPU上逐个参数原地更新
 
-    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0):
+    一阶、二阶矩始终为float32；float32的参数及其梯度直接原地更新，不再拷贝；
+    半精度的参数在master_weights为True时在状态中保存一份float32的主权重，更新主权重后再拷贝回参数，
+    否则与原来的实现一样，每一步由半精度参数临时转为float32更新
+    """
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0, master_weights=False, foreach=None):
         defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
-
-        super(PlainRAdam, self).__init__(params, defaults)
+        self.master_weights = master_weights
+        # 为None时GPU上使用foreach
+        self.foreach = foreach
+        super(_MultiTensorRAdam, self).__init__(params, defaults)
 
     def __setstate__(self, state):
-        super(PlainRAdam, self).__setstate__(state)
-
+        super(_MultiTensorRAdam, self).__setstate__(state)
+
+    def load_state_dict(self, state_dict):
+        """Optimizer.load_state_dict会将状态转为参数的数据类型，半精度参数的一阶、二阶矩以及主权重按照保存时的float32恢复
+        """
+        saved = state_dict['state']
+        indices = [index for group in state_dict['param_groups'] for index in group['params']]
+        super(_MultiTensorRAdam, self).load_state_dict(state_dict)
+        params = [p for group in self.param_groups for p in group['params']]
+        for index, p in zip(indices, params):
+            for key in ('exp_avg', 'exp_avg_sq', 'master'):
+                if key in saved.get(index, {}):
+                    self.state[p][key] = saved[index][key].to(device=p.device, dtype=torch.float32)
+
+    def step_size(self, step, lr, beta1, beta2):
+        return rectified_step_size(step, lr, beta1, beta2)
+
+    def init_state(self, p):
+        state = self.state[p]
+        if len(state) == 0:
+            state['step'] = 0
+            state['exp_avg'] = torch.zeros_like(p, dtype=torch.float32, memory_format=torch.preserve_format)
+            state['exp_avg_sq'] = torch.zeros_like(p, dtype=torch.float32, memory_format=torch.preserve_format)
+        if self.master_weights and p.dtype != torch.float32 and 'master' not in state:
+            state['master'] = p.detach().float()
+        return state
+
+    @torch.no_grad()
     def step(self, closure=None):
 
         loss = None
         if closure is not None:
-            loss = closure()
+            with torch.enable_grad():
+                loss = closure()
 
         for group in self.param_groups:
-
+            beta1, beta2 = group['betas']
+            # (设备, 数据类型, step, 是否有主权重) -> [参数, 梯度, 一阶矩, 二阶矩, 主权重]
+            buckets = defaultdict(lambda: ([], [], [], [], []))
             for p in group['params']:
                 if p.grad is None:
                     continue
-                grad = p.grad.data.float()
-                if grad.is_sparse:
+                if p.grad.is_sparse:
                     raise RuntimeError('RAdam does not support sparse gradients')
-
-                p_data_fp32 = p.data.float()
-
-                state = self.state[p]
-
-                if len(state) == 0:
-                    state['step'] = 0
-                    state['exp_avg'] = torch.zeros_like(p_data_fp32)
-                    state['exp_avg_sq'] = torch.zeros_like(p_data_fp32)
-                else:
-                    state['exp_avg'] = state['exp_avg'].type_as(p_data_fp32)
-                    state['exp_avg_sq'] = state['exp_avg_sq'].type_as(p_data_fp32)
-
-                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
-                beta1, beta2 = group['betas']
-
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
-
+                state = self.init_state(p)
                 state['step'] += 1
-                beta2_t = beta2 ** state['step']
-                N_sma_max = 2 / (1 - beta2) - 1
-                N_sma = N_sma_max - 2 * state['step'] * beta2_t / (1 - beta2_t)
+                bucket = buckets[(p.device, p.dtype, state['step'], 'master' in state)]
+                bucket[0].append(p)
+                bucket[1].append(p.grad)
+                bucket[2].append(state['exp_avg'])
+                bucket[3].append(state['exp_avg_sq'])
+                if 'master' in state:
+                    bucket[4].append(state['master'])
+
+            for (device, dtype, step, _), (params, grads, exp_avgs, exp_avg_sqs, masters) in buckets.items():
+                step_size, adaptive = self.step_size(step, group['lr'], beta1, beta2)
+                foreach = self.foreach if self.foreach is not None else device.type == 'cuda'
+                update = self.foreach_update if foreach else self.tensor_update
+                update(params, grads, exp_avgs, exp_avg_sqs, masters, group, step_size, adaptive)
 
-                if group['weight_decay'] != 0:
-                    p_data_fp32.add_(-group['weight_decay'] * group['lr'], p_data_fp32)
+        return loss
 
-                # more conservative since it's an approximated value
-                if N_sma >= 5:                    
-                    step_size = group['lr'] * math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** state['step'])
-                    denom = exp_avg_sq.sqrt().add_(group['eps'])
-                    p_data_fp32.addcdiv_(-step_size, exp_avg, denom)
-                else:
-                    step_size = group['lr'] / (1 - beta1 ** state['step'])
-                    p_data_fp32.add_(-step_size, exp_avg)
+    @staticmethod
+    def foreach_update(params, grads, exp_avgs, exp_avg_sqs, masters, group, step_size, adaptive):
+        beta1, beta2 = group['betas']
+        # 更新的对象：float32的参数本身、主权重，或者半精度参数临时转换的float32
+        targets = params
+        if params[0].dtype != torch.float32:
+            grads = [grad.float() for grad in grads]
+            targets = masters if masters else [p.float() for p in params]
+
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+
+        if group['weight_decay'] != 0:
+            torch._foreach_mul_(targets, 1 - group['weight_decay'] * group['lr'])
+
+        if adaptive:
+            denom = torch._foreach_sqrt(exp_avg_sqs)
+            torch._foreach_add_(denom, group['eps'])
+            torch._foreach_addcdiv_(targets, exp_avgs, denom, value=-step_size)
+        else:
+            torch._foreach_add_(targets, exp_avgs, alpha=-step_size)
+
+        if targets is not params:
+            foreach_copy_(params, targets)
+
+    @staticmethod
+    def tensor_update(params, grads, exp_avgs, exp_avg_sqs, masters, group, step_size, adaptive):
+        """与foreach_update相同的计算，逐个参数完成全部更新，CPU上参数留在缓存中，比逐个操作遍历全部参数更快
+        """
+        beta1, beta2 = group['betas']
+        for index, (p, grad, exp_avg, exp_avg_sq) in enumerate(zip(params, grads, exp_avgs, exp_avg_sqs)):
+            target = p
+            if p.dtype != torch.float32:
+                grad = grad.float()
+                target = masters[index] if masters else p.float()
+
+            exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+
+            if group['weight_decay'] != 0:
+                target.mul_(1 - group['weight_decay'] * group['lr'])
+
+            if adaptive:
+                target.addcdiv_(exp_avg, exp_avg_sq.sqrt().add_(group['eps']), value=-step_size)
+            else:
+                target.add_(exp_avg, alpha=-step_size)
+
+            if target is not p:
+                p.copy_(target)
+
+
+class RAdam(_MultiTensorRAdam):
+    """RAdam，同一个step的步长只计算一次，缓存在self.buffer中，所有参数组、所有分组共用
+    """
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0, master_weights=False, foreach=None):
+        # 最近10个(step, lr, betas)的步长
+        self.buffer = [[None, None, None] for ind in range(10)]
+        super(RAdam, self).__init__(params, lr, betas, eps, weight_decay, master_weights, foreach)
 
-                p.data.copy_(p_data_fp32)
+    def step_size(self, step, lr, beta1, beta2):
+        buffered = self.buffer[int(step % 10)]
+        key = (step, lr, beta1, beta2)
+        if buffered[0] != key:
+            buffered[0] = key
+            buffered[1], buffered[2] = rectified_step_size(step, lr, beta1, beta2)
+        return buffered[1], buffered[2]
 
-        return loss
+
+class PlainRAdam(_MultiTensorRAdam):
+    """不缓存步长的RAdam，每一个分组每一步重新计算
+    """
+    pass
 
 
 class AdamW(Optimizer):
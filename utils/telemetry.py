@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import datetime
+import threading
+from collections import deque
+from pprint import pformat
+import torch
+
+
+def format_seconds(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def to_floats(values):
+    """将float以及只有一个元素的tensor转为float，同一设备上的tensor拼接后一次性拷贝回CPU
+    """
+    floats = [None if torch.is_tensor(value) else float(value) for value in values]
+    positions = dict()
+    for position, value in enumerate(values):
+        if torch.is_tensor(value):
+            positions.setdefault(value.device, list()).append(position)
+    for device, device_positions in positions.items():
+        stacked = torch.stack([values[position].float().reshape(()) for position in device_positions]).cpu().tolist()
+        for position, value in zip(device_positions, stacked):
+            floats[position] = value
+    return floats
+
+
+class Throughput(object):
+    """统计训练速度(images/s)，并估计当前阶段以及当前折剩余的时间
+
+    只在主线程中记录时间戳，不进行任何设备同步；一个epoch的统计在epoch结束时(损失已同步)才是准确的
+    """
+    def __init__(self, world_size=1, momentum=0.9):
+        """
+        Args:
+            world_size: 分布式训练的进程数，每一个进程只统计自己的样本，乘上进程数得到总的吞吐
+            momentum: 每一步耗时的滑动平均系数
+        """
+        self.world_size = world_size
+        self.momentum = momentum
+        # 各阶段最近一次完整epoch的耗时，用于估计当前折后续阶段的剩余时间
+        self.epoch_seconds = dict()
+        self.step_seconds = None
+
+    def start_epoch(self, stage, steps_per_epoch, epochs_left, start_step=0):
+        """
+        Args:
+            steps_per_epoch: 每一个epoch的迭代次数
+            epochs_left: 包括当前epoch在内，当前阶段还剩多少个epoch
+            start_step: 从epoch中间继续训练时已经完成的步数
+        """
+        self.stage = stage
+        self.steps_per_epoch = steps_per_epoch
+        self.epochs_left = epochs_left
+        self.steps = start_step
+        self.images = 0
+        self.epoch_start = self.last_time = time.time()
+
+    def step(self, n_images):
+        now = time.time()
+        seconds = now - self.last_time
+        self.last_time = now
+        self.step_seconds = seconds if self.step_seconds is None else \
+            self.momentum * self.step_seconds + (1 - self.momentum) * seconds
+        self.steps += 1
+        self.images += n_images
+
+    def images_per_second(self):
+        seconds = time.time() - self.epoch_start
+        return self.images * self.world_size / seconds if seconds > 0 else 0.
+
+    def stage_eta(self):
+        """当前阶段剩余的秒数
+        """
+        if self.step_seconds is None:
+            return 0.
+        steps_left = self.steps_per_epoch - self.steps + (self.epochs_left - 1) * self.steps_per_epoch
+        return max(steps_left, 0) * self.step_seconds
+
+    def fold_eta(self, later_stages):
+        """当前折剩余的秒数
+
+        Args:
+            later_stages: 当前折之后还要训练的阶段，[(stage, epoch数), ...]；没有统计过的阶段以当前阶段的epoch耗时估计
+        """
+        epoch_seconds = self.epoch_seconds.get(self.stage, self.steps_per_epoch * (self.step_seconds or 0.))
+        return self.stage_eta() + sum(self.epoch_seconds.get(stage, epoch_seconds) * epochs for stage, epochs in later_stages)
+
+    def end_epoch(self):
+        """
+        Return:
+            本epoch的耗时、样本数以及images/s
+        """
+        seconds = time.time() - self.epoch_start
+        self.epoch_seconds[self.stage] = seconds
+        return seconds, self.images * self.world_size, self.images_per_second()
+
+
+class Telemetry(object):
+    """缓冲的训练日志：标量先放入内存中的环形缓冲区，由后台线程按照固定间隔写入TensorBoard和JSONL文件
+
+    训练循环中记录标量时可以直接传入设备上的tensor，由后台线程统一转为float，主线程不需要同步；
+    文本日志同样缓冲后追加到log.txt，代替每次都打开、写入、关闭文件的write_txt
+    """
+    def __init__(self, save_path, flush_interval=10., buffer_size=4096, enabled=True):
+        """
+        Args:
+            save_path: log.txt和telemetry.jsonl所在的目录
+            flush_interval: 后台线程写入的间隔，单位秒
+            buffer_size: 环形缓冲区的大小，写入跟不上时丢弃最早的标量
+            enabled: 为False时(分布式模式下的非主进程)不记录任何内容
+        """
+        self.save_path = save_path
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self.scalars = deque(maxlen=buffer_size)
+        self.texts = deque(maxlen=buffer_size)
+        self.dropped = 0
+        self.writer = None
+        # 并行训练各折时多个进程追加同一个telemetry.jsonl和log.txt，每一条记录带上当前的折
+        self.fold = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        self.thread = None
+        if self.enabled:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def set_writer(self, writer):
+        """切换TensorBoard的SummaryWriter(每一折一个)，切换前写完之前的缓冲
+        """
+        self.flush()
+        self.writer = writer
+
+    def set_fold(self, fold):
+        """之后记录的标量和文本属于第fold折
+        """
+        self.fold = fold
+
+    def scalar(self, tag, value, step):
+        """
+        Args:
+            value: float或者只有一个元素的tensor，tensor在后台线程中才转为float
+        """
+        if not self.enabled:
+            return
+        if torch.is_tensor(value):
+            value = value.detach()
+        with self.lock:
+            if len(self.scalars) == self.scalars.maxlen:
+                self.dropped += 1
+            self.scalars.append((tag, value, step, time.time(), self.fold))
+
+    def log(self, content):
+        """追加一条文本日志到log.txt，与write_txt的格式一致
+        """
+        if not self.enabled:
+            return
+        if isinstance(content, (dict, list)):
+            content = pformat(content)
+        if self.fold is not None:
+            content = 'Fold %d: %s' % (self.fold, content)
+        with self.lock:
+            self.texts.append(content)
+
+    def run(self):
+        while not self.closed:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        """将缓冲区中的内容写入TensorBoard、telemetry.jsonl和log.txt，主线程也可以直接调用
+        """
+        if not self.enabled:
+            return
+        with self.flush_lock:
+            with self.lock:
+                scalars, texts = list(self.scalars), list(self.texts)
+                self.scalars.clear()
+                self.texts.clear()
+                dropped, self.dropped = self.dropped, 0
+            if scalars:
+                # 设备上的标量一次性拷贝回CPU，只同步一次
+                values = to_floats([value for _, value, _, _, _ in scalars])
+                scalars = [(tag, value, step, wall_time, fold) for (tag, _, step, wall_time, fold), value in zip(scalars, values)]
+                with open(os.path.join(self.save_path, 'telemetry.jsonl'), 'a') as f:
+                    for tag, value, step, wall_time, fold in scalars:
+                        f.write(json.dumps({'tag': tag, 'value': value, 'step': step, 'time': wall_time, 'fold': fold}) + '\n')
+                        if self.writer is not None:
+                            self.writer.add_scalar(tag, value, step, walltime=wall_time)
+            if dropped:
+                texts.append('Telemetry dropped %d scalars, increase buffer_size or decrease flush_interval.' % dropped)
+            if texts:
+                with open(os.path.join(self.save_path, 'log.txt'), 'a') as f:
+                    f.write('\n'.join(texts) + '\n')
+            if self.writer is not None:
+                self.writer.flush()
+
+    def close(self):
+        """写完缓冲区并停止后台线程
+        """
+        if not self.enabled or self.closed:
+            return
+        self.closed = True
+        self.wake.set()
+        self.thread.join()
+        self.flush()
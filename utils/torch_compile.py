@@ -0,0 +1,145 @@
+import os
+import json
+import fcntl
+import importlib
+import warnings
+import torch
+
+
+COMPILE_MODES = ['default', 'reduce-overhead', 'max-autotune', 'max-autotune-no-cudagraphs']
+DEFAULT_CACHE_DIR = './checkpoints/compile_cache'
+# 只有这些dynamo/inductor的编译错误会退回eager并记录为编译失败，不同的torch版本中不存在的类型忽略
+COMPILE_ERRORS = [
+    ('torch._dynamo.exc', ['BackendCompilerFailed', 'Unsupported', 'InvalidBackend']),
+    ('torch._inductor.exc', ['InductorError', 'LoweringException', 'MissingOperatorWithoutDecomp', 'MissingOperatorWithDecomp',
+                             'InvalidCxxCompiler', 'CppCompileError', 'CUDACompileError', 'TritonMissing', 'GPUTooOldForTriton']),
+]
+
+
+def status_path(cache_dir):
+    return os.path.join(cache_dir, 'compile_status.json')
+
+
+def status_key(model_type, mode, device):
+    # 编译能否成功与模型、模式、设备类型以及torch版本有关
+    return '%s|%s|%s|torch-%s' % (model_type, mode, device.type, torch.__version__)
+
+
+def load_status(cache_dir):
+    if not os.path.exists(status_path(cache_dir)):
+        return dict()
+    with open(status_path(cache_dir), 'r') as f:
+        return json.load(f)
+
+
+def compile_errors():
+    """当前torch版本中表示编译失败的异常类型，tuple
+    """
+    errors = list()
+    for module_name, names in COMPILE_ERRORS:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        errors += [getattr(module, name) for name in names if hasattr(module, name)]
+    return tuple(errors)
+
+
+def record_failure(cache_dir, key, error):
+    """记录编译失败的模型，之后的运行直接使用eager，不再尝试编译
+
+    并行调度的多个训练进程可能同时写入，在文件锁中重新读取后合并，临时文件按进程区分
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    with open(status_path(cache_dir) + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        status = load_status(cache_dir)
+        status[key] = '%s: %s' % (type(error).__name__, str(error).splitlines()[0] if str(error) else '')
+        tmp_path = '%s.%d.tmp' % (status_path(cache_dir), os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(status, f, indent=2)
+        os.replace(tmp_path, status_path(cache_dir))
+
+
+def default_inductor_cache_dir():
+    try:
+        from torch._inductor.runtime.cache_dir_utils import default_cache_dir
+    except ImportError:
+        return None
+    return default_cache_dir()
+
+
+def set_compile_cache(cache_dir):
+    """将inductor的编译产物缓存到cache_dir，再次运行时直接读取，不需要重新编译；用户已经设置了环境变量时不覆盖
+
+    inductor第一次取缓存目录时会把默认目录写入环境变量(导入segmentation_models_pytorch时就会发生)，这种情况仍然覆盖
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    current = os.environ.get('TORCHINDUCTOR_CACHE_DIR')
+    if current is None or current == default_inductor_cache_dir():
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+    os.environ.setdefault('TORCHINDUCTOR_AUTOGRAD_CACHE', '1')
+
+
+def compile_model(model, model_type, mode='default', device=None, cache_dir=DEFAULT_CACHE_DIR):
+    """使用torch.compile编译模型的forward，编译失败时该模型退回eager执行
+
+    只替换实例的forward，因此state_dict的键不变，已有的权重可以直接加载；torch.compile是惰性的，
+    真正的编译发生在第一次前向时(输入尺寸变化时会重新编译)，此时dynamo/inductor的编译错误会打印警告、
+    记录到compile_status.json并改用eager，之后的运行中该模型不再尝试编译；其它错误(显存不足、设备端断言、
+    模型本身的错误等)与编译无关，直接抛出
+
+    Args:
+        model: 待编译的模型，需要在移动到设备之后调用；只替换forward，权重在编译前后加载均可
+        model_type: 模型名，用于记录编译失败的模型
+        mode: torch.compile的mode，为空时不编译
+        device: 模型所在的设备
+        cache_dir: 编译产物以及编译状态的缓存目录
+    Return:
+        是否使用了编译
+    """
+    if not mode:
+        return False
+    if not hasattr(torch, 'compile'):
+        print('torch.compile is not available in torch {}, using eager for {}.'.format(torch.__version__, model_type))
+        return False
+    if device is None:
+        device = next(model.parameters()).device
+    set_compile_cache(cache_dir)
+    key = status_key(model_type, mode, device)
+    failure = load_status(cache_dir).get(key)
+    if failure:
+        print('Compiling {} failed before ({}), using eager.'.format(model_type, failure))
+        return False
+
+    eager_forward = model.forward
+    try:
+        compiled_forward = torch.compile(eager_forward, mode=mode)
+    except Exception as e:
+        print('Compiling {} ({}) failed, using eager: {}'.format(model_type, mode, e))
+        record_failure(cache_dir, key, e)
+        return False
+    state = {'compiled': True}
+    errors = compile_errors()
+
+    def forward(*args, **kwargs):
+        if state['compiled']:
+            try:
+                return compiled_forward(*args, **kwargs)
+            except errors as e:
+                # 编译时的显存不足(例如自动试探batch size、autotune时)不是编译失败，需要抛出
+                if 'out of memory' in str(e):
+                    raise
+                # 第一次编译或者重新编译出错时退回eager
+                warnings.warn('Compiling {} ({}) failed, falling back to eager: {}'.format(model_type, mode, e))
+                state['compiled'] = False
+                record_failure(cache_dir, key, e)
+        return eager_forward(*args, **kwargs)
+
+    model.forward = forward
+    print('Compiling {} with torch.compile (mode={}), artifacts cached in {}'.format(
+        model_type, mode, os.environ['TORCHINDUCTOR_CACHE_DIR']))
+    return True